@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares checking every application service's namespaces against each
+event with looking the interested services up in an
+ApplicationServiceInterestIndex.
+"""
+
+from synapse.appservice import (
+    ApplicationService, ApplicationServiceInterestIndex,
+)
+from synapse.events import FrozenEvent
+
+import argparse
+import timeit
+
+
+def make_services(count):
+    return [
+        ApplicationService(
+            token="token%d" % (i,),
+            url="http://localhost:%d" % (9000 + i,),
+            sender="@bridge%d:example.com" % (i,),
+            namespaces={
+                ApplicationService.NS_USERS: [
+                    {"regex": "@bridge%d_.*" % (i,), "exclusive": True},
+                ],
+                ApplicationService.NS_ALIASES: [
+                    {"regex": "#bridge%d_.*" % (i,), "exclusive": True},
+                ],
+                ApplicationService.NS_ROOMS: [],
+            },
+        )
+        for i in range(count)
+    ]
+
+
+def make_events(count, users, bridged_percent):
+    events = []
+    for e in range(count):
+        if e % 100 < bridged_percent:
+            sender = "@bridge%d_user%d:example.com" % (e % 10, e % users)
+        else:
+            sender = "@user%d:example.com" % (e % users,)
+        events.append(FrozenEvent({
+            "type": "m.room.message",
+            "room_id": "!room%d:example.com" % (e % 50,),
+            "sender": sender,
+            "event_id": "$event%d:example.com" % (e,),
+            "content": {"msgtype": "m.text", "body": "Hello %d" % (e,)},
+        }))
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--services", type=int, default=50)
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--bridged-percent", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    services = make_services(args.services)
+    events = make_events(args.events, args.users, args.bridged_percent)
+    index = ApplicationServiceInterestIndex(services)
+
+    def check_each_service():
+        for event in events:
+            [s for s in services if s.is_interested(event)]
+
+    def check_index():
+        for event in events:
+            index.get_interested_services(event)
+
+    for name, func in (
+        ("each service", check_each_service),
+        ("interest index", check_index),
+    ):
+        best = min(timeit.repeat(func, repeat=args.repeat, number=1))
+        print "%-20s %8.1f ms %8.2f us/event" % (
+            name, best * 1000, best * 1e6 / args.events,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares storing event JSON uncompressed, compressed with plain zlib and
+compressed against the shared event dictionary, on a synthetic mix of events.
+
+Reports the total stored size, and the per-event cost of producing the stored
+form (write) and of turning it back into a dict (read).
+"""
+
+from synapse.util.jsoncompression import event_json_compressor
+
+import argparse
+import random
+import timeit
+import ujson as json
+import zlib
+
+
+def make_events(count, servers):
+    events = []
+    for i in range(count):
+        server = "server%d.example.com" % (random.randrange(servers),)
+        sender = "@user%d:%s" % (random.randrange(1000), server)
+        event = {
+            "room_id": "!room%d:example.com" % (random.randrange(50),),
+            "sender": sender,
+            "user_id": sender,
+            "event_id": "$%d%x:%s" % (i, random.getrandbits(64), server),
+            "origin": server,
+            "origin_server_ts": 1440000000000 + i,
+            "depth": i,
+            "hashes": {"sha256": "%x" % (random.getrandbits(172),)},
+            "signatures": {
+                server: {"ed25519:auto": "%x" % (random.getrandbits(344),)},
+            },
+            "prev_events": [
+                ["$%d:%s" % (i - 1, server), {"sha256": "%x" % (i,)}],
+            ],
+            "auth_events": [
+                ["$create:example.com", {"sha256": "abcdef"}],
+                ["$power:example.com", {"sha256": "abcdef"}],
+            ],
+            "unsigned": {"age_ts": 1440000000000 + i},
+        }
+        if i % 5 == 0:
+            event.update({
+                "type": "m.room.member",
+                "state_key": sender,
+                "prev_state": [],
+                "content": {
+                    "membership": "join",
+                    "displayname": "User %d" % (i,),
+                },
+            })
+        else:
+            event.update({
+                "type": "m.room.message",
+                "content": {
+                    "msgtype": "m.text",
+                    "body": "Message number %d" % (i,),
+                },
+            })
+        events.append(json.dumps(event, ensure_ascii=False))
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--servers", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    events = make_events(args.events, args.servers)
+
+    formats = (
+        ("uncompressed", lambda js: js, lambda js: js),
+        ("zlib", zlib.compress, zlib.decompress),
+        (
+            "zlib with dictionary",
+            event_json_compressor.compress,
+            event_json_compressor.decompress,
+        ),
+    )
+
+    print "%-22s %10s %8s %12s %12s" % (
+        "format", "bytes", "ratio", "write us/ev", "read us/ev",
+    )
+    raw_size = sum(len(js) for js in events)
+    for name, encode, decode in formats:
+        stored = [encode(js) for js in events]
+        size = sum(len(s) for s in stored)
+
+        write = min(timeit.repeat(
+            lambda: [encode(js) for js in events],
+            repeat=args.repeat, number=1,
+        ))
+        read = min(timeit.repeat(
+            lambda: [json.loads(decode(s)) for s in stored],
+            repeat=args.repeat, number=1,
+        ))
+
+        print "%-22s %10d %8.2f %12.1f %12.1f" % (
+            name, size, float(size) / raw_size,
+            write * 1e6 / len(events), read * 1e6 / len(events),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the JSON encoders we can use for client responses on a synthetic
+/sync response, made up of events built with or without frozen dicts.
+"""
+
+import synapse.events
+from synapse.events import FrozenEvent
+from synapse.events.utils import (
+    serialize_event, serialize_event_to_json,
+    format_event_for_client_v2_without_room_id,
+)
+from synapse.http.server import encode_fast_json
+
+from canonicaljson import encode_canonical_json
+
+import argparse
+import timeit
+import ujson
+
+
+def make_sync_response(rooms, events_per_room, members_per_room):
+    def serialize(event):
+        return serialize_event(
+            event, 1000,
+            event_format=format_event_for_client_v2_without_room_id,
+        )
+
+    def serialize_json(event):
+        return serialize_event_to_json(
+            event, 1000,
+            event_format=format_event_for_client_v2_without_room_id,
+        )
+
+    response = {}
+    raw_response = {}
+    for r in range(rooms):
+        room_id = "!room%d:example.com" % (r,)
+        state = [
+            FrozenEvent({
+                "type": "m.room.member",
+                "room_id": room_id,
+                "state_key": "@user%d:example.com" % (m,),
+                "sender": "@user%d:example.com" % (m,),
+                "event_id": "$member%d_%d:example.com" % (r, m),
+                "origin_server_ts": 1000,
+                "content": {
+                    "membership": "join",
+                    "displayname": u"User %d ☃" % (m,),
+                },
+                "unsigned": {"age_ts": 500},
+            })
+            for m in range(members_per_room)
+        ]
+        timeline = [
+            FrozenEvent({
+                "type": "m.room.message",
+                "room_id": room_id,
+                "sender": "@user%d:example.com" % (e % members_per_room,),
+                "event_id": "$message%d_%d:example.com" % (r, e),
+                "origin_server_ts": 1000,
+                "content": {"msgtype": "m.text", "body": "Hello %d" % (e,)},
+                "unsigned": {"age_ts": 500},
+            })
+            for e in range(events_per_room)
+        ]
+
+        response[room_id] = {
+            "timeline": {"events": [serialize(e) for e in timeline]},
+            "state": {"events": [serialize(e) for e in state]},
+        }
+        raw_response[room_id] = {
+            "timeline": {"events": [serialize_json(e) for e in timeline]},
+            "state": {"events": [serialize_json(e) for e in state]},
+        }
+
+    return {"rooms": {"join": response}}, {"rooms": {"join": raw_response}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--events", type=int, default=20)
+    parser.add_argument("--members", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--no-frozen-dicts", action="store_true",
+        help="Build the events without frozen dicts, as with"
+        " use_frozen_dicts: false. Only then can ujson encode them.",
+    )
+    args = parser.parse_args()
+
+    synapse.events.USE_FROZEN_DICTS = not args.no_frozen_dicts
+
+    response, raw_response = make_sync_response(
+        args.rooms, args.events, args.members
+    )
+
+    size = len(encode_canonical_json(response))
+    print "Response size: %.1f MB" % (size / 1024. / 1024.,)
+
+    encoders = [
+        ("canonical", encode_canonical_json, response),
+        ("fast", encode_fast_json, response),
+        ("fast with pre-encoded events", encode_fast_json, raw_response),
+    ]
+    if args.no_frozen_dicts:
+        def encode_ujson(obj):
+            return ujson.dumps(obj, ensure_ascii=False)
+
+        encoders.extend([
+            ("ujson", encode_ujson, response),
+            ("ujson with pre-encoded events", encode_ujson, raw_response),
+        ])
+
+    for name, func, obj in encoders:
+        best = min(timeit.repeat(
+            lambda: func(obj), repeat=args.repeat, number=1,
+        ))
+        print "%-30s %8.1f ms" % (name, best * 1000,)
+
+
+if __name__ == "__main__":
+    main()
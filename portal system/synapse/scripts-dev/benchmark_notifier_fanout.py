@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures how long the notifier takes to fan a burst of events in a large
+room out to the listeners of its members, and how many times those listeners
+get woken up.
+"""
+
+from twisted.internet import defer, reactor, task
+
+from synapse.notifier import Notifier, _NotifierUserStream
+from synapse.types import StreamToken
+from synapse.util import Clock
+
+from mock import Mock
+
+import argparse
+import time
+
+
+ROOM_ID = "!room:example.com"
+
+
+def make_notifier(members):
+    hs = Mock(spec=[
+        "get_event_sources", "get_datastore", "get_clock", "get_distributor",
+    ])
+    hs.get_clock.return_value = Clock()
+    notifier = Notifier(hs)
+
+    start_token = StreamToken.from_string("s0_0_0_0_0")
+    for m in range(members):
+        user_id = "@user%d:example.com" % (m,)
+        user_stream = _NotifierUserStream(
+            user=user_id,
+            rooms=[ROOM_ID],
+            current_token=start_token,
+            time_now_ms=0,
+        )
+        notifier._register_with_keys(user_stream)
+
+    return notifier
+
+
+def listen(notifier, counts):
+    """Adds a listener to every stream which counts how often it is woken
+    up and then listens again, like a client long-polling /events would.
+    """
+    def on_wake_up(token, user_stream):
+        counts[0] += 1
+        user_stream.new_listener(token).deferred.addCallback(
+            on_wake_up, user_stream
+        )
+
+    for user_stream in notifier.user_to_user_stream.values():
+        user_stream.new_listener(user_stream.current_token).deferred.addCallback(
+            on_wake_up, user_stream
+        )
+
+
+@defer.inlineCallbacks
+def run(args):
+    notifier = make_notifier(args.members)
+    counts = [0]
+    listen(notifier, counts)
+
+    start = time.time()
+    yield defer.gatherResults([
+        notifier.on_new_event("room_key", "s%d" % (i,), rooms=[ROOM_ID])
+        for i in range(1, args.events + 1)
+    ])
+    # Let the pending wake ups run.
+    yield task.deferLater(reactor, 0, lambda: None)
+    elapsed = time.time() - start
+
+    print "Members:             %8d" % (args.members,)
+    print "Events:              %8d" % (args.events,)
+    print "Listener wake ups:   %8d" % (counts[0],)
+    print "Wake ups per event:  %8.1f" % (counts[0] / float(args.events),)
+    print "Time:                %8.1f ms" % (elapsed * 1000,)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--members", type=int, default=5000)
+    parser.add_argument("--events", type=int, default=20)
+    args = parser.parse_args()
+
+    d = run(args)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Times state resolution for a synthetic room with a large membership whose
+forward extremities have forked, so that the state groups at the extremities
+disagree on a handful of memberships and the power levels.
+
+Resolution is timed from scratch both with and without the auth check results
+from previous runs, and again for a repeat of the same state groups.
+"""
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from synapse.api.auth import Auth
+from synapse.api.constants import EventTypes, Membership
+from synapse.events import FrozenEvent
+from synapse.state import StateHandler
+from synapse.util import Clock
+
+import argparse
+import itertools
+import timeit
+
+
+ROOM_ID = "!room:example.com"
+CREATOR = "@creator:example.com"
+
+_event_ids = itertools.count()
+
+
+def make_event(type, state_key, content, depth, sender=CREATOR):
+    return FrozenEvent({
+        "event_id": "$%d:example.com" % (next(_event_ids),),
+        "room_id": ROOM_ID,
+        "type": type,
+        "state_key": state_key,
+        "sender": sender,
+        "content": content,
+        "depth": depth,
+        "prev_events": [],
+        "auth_events": [],
+    })
+
+
+def make_member(user_id, membership, depth):
+    return make_event(
+        EventTypes.Member, user_id, {"membership": membership}, depth,
+        sender=user_id,
+    )
+
+
+def make_state_groups(members, forks, conflicts):
+    """Returns a dict of state group -> list of state events, where every
+    group shares the same base state but has its own changes to `conflicts`
+    memberships and the power levels.
+    """
+    base = [
+        make_event(EventTypes.Create, "", {"creator": CREATOR}, 1),
+        make_member(CREATOR, Membership.JOIN, 2),
+        make_event(
+            EventTypes.JoinRules, "", {"join_rule": "public"}, 3,
+        ),
+    ]
+    base.extend(
+        make_member("@user%d:example.com" % (i,), Membership.JOIN, 4)
+        for i in range(members)
+    )
+
+    groups = {}
+    for fork in range(forks):
+        changed = {
+            (e.type, e.state_key): e
+            for e in [
+                make_event(
+                    EventTypes.PowerLevels, "",
+                    {
+                        "events": {},
+                        "users": {CREATOR: 100},
+                        "users_default": fork,
+                    }, 5,
+                )
+            ] + [
+                make_member("@user%d:example.com" % (i,), Membership.LEAVE, 6)
+                for i in range(fork, fork + conflicts)
+            ]
+        }
+        groups["group%d" % (fork,)] = [
+            changed.get((e.type, e.state_key), e) for e in base
+        ] + [
+            e for k, e in changed.items()
+            if k[0] == EventTypes.PowerLevels
+        ]
+    return groups
+
+
+class BenchmarkStore(object):
+    def __init__(self, state_groups):
+        self.state_groups = state_groups
+
+    def get_state_groups(self, room_id, event_ids):
+        return defer.succeed(self.state_groups)
+
+    def get_state_group_ids(self, room_id, event_ids):
+        return defer.succeed(set(self.state_groups))
+
+
+class BenchmarkHomeServer(object):
+    def __init__(self, store):
+        self.store = store
+        self.clock = Clock()
+        self.state_handler = StateHandler(self)
+        self.auth = Auth(self)
+
+    def get_clock(self):
+        return self.clock
+
+    def get_datastore(self):
+        return self.store
+
+    def get_auth(self):
+        return self.auth
+
+    def get_state_handler(self):
+        return self.state_handler
+
+
+def resolve(state_handler, extremities):
+    results = []
+    state_handler.resolve_state_groups(
+        ROOM_ID, extremities,
+    ).addBoth(results.append)
+    if isinstance(results[0], Failure):
+        results[0].raiseException()
+    return results[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--members", type=int, default=10000)
+    parser.add_argument("--forks", type=int, default=2)
+    parser.add_argument("--conflicts", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    state_groups = make_state_groups(args.members, args.forks, args.conflicts)
+    hs = BenchmarkHomeServer(BenchmarkStore(state_groups))
+
+    # Without caching started every call resolves from scratch.
+    uncached_handler = StateHandler(hs)
+    cached_handler = hs.get_state_handler()
+    cached_handler.start_caching()
+
+    extremities = itertools.count()
+
+    def cold():
+        hs.auth = Auth(hs)
+        return resolve(uncached_handler, ["$extremity"])
+
+    def uncached():
+        return resolve(uncached_handler, ["$extremity"])
+
+    def memoized():
+        return resolve(cached_handler, [
+            "$extremity%d" % (next(extremities),) for _ in range(args.forks)
+        ])
+
+    _, state, _ = memoized()
+    print "Resolved %d keys across %d state groups" % (
+        len(state), len(state_groups),
+    )
+
+    for name, func in (
+        ("resolve, cold auth caches", cold),
+        ("resolve", uncached),
+        ("resolve, same state groups", memoized),
+    ):
+        best = min(timeit.repeat(func, repeat=args.repeat, number=1))
+        print "%-30s %8.2f ms" % (name, best * 1000,)
+
+
+if __name__ == "__main__":
+    main()
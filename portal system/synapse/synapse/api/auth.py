@@ -23,9 +23,11 @@ from twisted.internet import defer
 from synapse.api.constants import EventTypes, Membership, JoinRules
 from synapse.api.errors import AuthError, Codes, SynapseError, EventSizeError
 from synapse.types import RoomID, UserID, EventID
+from synapse.util.caches.descriptors import Cache
 from synapse.util.logutils import log_function
 from unpaddedbase64 import decode_base64
 
+import collections
 import logging
 import pymacaroons
 
@@ -39,6 +41,154 @@ AuthEventTypes = (
 )
 
 
+# The number of compiled auth contexts and auth check results to keep around.
+AUTH_CONTEXT_CACHE_SIZE = 10000
+AUTH_RESULT_CACHE_SIZE = 50000
+
+
+def _auth_keys_for_event(event):
+    """Returns the (type, state_key) pairs that `Auth.check` may look at when
+    checking the given event, or just the room-wide ones if event is None.
+    """
+    keys = [
+        (EventTypes.Create, ""),
+        (EventTypes.PowerLevels, ""),
+        (EventTypes.JoinRules, ""),
+    ]
+
+    if event is None:
+        return keys
+
+    keys.append((EventTypes.Member, event.user_id))
+
+    if event.type == EventTypes.Member:
+        keys.append((EventTypes.Member, event.state_key))
+
+        invite = event.content.get("third_party_invite")
+        if isinstance(invite, dict) and isinstance(invite.get("signed"), dict):
+            token = invite["signed"].get("token")
+            if isinstance(token, basestring):
+                keys.append((EventTypes.ThirdPartyInvite, token))
+
+    return keys
+
+
+def _compile_level(level):
+    try:
+        return int(level)
+    except (TypeError, ValueError):
+        # Leave it to the lookup to complain about, so that a bad level for
+        # one user doesn't break the checks for everyone else.
+        return level
+
+
+class PowerLevels(object):
+    """The power levels of a room, precomputed from its create and power
+    levels events. Immutable, and shared between the AuthContexts for the
+    room.
+    """
+
+    def __init__(self, create_event, power_levels_event):
+        self.create_event = create_event
+        self.power_levels_event = power_levels_event
+
+        if power_levels_event:
+            content = power_levels_event.content
+            self._levels = content
+
+            # A falsey level for a user means they get the default.
+            self._user_levels = {
+                user_id: _compile_level(level)
+                for user_id, level in content.get("users", {}).items()
+                if level
+            }
+            users_default = content.get("users_default", 0)
+            if users_default is None:
+                users_default = 0
+            self._users_default = _compile_level(users_default)
+
+            self._event_levels = content.get("events", {})
+
+    def get_user_power_level(self, user_id):
+        if self.power_levels_event:
+            return int(self._user_levels.get(user_id, self._users_default))
+        elif (self.create_event is not None and
+                self.create_event.content["creator"] == user_id):
+            return 100
+        else:
+            return 0
+
+    def get_named_level(self, name, default):
+        if not self.power_levels_event:
+            return default
+
+        level = self._levels.get(name, None)
+        if level is not None:
+            return int(level)
+        else:
+            return default
+
+    def get_send_level(self, event_type, is_state):
+        if not self.power_levels_event:
+            return 0
+
+        send_level = self._event_levels.get(event_type)
+        if send_level is None:
+            if is_state:
+                send_level = self._levels.get("state_default", 50)
+            else:
+                send_level = self._levels.get("events_default", 0)
+
+        if send_level:
+            return int(send_level)
+        else:
+            return 0
+
+
+class AuthContext(collections.Mapping):
+    """An immutable view of the auth events that an event is checked against,
+    with the power levels and memberships precomputed.
+
+    It behaves as a read-only dict of (type, state_key) -> event, so can be
+    passed anywhere that expects auth events. Contexts are built by
+    `Auth.compile_auth_events` and shared between checks against the same set
+    of auth events, which is identified by `id`.
+
+    Args:
+        auth_events (dict): (type, state_key) -> event of the auth events.
+        context_id (frozenset): The ids of the auth events.
+        power_levels (PowerLevels): The power levels for the auth events.
+    """
+
+    def __init__(self, auth_events, context_id, power_levels):
+        self._events = auth_events
+        self.id = context_id
+        self.power_levels = power_levels
+
+        self.memberships = {}
+        self.join_rule = JoinRules.INVITE
+        for (etype, state_key), event in auth_events.items():
+            if etype == EventTypes.Member:
+                self.memberships[state_key] = event.membership
+            elif etype == EventTypes.JoinRules:
+                self.join_rule = event.content.get(
+                    "join_rule", JoinRules.INVITE
+                )
+
+        self.get_user_power_level = power_levels.get_user_power_level
+        self.get_named_level = power_levels.get_named_level
+        self.get_send_level = power_levels.get_send_level
+
+    def __getitem__(self, key):
+        return self._events[key]
+
+    def __iter__(self):
+        return iter(self._events)
+
+    def __len__(self):
+        return len(self._events)
+
+
 class Auth(object):
 
     def __init__(self, hs):
@@ -54,9 +204,23 @@ class Auth(object):
             "user_id = ",
         ])
 
+        self._power_levels = Cache(
+            "auth_power_levels", max_entries=AUTH_CONTEXT_CACHE_SIZE, keylen=2,
+        )
+        self._auth_contexts = Cache(
+            "auth_contexts", max_entries=AUTH_CONTEXT_CACHE_SIZE,
+        )
+        self._auth_results = Cache(
+            "auth_results", max_entries=AUTH_RESULT_CACHE_SIZE, keylen=2,
+        )
+
     def check(self, event, auth_events):
         """ Checks if this event is correctly authed.
 
+        The result is memoized against the event_id and the ids of the auth
+        events the check depends on, as state resolution and federation tend
+        to check the same events against the same auth events many times.
+
         Args:
             event: the event being checked.
             auth_events (dict: event-key -> event): the existing room state.
@@ -65,6 +229,71 @@ class Auth(object):
         Returns:
             True if the auth checks pass.
         """
+        if auth_events is None:
+            return self._check(event, auth_events)
+
+        auth_events = self.compile_auth_events(event, auth_events)
+
+        key = (event.event_id, auth_events.id)
+        result = self._auth_results.get(key, None)
+        if result is None:
+            try:
+                result = (self._check(event, auth_events), None)
+            except SynapseError as e:
+                result = (None, e)
+            self._auth_results.prefill(key, result)
+
+        allowed, error = result
+        if error is not None:
+            raise error
+        return allowed
+
+    def compile_auth_events(self, event, auth_events):
+        """Picks out the auth events that `check` will look at for the given
+        event, and returns them as an AuthContext.
+
+        Args:
+            event: the event that will be checked, or None if only the
+                room-wide auth events (create, power levels and join rules)
+                are needed.
+            auth_events (dict): (type, state_key) -> event. May be the entire
+                state of the room.
+
+        Returns:
+            AuthContext
+        """
+        selected = {}
+        for key in _auth_keys_for_event(event):
+            auth_event = auth_events.get(key)
+            if auth_event is not None:
+                selected[key] = auth_event
+
+        context_id = frozenset(e.event_id for e in selected.values())
+        context = self._auth_contexts.get(context_id, None)
+        if context is None:
+            create_event = selected.get((EventTypes.Create, ""))
+            power_levels_event = selected.get((EventTypes.PowerLevels, ""))
+
+            power_levels_key = (
+                create_event.event_id if create_event else None,
+                power_levels_event.event_id if power_levels_event else None,
+            )
+            power_levels = self._power_levels.get(power_levels_key, None)
+            if power_levels is None:
+                power_levels = PowerLevels(create_event, power_levels_event)
+                self._power_levels.prefill(power_levels_key, power_levels)
+
+            context = AuthContext(selected, context_id, power_levels)
+            self._auth_contexts.prefill(context_id, context)
+
+        return context
+
+    def _get_auth_context(self, event, auth_events):
+        if isinstance(auth_events, AuthContext):
+            return auth_events
+        return self.compile_auth_events(event, auth_events)
+
+    def _check(self, event, auth_events):
         self.check_size_limits(event)
 
         try:
@@ -250,6 +479,7 @@ class Auth(object):
 
     @log_function
     def is_membership_change_allowed(self, event, auth_events):
+        auth_events = self._get_auth_context(event, auth_events)
         membership = event.content["membership"]
 
         # Check if this is the room creator joining:
@@ -273,35 +503,24 @@ class Auth(object):
                 )
 
         # get info about the caller
-        key = (EventTypes.Member, event.user_id, )
-        caller = auth_events.get(key)
+        caller = auth_events.memberships.get(event.user_id)
 
-        caller_in_room = caller and caller.membership == Membership.JOIN
-        caller_invited = caller and caller.membership == Membership.INVITE
+        caller_in_room = caller == Membership.JOIN
+        caller_invited = caller == Membership.INVITE
 
         # get info about the target
-        key = (EventTypes.Member, target_user_id, )
-        target = auth_events.get(key)
+        target = auth_events.memberships.get(target_user_id)
 
-        target_in_room = target and target.membership == Membership.JOIN
-        target_banned = target and target.membership == Membership.BAN
+        target_in_room = target == Membership.JOIN
+        target_banned = target == Membership.BAN
 
-        key = (EventTypes.JoinRules, "", )
-        join_rule_event = auth_events.get(key)
-        if join_rule_event:
-            join_rule = join_rule_event.content.get(
-                "join_rule", JoinRules.INVITE
-            )
-        else:
-            join_rule = JoinRules.INVITE
+        join_rule = auth_events.join_rule
 
-        user_level = self._get_user_power_level(event.user_id, auth_events)
-        target_level = self._get_user_power_level(
-            target_user_id, auth_events
-        )
+        user_level = auth_events.get_user_power_level(event.user_id)
+        target_level = auth_events.get_user_power_level(target_user_id)
 
         # FIXME (erikj): What should we do here as the default?
-        ban_level = self._get_named_level(auth_events, "ban", 50)
+        ban_level = auth_events.get_named_level("ban", 50)
 
         logger.debug(
             "is_membership_change_allowed: %s",
@@ -347,7 +566,7 @@ class Auth(object):
                 raise AuthError(403, "%s is already in the room." %
                                      target_user_id)
             else:
-                invite_level = self._get_named_level(auth_events, "invite", 0)
+                invite_level = auth_events.get_named_level("invite", 0)
 
                 if user_level < invite_level:
                     raise AuthError(
@@ -377,7 +596,7 @@ class Auth(object):
                     403, "You cannot unban user &s." % (target_user_id,)
                 )
             elif target_user_id != event.user_id:
-                kick_level = self._get_named_level(auth_events, "kick", 50)
+                kick_level = auth_events.get_named_level("kick", 50)
 
                 if user_level < kick_level or user_level <= target_level:
                     raise AuthError(
@@ -451,42 +670,13 @@ class Auth(object):
         except (KeyError, SignatureVerifyException,):
             return False
 
-    def _get_power_level_event(self, auth_events):
-        key = (EventTypes.PowerLevels, "", )
-        return auth_events.get(key)
-
     def _get_user_power_level(self, user_id, auth_events):
-        power_level_event = self._get_power_level_event(auth_events)
-
-        if power_level_event:
-            level = power_level_event.content.get("users", {}).get(user_id)
-            if not level:
-                level = power_level_event.content.get("users_default", 0)
-
-            if level is None:
-                return 0
-            else:
-                return int(level)
-        else:
-            key = (EventTypes.Create, "", )
-            create_event = auth_events.get(key)
-            if (create_event is not None and
-                    create_event.content["creator"] == user_id):
-                return 100
-            else:
-                return 0
+        auth_events = self._get_auth_context(None, auth_events)
+        return auth_events.get_user_power_level(user_id)
 
     def _get_named_level(self, auth_events, name, default):
-        power_level_event = self._get_power_level_event(auth_events)
-
-        if not power_level_event:
-            return default
-
-        level = power_level_event.content.get(name, None)
-        if level is not None:
-            return int(level)
-        else:
-            return default
+        auth_events = self._get_auth_context(None, auth_events)
+        return auth_events.get_named_level(name, default)
 
     @defer.inlineCallbacks
     def get_user_by_req(self, request, allow_guest=False):
@@ -784,29 +974,12 @@ class Auth(object):
 
     @log_function
     def _can_send_event(self, event, auth_events):
-        key = (EventTypes.PowerLevels, "", )
-        send_level_event = auth_events.get(key)
-        send_level = None
-        if send_level_event:
-            send_level = send_level_event.content.get("events", {}).get(
-                event.type
-            )
-            if send_level is None:
-                if hasattr(event, "state_key"):
-                    send_level = send_level_event.content.get(
-                        "state_default", 50
-                    )
-                else:
-                    send_level = send_level_event.content.get(
-                        "events_default", 0
-                    )
+        auth_events = self._get_auth_context(event, auth_events)
 
-        if send_level:
-            send_level = int(send_level)
-        else:
-            send_level = 0
-
-        user_level = self._get_user_power_level(event.user_id, auth_events)
+        send_level = auth_events.get_send_level(
+            event.type, hasattr(event, "state_key"),
+        )
+        user_level = auth_events.get_user_power_level(event.user_id)
 
         if user_level < send_level:
             raise AuthError(
@@ -849,9 +1022,11 @@ class Auth(object):
             AuthError if the event sender is definitely not allowed to redact
             the target event.
         """
-        user_level = self._get_user_power_level(event.user_id, auth_events)
+        auth_events = self._get_auth_context(event, auth_events)
+
+        user_level = auth_events.get_user_power_level(event.user_id)
 
-        redact_level = self._get_named_level(auth_events, "redact", 50)
+        redact_level = auth_events.get_named_level("redact", 50)
 
         if user_level > redact_level:
             return False
@@ -114,6 +114,12 @@ class Filtering(object):
                     if not isinstance(event_type, basestring):
                         raise SynapseError(400, "Event type should be a string")
 
+        if "lazy_load_members" in definition:
+            if type(definition["lazy_load_members"]) != bool:
+                raise SynapseError(
+                    400, "Expected lazy_load_members to be a boolean."
+                )
+
 
 class FilterCollection(object):
     def __init__(self, filter_json):
@@ -148,6 +154,9 @@ class FilterCollection(object):
     def ephemeral_limit(self):
         return self.room_ephemeral_filter.limit()
 
+    def lazy_load_members(self):
+        return self.room_state_filter.lazy_load_members()
+
     def filter_presence(self, events):
         return self.presence_filter.filter(events)
 
@@ -238,6 +247,12 @@ class Filter(object):
     def limit(self):
         return self.filter_json.get("limit", 10)
 
+    def lazy_load_members(self):
+        """Whether the client only wants the membership events of the users
+        whose events it is sent, rather than of every member of the room.
+        """
+        return self.filter_json.get("lazy_load_members", False)
+
 
 def _matches_wildcard(actual_value, filter_value):
     if filter_value.endswith("*"):
@@ -438,8 +438,23 @@ def setup(config_options):
 
     hs.get_pusherpool().start()
     hs.get_state_handler().start_caching()
-    hs.get_datastore().start_profiling()
-    hs.get_datastore().start_doing_background_updates()
+    store = hs.get_datastore()
+    store.start_profiling()
+    store.start_state_group_dedup()
+
+    def log_queue_failure(failure):
+        logger.error(
+            "Failed to queue event JSON compression",
+            exc_info=(failure.type, failure.value, failure.getTracebackObject())
+        )
+
+    if config.event_json_compression:
+        d = store.queue_event_json_compression()
+        # The other background updates should run even if this one can't.
+        d.addErrback(log_queue_failure)
+    else:
+        d = defer.succeed(None)
+    d.addCallback(lambda _: store.start_doing_background_updates())
     hs.get_replication_layer().start_get_pdu_cache()
 
     return hs
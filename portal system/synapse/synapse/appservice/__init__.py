@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from synapse.api.constants import EventTypes
+from synapse.util.caches.lrucache import LruCache
 
 import logging
 import re
@@ -224,3 +225,135 @@ class ApplicationService(object):
 
     def __str__(self):
         return "ApplicationService: %s" % (self.__dict__,)
+
+
+class ApplicationServiceInterestIndex(object):
+    """Finds the application services interested in an event without running
+    every service's namespace regexes against it.
+
+    The regexes of each namespace kind are combined across all the services
+    into a single alternation, so a user ID, alias or room ID that no service
+    cares about (by far the most common case) is rejected with a single match.
+    Strings which do match are checked against the individual services, and
+    the resulting set of services is cached since the same users, rooms and
+    aliases come up over and over again.
+
+    Args:
+        services (list<ApplicationService>): The services to index. Their
+            namespaces must not change once they have been indexed.
+        max_entries (int): The number of strings of each namespace kind to
+            cache the interested services for.
+    """
+
+    def __init__(self, services, max_entries=10000):
+        self.services = list(services)
+        self._senders = set(s.sender for s in self.services if s.sender)
+        self._prefilters = {}
+        self._caches = {}
+
+        for ns in ApplicationService.NS_LIST:
+            self._prefilters[ns] = self._combine_regexes([
+                regex_obj["regex"]
+                for service in self.services
+                for regex_obj in service.namespaces[ns]
+            ])
+            self._caches[ns] = LruCache(max_entries)
+
+    @staticmethod
+    def _combine_regexes(regexes):
+        if not regexes:
+            return None
+        try:
+            return re.compile("|".join("(?:%s)" % (r,) for r in regexes))
+        except re.error:
+            # Some regexes can't be combined, e.g. ones using numbered
+            # backreferences, so fall back to checking each service.
+            logger.warn("Unable to combine application service regexes")
+            return re.compile("")
+
+    def _get_services(self, ns, test_string, is_interested):
+        if not isinstance(test_string, basestring):
+            logger.error(
+                "Expected a string to test regex against, but got %s",
+                test_string
+            )
+            return frozenset()
+
+        prefilter = self._prefilters[ns]
+        if prefilter is None or not prefilter.match(test_string):
+            if ns != ApplicationService.NS_USERS:
+                return frozenset()
+            if test_string not in self._senders:
+                return frozenset()
+
+        cache = self._caches[ns]
+        services = cache.get(test_string)
+        if services is None:
+            services = frozenset(
+                s for s in self.services if is_interested(s, test_string)
+            )
+            cache[test_string] = services
+        return services
+
+    def get_services_for_user(self, user_id):
+        """Returns the set of services interested in the given user ID."""
+        return self._get_services(
+            ApplicationService.NS_USERS, user_id,
+            ApplicationService.is_interested_in_user,
+        )
+
+    def get_services_for_alias(self, alias):
+        """Returns the set of services interested in the given room alias."""
+        return self._get_services(
+            ApplicationService.NS_ALIASES, alias,
+            ApplicationService.is_interested_in_alias,
+        )
+
+    def get_services_for_room(self, room_id):
+        """Returns the set of services interested in the given room ID."""
+        return self._get_services(
+            ApplicationService.NS_ROOMS, room_id,
+            ApplicationService.is_interested_in_room,
+        )
+
+    def get_interested_services(self, event, restrict_to=None,
+                                aliases_for_event=None, member_list=None):
+        """Get the services interested in an event. This matches what
+        `ApplicationService.is_interested` would return for each service.
+
+        Args:
+            event(Event): The event to check. Can be None if restricting to
+            aliases.
+            restrict_to(str): The namespace to restrict regex tests to.
+            aliases_for_event(list): A list of all the known room aliases for
+            this event.
+            member_list(list): A list of all joined user_ids in this room.
+        Returns:
+            list<ApplicationService>: The interested services, in the order
+            they were given to the index.
+        """
+        if restrict_to and restrict_to not in ApplicationService.NS_LIST:
+            raise Exception("Unexpected restrict_to value: %s" % restrict_to)
+
+        interested = set()
+
+        if not restrict_to or restrict_to == ApplicationService.NS_USERS:
+            if hasattr(event, "sender"):
+                interested |= self.get_services_for_user(event.sender)
+            if (hasattr(event, "type") and event.type == EventTypes.Member
+                    and hasattr(event, "state_key")):
+                interested |= self.get_services_for_user(event.state_key)
+            for user_id in member_list or []:
+                if len(interested) == len(self.services):
+                    break
+                interested |= self.get_services_for_user(user_id)
+
+        if not restrict_to or restrict_to == ApplicationService.NS_ALIASES:
+            for alias in aliases_for_event or []:
+                interested |= self.get_services_for_alias(alias)
+
+        if not restrict_to or restrict_to == ApplicationService.NS_ROOMS:
+            if hasattr(event, "room_id"):
+                interested |= self.get_services_for_room(event.room_id)
+
+        return [s for s in self.services if s in interested]
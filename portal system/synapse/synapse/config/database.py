@@ -23,6 +23,15 @@ class DatabaseConfig(Config):
             config.get("event_cache_size", "10K")
         )
 
+        self.pagination_read_ahead = config.get("pagination_read_ahead", False)
+        self.pagination_read_ahead_events = config.get(
+            "pagination_read_ahead_events", True
+        )
+
+        self.event_json_compression = config.get(
+            "event_json_compression", False
+        )
+
         self.database_config = config.get("database")
 
         if self.database_config is None:
@@ -59,6 +68,18 @@ class DatabaseConfig(Config):
 
         # Number of events to cache in memory.
         event_cache_size: "10K"
+
+        # Whether to fetch the next page of events in the background when a
+        # client paginates backwards through a room.
+        pagination_read_ahead: False
+
+        # Whether the pagination read-ahead should also pull the events into
+        # the event cache, rather than just their IDs.
+        pagination_read_ahead_events: True
+
+        # Whether to store new events' JSON compressed. Turning this on also
+        # compresses existing events in the background.
+        event_json_compression: False
         """ % locals()
 
     def read_arguments(self, args):
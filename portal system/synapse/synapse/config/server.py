@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from ._base import Config
+from ._base import Config, ConfigError
 
 
 class ServerConfig(Config):
@@ -28,6 +28,10 @@ class ServerConfig(Config):
         self.print_pidfile = config.get("print_pidfile")
         self.user_agent_suffix = config.get("user_agent_suffix")
         self.use_frozen_dicts = config.get("use_frozen_dicts", True)
+        self.sync_room_concurrency = config.get("sync_room_concurrency", 10)
+        if self.sync_room_concurrency < 1:
+            raise ConfigError("sync_room_concurrency must be at least 1")
+        self.sync_snapshots = config.get("sync_snapshots", False)
 
         self.listeners = config.get("listeners", [])
 
@@ -141,6 +145,16 @@ class ServerConfig(Config):
         # Whether to serve a web client from the HTTP/HTTPS root resource.
         web_client: True
 
+        # The number of rooms to work on at once when computing a /sync. This
+        # should be kept below the size of the database connection pool.
+        sync_room_concurrency: 10
+
+        # Whether to store a snapshot of each user's initial /sync, so that
+        # later initial syncs only need to recompute the rooms which have
+        # changed since. Snapshots which haven't been replaced for a week are
+        # deleted.
+        sync_snapshots: False
+
         # Set the soft limit on the number of file descriptors synapse can use
         # Zero is used to indicate synapse should set the soft limit to the
         # hard limit.
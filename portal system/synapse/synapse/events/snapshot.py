@@ -15,6 +15,11 @@
 
 
 class EventContext(object):
+    """
+    Attributes:
+        current_state (StateMap): The state of the room before the event. This
+            is usually shared with the state caches, so is immutable.
+    """
 
     def __init__(self, current_state=None):
         self.current_state = current_state
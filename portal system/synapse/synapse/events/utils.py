@@ -14,8 +14,34 @@
 # limitations under the License.
 
 from synapse.api.constants import EventTypes
+from synapse.util.caches.descriptors import Cache
 from . import EventBase
 
+from canonicaljson import encode_canonical_json
+from simplejson import RawJSON
+
+
+class EncodedEventJSON(RawJSON):
+    """A pre-encoded event, which simplejson (and so canonicaljson) embeds
+    verbatim. ujson does the same with anything that has a `__json__` method,
+    rather than encoding the object's attributes.
+    """
+
+    def __json__(self):
+        return self.encoded_json
+
+
+# The number of client formatted events we keep pre-encoded JSON for.
+SERIALIZED_EVENT_CACHE_SIZE = 10000
+
+# Maps (event_id, event_format) to a tuple of the event the entry was built
+# from and its encoded client JSON, minus the fields that differ between
+# requests (`age` and `transaction_id`).
+_serialized_event_cache = Cache(
+    "serialized_event_cache", keylen=2, lru=True,
+    max_entries=SERIALIZED_EVENT_CACHE_SIZE,
+)
+
 
 def prune_event(event):
     """ Returns a pruned version of the given event, which removes all keys we
@@ -167,3 +193,97 @@ def serialize_event(e, time_now_ms, as_client_event=True,
         return event_format(d)
     else:
         return d
+
+
+def _encode_static_event(e, event_format):
+    """Applies the event_format to the event and encodes everything that
+    doesn't depend on the request.
+
+    Returns:
+        tuple: (body, unsigned, top_level_age), where body is the JSON
+        encoding of the formatted event without "unsigned" and "age", unsigned
+        is the formatted "unsigned" dict minus per-request fields (or None if
+        the format drops it) and top_level_age is whether the format wants
+        "age" at the top level of the event.
+    """
+    d = {k: v for k, v in e.get_dict().items()}
+
+    # Add a placeholder age so that we can tell where the format puts it.
+    if "age_ts" in d["unsigned"]:
+        d["unsigned"]["age"] = 0
+        del d["unsigned"]["age_ts"]
+
+    d = event_format(d)
+
+    top_level_age = d.pop("age", None) is not None
+
+    unsigned = d.pop("unsigned", None)
+    if unsigned is not None:
+        unsigned.pop("age", None)
+        unsigned.pop("transaction_id", None)
+
+    return encode_canonical_json(d).decode("UTF-8"), unsigned, top_level_age
+
+
+def serialize_event_to_json(e, time_now_ms,
+                            event_format=format_event_for_client_v1,
+                            token_id=None):
+    """Like `serialize_event` with `as_client_event=True`, except that the
+    result is pre-encoded JSON that can be embedded in a response.
+
+    The request independent part of the encoding is cached per (event_id,
+    event_format), so popular events only get formatted and encoded once.
+    The `age` and `transaction_id` fields are spliced in on every call.
+
+    Returns:
+        EncodedEventJSON
+    """
+    if not isinstance(e, EventBase):
+        return e
+
+    if "redacted_because" in e.unsigned:
+        # The redaction event has its own age, so don't bother caching these.
+        return serialize_event(
+            e, time_now_ms, event_format=event_format, token_id=token_id,
+        )
+
+    key = (e.event_id, event_format)
+    entry = _serialized_event_cache.get(key, None)
+    if entry is None or entry[0] is not e:
+        # A different event object with the same ID may have been redacted,
+        # or fetched with different unsigned data, so we check identity.
+        entry = (e,) + _encode_static_event(e, event_format)
+        _serialized_event_cache.prefill(key, entry)
+
+    _, body, static_unsigned, top_level_age = entry
+
+    age = None
+    if "age_ts" in e.unsigned:
+        age = int(time_now_ms) - e.unsigned["age_ts"]
+
+    fields = []
+    if top_level_age and age is not None:
+        fields.append('"age":%d' % (age,))
+
+    if static_unsigned is not None:
+        unsigned = dict(static_unsigned)
+        if age is not None:
+            unsigned["age"] = age
+
+        if token_id is not None:
+            if token_id == getattr(e.internal_metadata, "token_id", None):
+                txn_id = getattr(e.internal_metadata, "txn_id", None)
+                if txn_id is not None:
+                    unsigned["transaction_id"] = txn_id
+
+        fields.append(
+            u'"unsigned":' + encode_canonical_json(unsigned).decode("UTF-8")
+        )
+
+    if not fields:
+        return EncodedEventJSON(body)
+
+    if body == u"{}":
+        return EncodedEventJSON(u"{" + u",".join(fields) + u"}")
+
+    return EncodedEventJSON(u"{" + u",".join(fields) + u"," + body[1:])
@@ -78,16 +78,36 @@ class BaseHandler(object):
 
             return True
 
-        event_id_to_state = yield self.store.get_state_for_events(
-            frozenset(e.event_id for e in events),
-            types=(
-                (EventTypes.RoomHistoryVisibility, ""),
-                (EventTypes.Member, user_id),
+        visible_event_ids = set()
+        events_by_room = {}
+        for event in events:
+            events_by_room.setdefault(event.room_id, []).append(event)
+
+        for room_id, room_events in events_by_room.items():
+            visible = yield self._get_events_visible_from_history(
+                room_id, room_events, is_guest,
+            )
+            visible_event_ids.update(visible)
+
+        event_id_to_state = {}
+        if len(visible_event_ids) < len(events):
+            event_id_to_state = yield self.store.get_state_for_events(
+                frozenset(
+                    e.event_id for e in events
+                    if e.event_id not in visible_event_ids
+                ),
+                types=(
+                    (EventTypes.RoomHistoryVisibility, ""),
+                    (EventTypes.Member, user_id),
+                )
             )
-        )
 
         events_to_return = []
         for event in events:
+            if event.event_id in visible_event_ids:
+                events_to_return.append(event)
+                continue
+
             state = event_id_to_state[event.event_id]
 
             membership_event = state.get((EventTypes.Member, user_id), None)
@@ -119,6 +139,33 @@ class BaseHandler(object):
 
         defer.returnValue(events_to_return)
 
+    @defer.inlineCallbacks
+    def _get_events_visible_from_history(self, room_id, events, is_guest):
+        """Find the events in a room which are visible to the user whatever
+        the state at each event, so that we can skip looking it up.
+
+        Membership and history visibility can differ between forks of the
+        room, so we can't tell them from where the events sit in the stream.
+        But the state at an event can only hold a visibility the room has had
+        at some point, so if that has only ever been "shared" or
+        "world_readable", a (non-guest) user can see every event in it.
+
+        Returns:
+            Deferred: Results in a set of event IDs.
+        """
+        if is_guest:
+            # Guests can only see world readable history, and whether an event
+            # has it depends on the state at the event.
+            defer.returnValue(set())
+
+        visibilities = yield self.store.get_history_visibilities_for_room(
+            room_id
+        )
+        if not visibilities.issubset(("shared", "world_readable")):
+            defer.returnValue(set())
+
+        defer.returnValue(set(event.event_id for event in events))
+
     def ratelimit(self, user_id):
         time_now = self.clock.time()
         allowed, time_allowed = self.ratelimiter.send_message(
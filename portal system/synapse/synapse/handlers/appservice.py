@@ -16,7 +16,9 @@
 from twisted.internet import defer
 
 from synapse.api.constants import EventTypes
-from synapse.appservice import ApplicationService
+from synapse.appservice import (
+    ApplicationService, ApplicationServiceInterestIndex,
+)
 from synapse.types import UserID
 
 import logging
@@ -47,6 +49,16 @@ class ApplicationServicesHandler(object):
         self.scheduler = appservice_scheduler
         self.started_scheduler = False
 
+        self._interest_index = ApplicationServiceInterestIndex([])
+
+    def _get_interest_index(self, services):
+        """Returns an ApplicationServiceInterestIndex for the given services,
+        reusing the last one if the services haven't changed.
+        """
+        if self._interest_index.services != list(services):
+            self._interest_index = ApplicationServiceInterestIndex(services)
+        return self._interest_index
+
     @defer.inlineCallbacks
     def notify_interested_services(self, event):
         """Notifies (pushes) all application services interested in this event.
@@ -150,21 +162,17 @@ class ApplicationServicesHandler(object):
             member_list = yield self.store.get_users_in_room(event.room_id)
 
         services = yield self.store.get_app_services()
-        interested_list = [
-            s for s in services if (
-                s.is_interested(event, restrict_to, alias_list, member_list)
-            )
-        ]
+        interested_list = self._get_interest_index(
+            services
+        ).get_interested_services(event, restrict_to, alias_list, member_list)
         defer.returnValue(interested_list)
 
     @defer.inlineCallbacks
     def _get_services_for_user(self, user_id):
         services = yield self.store.get_app_services()
-        interested_list = [
-            s for s in services if (
-                s.is_interested_in_user(user_id)
-            )
-        ]
+        index = self._get_interest_index(services)
+        interested = index.get_services_for_user(user_id)
+        interested_list = [s for s in index.services if s in interested]
         defer.returnValue(interested_list)
 
     @defer.inlineCallbacks
@@ -26,7 +26,9 @@ from synapse.util import unwrapFirstError
 from synapse.util.logcontext import PreserveLoggingContext
 from synapse.util.logutils import log_function
 from synapse.util.async import run_on_reactor
+from synapse.util.caches.descriptors import Cache
 from synapse.util.frozenutils import unfreeze
+from synapse.util.statemap import StateMap
 from synapse.crypto.event_signing import (
     compute_event_signature, add_hashes_and_signatures,
 )
@@ -44,6 +46,9 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+SERVER_VISIBILITY_CACHE_SIZE = 10000
+
+
 class FederationHandler(BaseHandler):
     """Handles events that originated from federation.
         Responsible for:
@@ -78,6 +83,13 @@ class FederationHandler(BaseHandler):
         # When joining a room we need to queue any events for that room up
         self.room_queues = {}
 
+        # Who can see the events in each state group, keyed by room and
+        # state group. See `_filter_events_for_server`.
+        self._server_visibility_cache = Cache(
+            "server_visibility", max_entries=SERVER_VISIBILITY_CACHE_SIZE,
+            keylen=2,
+        )
+
     def handle_new_event(self, event, destinations):
         """ Takes in an event from the client to server side, that has already
         been authed and handled by the state module, and sends it to any
@@ -240,52 +252,119 @@ class FederationHandler(BaseHandler):
 
     @defer.inlineCallbacks
     def _filter_events_for_server(self, server_name, room_id, events):
-        event_to_state = yield self.store.get_state_for_events(
-            frozenset(e.event_id for e in events),
-            types=(
-                (EventTypes.RoomHistoryVisibility, ""),
-                (EventTypes.Member, None),
-            )
+        """Redact the events that the given server isn't allowed to see.
+
+        Whether an event is visible depends only on the state at it, so this
+        is worked out once per state group in the batch rather than once per
+        event. The history visibility and the servers with joined and invited
+        members at each state group are cached, so later requests (including
+        those from other servers) only need a set lookup per state group.
+        """
+        event_to_group = yield self.store.get_state_group_for_events(
+            [e.event_id for e in events]
         )
 
-        def redact_disallowed(event, state):
-            if not state:
+        summaries = {}
+        missing = {}
+        for event in events:
+            group = event_to_group.get(event.event_id)
+            if group is None or group in summaries or group in missing:
+                continue
+
+            summary = self._server_visibility_cache.get((room_id, group), None)
+            if summary is None:
+                missing[group] = event.event_id
+            else:
+                summaries[group] = summary
+
+        if missing:
+            fetched = yield self._get_server_visibility_for_groups(missing)
+            for group, summary in fetched.items():
+                self._server_visibility_cache.prefill((room_id, group), summary)
+            summaries.update(fetched)
+
+        def redact_disallowed(event):
+            summary = summaries.get(event_to_group.get(event.event_id))
+            if summary is None:
                 return event
 
-            history = state.get((EventTypes.RoomHistoryVisibility, ''), None)
+            visibility, joined_servers, invited_servers = summary
+            if visibility not in ["invited", "joined"]:
+                return event
+            if server_name in joined_servers:
+                return event
+            if visibility == "invited" and server_name in invited_servers:
+                return event
+
+            return prune_event(event)
+
+        defer.returnValue([redact_disallowed(e) for e in events])
+
+    @defer.inlineCallbacks
+    def _get_server_visibility_for_groups(self, group_to_event_id):
+        """Work out who can see the events in each of the given state groups.
+
+        Args:
+            group_to_event_id (dict): Map from state group to the id of an
+                event in that group.
+        Returns:
+            Deferred: Results in a map from state group to a tuple of the
+            history visibility and the frozensets of servers with joined and
+            with invited members. The servers are only filled in if the
+            visibility depends on them.
+        """
+        event_to_state = yield self.store.get_state_for_events(
+            group_to_event_id.values(),
+            types=((EventTypes.RoomHistoryVisibility, ""),),
+        )
+
+        visibilities = {}
+        for group, event_id in group_to_event_id.items():
+            history = event_to_state[event_id].get(
+                (EventTypes.RoomHistoryVisibility, ""), None
+            )
             if history:
                 visibility = history.content.get("history_visibility", "shared")
-                if visibility in ["invited", "joined"]:
-                    # We now loop through all state events looking for
-                    # membership states for the requesting server to determine
-                    # if the server is either in the room or has been invited
-                    # into the room.
-                    for ev in state.values():
-                        if ev.type != EventTypes.Member:
-                            continue
-                        try:
-                            domain = UserID.from_string(ev.state_key).domain
-                        except:
-                            continue
+            else:
+                visibility = "shared"
+            visibilities[group] = visibility
+
+        # Only load the membership of the groups where it matters, since that
+        # may be large.
+        restricted = {
+            group: event_id
+            for group, event_id in group_to_event_id.items()
+            if visibilities[group] in ["invited", "joined"]
+        }
+        event_to_members = {}
+        if restricted:
+            event_to_members = yield self.store.get_state_for_events(
+                restricted.values(),
+                types=((EventTypes.Member, None),),
+            )
 
-                        if domain != server_name:
-                            continue
+        results = {}
+        for group, event_id in group_to_event_id.items():
+            joined_servers = set()
+            invited_servers = set()
+            for ev in event_to_members.get(event_id, {}).values():
+                try:
+                    domain = UserID.from_string(ev.state_key).domain
+                except:
+                    continue
 
-                        memtype = ev.membership
-                        if memtype == Membership.JOIN:
-                            return event
-                        elif memtype == Membership.INVITE:
-                            if visibility == "invited":
-                                return event
-                    else:
-                        return prune_event(event)
+                if ev.membership == Membership.JOIN:
+                    joined_servers.add(domain)
+                elif ev.membership == Membership.INVITE:
+                    invited_servers.add(domain)
 
-            return event
+            results[group] = (
+                visibilities[group],
+                frozenset(joined_servers),
+                frozenset(invited_servers),
+            )
 
-        defer.returnValue([
-            redact_disallowed(e, event_to_state[e.event_id])
-            for e in events
-        ])
+        defer.returnValue(results)
 
     @log_function
     @defer.inlineCallbacks
@@ -1215,8 +1294,11 @@ class FederationHandler(BaseHandler):
             event, old_state=state, outlier=outlier,
         )
 
-        if not auth_events:
-            auth_events = context.current_state
+        # do_auth updates the auth events in place, and if they are the state
+        # of the context then those updates belong in the context too.
+        auth_events_from_context = not auth_events
+        if auth_events_from_context:
+            auth_events = dict(context.current_state)
 
         # This is a hack to fix some old rooms where the initial join event
         # didn't reference the create event in its auth events.
@@ -1241,6 +1323,9 @@ class FederationHandler(BaseHandler):
 
             context.rejected = RejectedReason.AUTH_ERROR
 
+        if auth_events_from_context:
+            context.current_state = StateMap(auth_events)
+
         if event.type == EventTypes.GuestAccess:
             full_context = yield self.store.get_current_state(room_id=event.room_id)
             yield self.maybe_kick_guest_users(event, full_context)
@@ -1302,6 +1387,10 @@ class FederationHandler(BaseHandler):
             min_depth=min_depth,
         )
 
+        missing_events = yield self._filter_events_for_server(
+            origin, room_id, missing_events,
+        )
+
         defer.returnValue(missing_events)
 
     @defer.inlineCallbacks
@@ -1414,7 +1503,9 @@ class FederationHandler(BaseHandler):
                 current_state = set(e.event_id for e in auth_events.values())
                 different_auth = event_auth_events - current_state
 
-                context.current_state.update(auth_events)
+                context.current_state = context.current_state.set_many(
+                    auth_events
+                )
                 context.state_group = None
 
         if different_auth and not event.internal_metadata.is_outlier():
@@ -1493,7 +1584,9 @@ class FederationHandler(BaseHandler):
                 # 4. Look at rejects and their proofs.
                 # TODO.
 
-                context.current_state.update(auth_events)
+                context.current_state = context.current_state.set_many(
+                    auth_events
+                )
                 context.state_group = None
 
         try:
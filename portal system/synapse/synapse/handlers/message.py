@@ -18,7 +18,7 @@ from twisted.internet import defer
 from synapse.api.constants import EventTypes, Membership
 from synapse.api.errors import SynapseError, AuthError, Codes
 from synapse.streams.config import PaginationConfig
-from synapse.events.utils import serialize_event
+from synapse.events.utils import serialize_event, serialize_event_to_json
 from synapse.events.validator import EventValidator
 from synapse.util import unwrapFirstError
 from synapse.util.logcontext import PreserveLoggingContext
@@ -154,11 +154,13 @@ class MessageHandler(BaseHandler):
 
         time_now = self.clock.time_msec()
 
+        if as_client_event:
+            serialized = [serialize_event_to_json(e, time_now) for e in events]
+        else:
+            serialized = [serialize_event(e, time_now, False) for e in events]
+
         chunk = {
-            "chunk": [
-                serialize_event(e, time_now, as_client_event)
-                for e in events
-            ],
+            "chunk": serialized,
             "start": pagin_config.from_token.to_string(),
             "end": next_token.to_string(),
         }
@@ -314,7 +316,8 @@ class MessageHandler(BaseHandler):
 
     @defer.inlineCallbacks
     def snapshot_all_rooms(self, user_id=None, pagin_config=None,
-                           as_client_event=True, include_archived=False):
+                           as_client_event=True, include_archived=False,
+                           lazy_load_members=False):
         """Retrieve a snapshot of all rooms the user is invited or has joined.
 
         This snapshot may include messages for all rooms where the user is
@@ -326,6 +329,9 @@ class MessageHandler(BaseHandler):
             config used to determine how many messages *PER ROOM* to return.
             as_client_event (bool): True to get events in client-server format.
             include_archived (bool): True to get rooms that the user has left
+            lazy_load_members (bool): True to only include the membership
+            events of the user and of the senders of the returned messages in
+            the state of each room, rather than of every member.
         Returns:
             A list of dicts with "room_id" and "membership" keys for all rooms
             the user is currently invited or joined in on. Rooms where the user
@@ -418,6 +424,20 @@ class MessageHandler(BaseHandler):
                     user_id, messages
                 )
 
+                if lazy_load_members:
+                    wanted_members = set([user_id])
+                    for m in messages:
+                        wanted_members.add(m.sender)
+                        if m.type == EventTypes.Member:
+                            wanted_members.add(m.state_key)
+
+                    current_state = {
+                        key: state_event
+                        for key, state_event in current_state.items()
+                        if key[0] != EventTypes.Member
+                        or key[1] in wanted_members
+                    }
+
                 start_token = now_token.copy_and_replace("room_key", token[0])
                 end_token = now_token.copy_and_replace("room_key", token[1])
                 time_now = self.clock.time_msec()
@@ -17,18 +17,44 @@ from ._base import BaseHandler
 
 from synapse.streams.config import PaginationConfig
 from synapse.api.constants import Membership, EventTypes
+from synapse.types import StreamToken
+from synapse.util.async import concurrently_execute
+from synapse.util.caches.descriptors import Cache
+from synapse.util.caches.response_cache import ResponseCache
 
+from canonicaljson import encode_canonical_json
 from twisted.internet import defer
 
 import collections
+import hashlib
+import itertools
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+# How long to keep the result of a /sync after it completes, so that a client
+# which retries straight away doesn't make us compute it again.
+SYNC_RESPONSE_CACHE_MS = 2 * 1000
+
+
+# The number of (user, access token, room) entries to remember the members
+# sent to lazy-loading clients for.
+LAZY_LOADED_MEMBERS_CACHE_SIZE = 100000
+
+
+# Sync snapshots that haven't been replaced by an initial sync for this long
+# are deleted, so that the table doesn't grow with every user and filter ever
+# seen.
+SYNC_SNAPSHOT_MAX_AGE_MS = 7 * 24 * 60 * 60 * 1000
+SYNC_SNAPSHOT_PRUNE_INTERVAL_MS = 60 * 60 * 1000
+
+
 SyncConfig = collections.namedtuple("SyncConfig", [
     "user",
     "filter",
+    "request_key",  # Identifies requests which will get the same response.
+    "token_id",  # The ID of the access token (and so device) syncing.
 ])
 
 
@@ -122,16 +148,51 @@ class SyncHandler(BaseHandler):
         super(SyncHandler, self).__init__(hs)
         self.event_sources = hs.get_event_sources()
         self.clock = hs.get_clock()
+        self.room_concurrency = hs.config.sync_room_concurrency
+        self.sync_snapshots = hs.config.sync_snapshots
+        self.response_cache = ResponseCache(
+            self.clock, timeout_ms=SYNC_RESPONSE_CACHE_MS,
+            # Don't keep empty results, or a client long-polling for new
+            # events would get them straight back until they expired.
+            keep_result=bool,
+        )
+
+        # The membership events we've sent to each client that is lazy
+        # loading members, keyed by (user_id, token_id, room_id). Each entry
+        # is a dict of member user_id to the event_id of the member event sent.
+        self.lazy_loaded_members_cache = Cache(
+            "lazy_loaded_members", max_entries=LAZY_LOADED_MEMBERS_CACHE_SIZE,
+            keylen=3,
+        )
+
+        self.clock.looping_call(
+            self._prune_sync_snapshots, SYNC_SNAPSHOT_PRUNE_INTERVAL_MS
+        )
 
-    @defer.inlineCallbacks
     def wait_for_sync_for_user(self, sync_config, since_token=None, timeout=0,
                                full_state=False):
         """Get the sync for a client if we have new data for it now. Otherwise
         wait for new data to arrive on the server. If the timeout expires, then
         return an empty sync result.
+
+        Requests with the same `sync_config.request_key` made while one is in
+        progress, or shortly after it completed, share its result.
         Returns:
             A Deferred SyncResult.
         """
+        result = self.response_cache.get(sync_config.request_key)
+        if result is None:
+            result = self.response_cache.set(
+                sync_config.request_key,
+                self._wait_for_sync_for_user(
+                    sync_config, since_token, timeout, full_state
+                )
+            )
+        return result
+
+    @defer.inlineCallbacks
+    def _wait_for_sync_for_user(self, sync_config, since_token, timeout,
+                                full_state):
 
         if timeout == 0 or since_token is None or full_state:
             # we are going to return immediately, so don't bother calling
@@ -199,39 +260,101 @@ class SyncHandler(BaseHandler):
             sync_config.user.to_string()
         )
 
-        joined = []
+        joined_events = [
+            e for e in room_list if e.membership == Membership.JOIN
+        ]
+        archived_events = [
+            e for e in room_list
+            if e.membership in (Membership.LEAVE, Membership.BAN)
+        ]
+
+        # Syncs that lazy load members depend on what that device has been
+        # sent before, so can't share a snapshot.
+        use_snapshot = (
+            self.sync_snapshots
+            and timeline_since_token is None
+            and not sync_config.filter.lazy_load_members()
+        )
+        snapshot_joined = {}
+        snapshot_archived = {}
+        if use_snapshot:
+            snapshot = yield self.load_sync_snapshot(
+                sync_config, joined_events, archived_events, now_token,
+            )
+            if snapshot is not None:
+                snapshot_joined, snapshot_archived = snapshot
+
+        recent_events_by_room = yield self.load_recent_events_for_rooms(
+            [
+                e.room_id for e in joined_events
+                if e.room_id not in snapshot_joined
+            ],
+            sync_config, now_token, since_token=timeline_since_token,
+        )
+
+        def sync_joined_room(event):
+            room_sync = snapshot_joined.get(event.room_id)
+            if room_sync is not None:
+                return defer.succeed(room_sync._replace(
+                    ephemeral=ephemeral_by_room.get(event.room_id, []),
+                    account_data=self.account_data_for_room(
+                        event.room_id, tags_by_room
+                    ),
+                ))
+
+            return self.full_state_sync_for_joined_room(
+                room_id=event.room_id,
+                sync_config=sync_config,
+                now_token=now_token,
+                timeline_since_token=timeline_since_token,
+                ephemeral_by_room=ephemeral_by_room,
+                tags_by_room=tags_by_room,
+                recent_events=recent_events_by_room.get(event.room_id),
+            )
+
+        def sync_archived_room(event):
+            room_sync = snapshot_archived.get(event.room_id)
+            if room_sync is not None:
+                return defer.succeed(room_sync._replace(
+                    account_data=self.account_data_for_room(
+                        event.room_id, tags_by_room
+                    ),
+                ))
+
+            leave_token = now_token.copy_and_replace(
+                "room_key", "s%d" % (event.stream_ordering,)
+            )
+            return self.full_state_sync_for_archived_room(
+                sync_config=sync_config,
+                room_id=event.room_id,
+                leave_event_id=event.event_id,
+                leave_token=leave_token,
+                timeline_since_token=timeline_since_token,
+                tags_by_room=tags_by_room,
+            )
+
+        joined = yield concurrently_execute(
+            sync_joined_room, joined_events, self.room_concurrency,
+        )
+
         invited = []
-        archived = []
         for event in room_list:
-            if event.membership == Membership.JOIN:
-                room_sync = yield self.full_state_sync_for_joined_room(
-                    room_id=event.room_id,
-                    sync_config=sync_config,
-                    now_token=now_token,
-                    timeline_since_token=timeline_since_token,
-                    ephemeral_by_room=ephemeral_by_room,
-                    tags_by_room=tags_by_room,
-                )
-                joined.append(room_sync)
-            elif event.membership == Membership.INVITE:
+            if event.membership == Membership.INVITE:
                 invite = yield self.store.get_event(event.event_id)
                 invited.append(InvitedSyncResult(
                     room_id=event.room_id,
                     invite=invite,
                 ))
-            elif event.membership in (Membership.LEAVE, Membership.BAN):
-                leave_token = now_token.copy_and_replace(
-                    "room_key", "s%d" % (event.stream_ordering,)
-                )
-                room_sync = yield self.full_state_sync_for_archived_room(
-                    sync_config=sync_config,
-                    room_id=event.room_id,
-                    leave_event_id=event.event_id,
-                    leave_token=leave_token,
-                    timeline_since_token=timeline_since_token,
-                    tags_by_room=tags_by_room,
-                )
-                archived.append(room_sync)
+
+        archived = yield concurrently_execute(
+            sync_archived_room, archived_events, self.room_concurrency,
+        )
+
+        reused = len(snapshot_joined) + len(snapshot_archived)
+        if use_snapshot and reused < len(joined) + len(archived):
+            yield self.store_sync_snapshot(
+                sync_config, now_token, joined, archived_events, archived,
+            )
 
         defer.returnValue(SyncResult(
             presence=presence,
@@ -241,21 +364,189 @@ class SyncHandler(BaseHandler):
             next_batch=now_token,
         ))
 
+    @defer.inlineCallbacks
+    def _prune_sync_snapshots(self):
+        try:
+            yield self.store.prune_sync_snapshots(SYNC_SNAPSHOT_MAX_AGE_MS)
+        except Exception:
+            logger.exception("Failed to prune sync snapshots")
+
+    @staticmethod
+    def _sync_snapshot_key(sync_config):
+        """Identifies the filter used for a sync, so that snapshots are only
+        shared between syncs which would return the same rooms.
+        """
+        return hashlib.sha256(
+            encode_canonical_json(sync_config.filter.filter_json)
+        ).hexdigest()
+
+    @defer.inlineCallbacks
+    def load_sync_snapshot(self, sync_config, joined_events, archived_events,
+                           now_token):
+        """Load the rooms from the user's latest initial sync snapshot that
+        haven't changed since it was taken, so that they don't have to be
+        synced again.
+
+        A joined room is unchanged if there have been no events in it since
+        the snapshot was taken. An archived room is unchanged if the user's
+        membership event in it is the one the snapshot was taken after.
+
+        :param list joined_events: the membership events of the rooms the user
+            is joined to
+        :param list archived_events: the membership events of the rooms the
+            user has left or been banned from
+        :param StreamToken now_token: where the server is currently up to
+        :returns a Deferred tuple of dicts of room_id to JoinedSyncResult and
+            to ArchivedSyncResult for the unchanged rooms, or None if there
+            isn't a snapshot. The results don't include any ephemeral events
+            or account data.
+        """
+        snapshot = yield self.store.get_sync_snapshot(
+            sync_config.user.to_string(), self._sync_snapshot_key(sync_config),
+        )
+        if snapshot is None:
+            defer.returnValue(None)
+
+        snapshot_token, snapshot = snapshot
+        snapshot_token = StreamToken.from_string(snapshot_token)
+
+        candidate_room_ids = [
+            e.room_id for e in joined_events if e.room_id in snapshot["joined"]
+        ]
+        changes_by_room = yield self.store.get_recent_events_for_rooms(
+            candidate_room_ids, limit=1,
+            from_token=snapshot_token.room_key,
+            end_token=now_token.room_key,
+        )
+
+        joined_entries = {
+            room_id: snapshot["joined"][room_id]
+            for room_id in candidate_room_ids
+            if not changes_by_room[room_id][0]
+        }
+        archived_entries = {}
+        for event in archived_events:
+            entry = snapshot["archived"].get(event.room_id)
+            if entry is not None and entry["leave_event_id"] == event.event_id:
+                archived_entries[event.room_id] = entry
+
+        entries = joined_entries.values() + archived_entries.values()
+        state_map = yield self.store.get_events(
+            [event_id for e in entries for event_id in e["state"]]
+        )
+        timeline_map = yield self.store.get_events(
+            [event_id for e in entries for event_id in e["timeline"]],
+            get_prev_content=True,
+        )
+
+        def decode(entry):
+            # The events may have been purged since the snapshot was taken, in
+            # which case the room has to be synced again.
+            if not all(event_id in state_map for event_id in entry["state"]):
+                return None, None
+            if not all(e_id in timeline_map for e_id in entry["timeline"]):
+                return None, None
+
+            state = {}
+            for event_id in entry["state"]:
+                event = state_map[event_id]
+                state[(event.type, event.state_key)] = event
+
+            timeline = TimelineBatch(
+                events=[timeline_map[e_id] for e_id in entry["timeline"]],
+                prev_batch=StreamToken.from_string(entry["prev_batch"]),
+                limited=entry["limited"],
+            )
+            return timeline, state
+
+        joined = {}
+        for room_id, entry in joined_entries.items():
+            timeline, state = decode(entry)
+            if timeline is not None:
+                joined[room_id] = JoinedSyncResult(
+                    room_id=room_id,
+                    timeline=timeline,
+                    state=state,
+                    ephemeral=[],
+                    account_data=[],
+                )
+
+        archived = {}
+        for room_id, entry in archived_entries.items():
+            timeline, state = decode(entry)
+            if timeline is not None:
+                archived[room_id] = ArchivedSyncResult(
+                    room_id=room_id,
+                    timeline=timeline,
+                    state=state,
+                    account_data=[],
+                )
+
+        defer.returnValue((joined, archived))
+
+    def store_sync_snapshot(self, sync_config, now_token, joined,
+                            archived_events, archived):
+        """Store a snapshot of the rooms from an initial sync, for later
+        initial syncs to start from.
+
+        :param StreamToken now_token: the token the sync was made at
+        :param list[JoinedSyncResult] joined: the joined rooms of the sync
+        :param list archived_events: the membership events of the archived
+            rooms, in the same order as `archived`
+        :param list[ArchivedSyncResult] archived: the archived rooms of the
+            sync
+        :returns a Deferred that completes once the snapshot is stored
+        """
+        def encode(room_sync):
+            return {
+                "timeline": [e.event_id for e in room_sync.timeline.events],
+                "prev_batch": room_sync.timeline.prev_batch.to_string(),
+                "limited": room_sync.timeline.limited,
+                "state": [e.event_id for e in room_sync.state.values()],
+            }
+
+        snapshot_archived = {}
+        for event, room_sync in zip(archived_events, archived):
+            entry = encode(room_sync)
+            entry["leave_event_id"] = event.event_id
+            snapshot_archived[room_sync.room_id] = entry
+
+        return self.store.store_sync_snapshot(
+            sync_config.user.to_string(),
+            self._sync_snapshot_key(sync_config),
+            now_token.to_string(),
+            {
+                "joined": {
+                    room_sync.room_id: encode(room_sync)
+                    for room_sync in joined
+                },
+                "archived": snapshot_archived,
+            },
+        )
+
     @defer.inlineCallbacks
     def full_state_sync_for_joined_room(self, room_id, sync_config,
                                         now_token, timeline_since_token,
-                                        ephemeral_by_room, tags_by_room):
+                                        ephemeral_by_room, tags_by_room,
+                                        recent_events=None):
         """Sync a room for a client which is starting without any state
         Returns:
             A Deferred JoinedSyncResult.
         """
 
         batch = yield self.load_filtered_recents(
-            room_id, sync_config, now_token, since_token=timeline_since_token
+            room_id, sync_config, now_token, since_token=timeline_since_token,
+            recent_events=recent_events,
         )
 
         current_state = yield self.get_state_at(room_id, now_token)
 
+        if sync_config.filter.lazy_load_members():
+            current_state = yield self.lazy_load_members(
+                sync_config, room_id, batch.events, current_state,
+                full_state=True,
+            )
+
         defer.returnValue(JoinedSyncResult(
             room_id=room_id,
             timeline=batch,
@@ -276,6 +567,16 @@ class SyncHandler(BaseHandler):
             })
         return account_data
 
+    @staticmethod
+    def _stream_advanced(key, since_token, now_token):
+        """Whether the stream with the given key in a StreamToken may have
+        moved on since the client last synced, or the client hasn't synced
+        before.
+        """
+        if since_token is None:
+            return True
+        return str(getattr(since_token, key)) != str(getattr(now_token, key))
+
     @defer.inlineCallbacks
     def ephemeral_by_room(self, sync_config, now_token, since_token=None):
         """Get the ephemeral events for each room the user is in
@@ -290,22 +591,34 @@ class SyncHandler(BaseHandler):
             typing events for that room.
         """
 
+        ephemeral_by_room = {}
+
+        typing_changed = self._stream_advanced(
+            "typing_key", since_token, now_token
+        )
+        receipts_changed = self._stream_advanced(
+            "receipt_key", since_token, now_token
+        )
+        if not typing_changed and not receipts_changed:
+            defer.returnValue((now_token, ephemeral_by_room))
+
         typing_key = since_token.typing_key if since_token else "0"
 
         rooms = yield self.store.get_rooms_for_user(sync_config.user.to_string())
         room_ids = [room.room_id for room in rooms]
 
-        typing_source = self.event_sources.sources["typing"]
-        typing, typing_key = yield typing_source.get_new_events(
-            user=sync_config.user,
-            from_key=typing_key,
-            limit=sync_config.filter.ephemeral_limit(),
-            room_ids=room_ids,
-            is_guest=False,
-        )
-        now_token = now_token.copy_and_replace("typing_key", typing_key)
-
-        ephemeral_by_room = {}
+        if typing_changed:
+            typing_source = self.event_sources.sources["typing"]
+            typing, typing_key = yield typing_source.get_new_events(
+                user=sync_config.user,
+                from_key=typing_key,
+                limit=sync_config.filter.ephemeral_limit(),
+                room_ids=room_ids,
+                is_guest=False,
+            )
+            now_token = now_token.copy_and_replace("typing_key", typing_key)
+        else:
+            typing = []
 
         for event in typing:
             # we want to exclude the room_id from the event, but modifying the
@@ -318,16 +631,20 @@ class SyncHandler(BaseHandler):
 
         receipt_key = since_token.receipt_key if since_token else "0"
 
-        receipt_source = self.event_sources.sources["receipt"]
-        receipts, receipt_key = yield receipt_source.get_new_events(
-            user=sync_config.user,
-            from_key=receipt_key,
-            limit=sync_config.filter.ephemeral_limit(),
-            room_ids=room_ids,
-            # /sync doesn't support guest access, they can't get to this point in code
-            is_guest=False,
-        )
-        now_token = now_token.copy_and_replace("receipt_key", receipt_key)
+        if receipts_changed:
+            receipt_source = self.event_sources.sources["receipt"]
+            receipts, receipt_key = yield receipt_source.get_new_events(
+                user=sync_config.user,
+                from_key=receipt_key,
+                limit=sync_config.filter.ephemeral_limit(),
+                room_ids=room_ids,
+                # /sync doesn't support guest access, they can't get to this
+                # point in code
+                is_guest=False,
+            )
+            now_token = now_token.copy_and_replace("receipt_key", receipt_key)
+        else:
+            receipts = []
 
         for event in receipts:
             room_id = event["room_id"]
@@ -370,20 +687,26 @@ class SyncHandler(BaseHandler):
             A Deferred SyncResult.
         """
         now_token = yield self.event_sources.get_current_token()
-
-        rooms = yield self.store.get_rooms_for_user(sync_config.user.to_string())
-        room_ids = [room.room_id for room in rooms]
-
-        presence_source = self.event_sources.sources["presence"]
-        presence, presence_key = yield presence_source.get_new_events(
-            user=sync_config.user,
-            from_key=since_token.presence_key,
-            limit=sync_config.filter.presence_limit(),
-            room_ids=room_ids,
-            # /sync doesn't support guest access, they can't get to this point in code
-            is_guest=False,
-        )
-        now_token = now_token.copy_and_replace("presence_key", presence_key)
+        user_id = sync_config.user.to_string()
+
+        # We only look at the streams which have moved on since the last
+        # sync, and only at the rooms which have changed in them, so that a
+        # sync woken up by a single event does a single event's worth of work.
+        if self._stream_advanced("presence_key", since_token, now_token):
+            rooms = yield self.store.get_rooms_for_user(user_id)
+            presence_source = self.event_sources.sources["presence"]
+            presence, presence_key = yield presence_source.get_new_events(
+                user=sync_config.user,
+                from_key=since_token.presence_key,
+                limit=sync_config.filter.presence_limit(),
+                room_ids=[room.room_id for room in rooms],
+                # /sync doesn't support guest access, they can't get to this
+                # point in code
+                is_guest=False,
+            )
+            now_token = now_token.copy_and_replace("presence_key", presence_key)
+        else:
+            presence = []
 
         now_token, ephemeral_by_room = yield self.ephemeral_by_room(
             sync_config, now_token, since_token
@@ -403,20 +726,39 @@ class SyncHandler(BaseHandler):
 
         timeline_limit = sync_config.filter.timeline_limit()
 
-        room_events, _ = yield self.store.get_room_events_stream(
-            sync_config.user.to_string(),
-            from_key=since_token.room_key,
-            to_key=now_token.room_key,
-            limit=timeline_limit + 1,
+        changed_room_ids = yield self.store.get_rooms_with_new_events(
+            joined_room_ids, since_token.room_key,
         )
-
-        tags_by_room = yield self.store.get_updated_tags(
-            sync_config.user.to_string(),
-            since_token.account_data_key,
+        membership_changed = yield self.store.has_membership_changed_for_user(
+            user_id, since_token.room_key,
         )
 
+        if changed_room_ids or membership_changed:
+            room_events, _ = yield self.store.get_room_events_stream(
+                user_id,
+                from_key=since_token.room_key,
+                to_key=now_token.room_key,
+                limit=timeline_limit + 1,
+                room_ids=changed_room_ids,
+            )
+        else:
+            room_events = []
+
+        if self._stream_advanced("account_data_key", since_token, now_token):
+            tags_by_room = yield self.store.get_updated_tags(
+                user_id, since_token.account_data_key,
+            )
+        else:
+            tags_by_room = {}
+
+        # Rooms without new events only need to be sent if they have new
+        # ephemeral events or account data.
+        quiet_room_ids = set(ephemeral_by_room.keys())
+        quiet_room_ids.update(tags_by_room.keys())
+        quiet_room_ids.intersection_update(joined_room_ids)
+        quiet_room_ids.difference_update(changed_room_ids)
+
         joined = []
-        archived = []
         if len(room_events) <= timeline_limit:
             # There is no gap in any of the rooms. Therefore we can just
             # partition the new events by room and return them.
@@ -436,7 +778,10 @@ class SyncHandler(BaseHandler):
                         elif event.membership in (Membership.LEAVE, Membership.BAN):
                             leave_events.append(event)
 
-            for room_id in joined_room_ids:
+            for room_id in quiet_room_ids.union(events_by_room_id.keys()):
+                if room_id not in joined_room_ids:
+                    continue
+
                 recents = events_by_room_id.get(room_id, [])
                 logger.debug("Events for room %s: %r", room_id, recents)
                 state = {
@@ -459,6 +804,12 @@ class SyncHandler(BaseHandler):
                     # the timeline is inherently limited if we've just joined
                     limited = True
 
+                if sync_config.filter.lazy_load_members():
+                    state = yield self.lazy_load_members(
+                        sync_config, room_id, recents, state,
+                        full_state=just_joined,
+                    )
+
                 room_sync = JoinedSyncResult(
                     room_id=room_id,
                     timeline=TimelineBatch(
@@ -481,27 +832,53 @@ class SyncHandler(BaseHandler):
             logger.debug("Got %i events for incremental sync - hit limit",
                          len(room_events))
 
-            invite_events = yield self.store.get_invites_for_user(
-                sync_config.user.to_string()
-            )
+            if membership_changed:
+                invite_events = yield self.store.get_invites_for_user(user_id)
+                leave_events = (
+                    yield self.store.get_leave_and_ban_events_for_user(user_id)
+                )
+            else:
+                invite_events = []
+                leave_events = []
 
-            leave_events = yield self.store.get_leave_and_ban_events_for_user(
-                sync_config.user.to_string()
+            changed_room_ids = list(changed_room_ids)
+            recent_events_by_room = yield self.load_recent_events_for_rooms(
+                changed_room_ids, sync_config, now_token, since_token,
             )
 
-            for room_id in joined_room_ids:
-                room_sync = yield self.incremental_sync_with_gap_for_room(
+            def sync_room(room_id):
+                return self.incremental_sync_with_gap_for_room(
                     room_id, sync_config, since_token, now_token,
-                    ephemeral_by_room, tags_by_room
+                    ephemeral_by_room, tags_by_room,
+                    recent_events=recent_events_by_room.get(room_id),
                 )
-                if room_sync:
-                    joined.append(room_sync)
 
-        for leave_event in leave_events:
-            room_sync = yield self.incremental_sync_for_archived_room(
+            room_syncs = yield concurrently_execute(
+                sync_room, changed_room_ids, self.room_concurrency,
+            )
+            joined.extend(room_sync for room_sync in room_syncs if room_sync)
+
+            for room_id in quiet_room_ids:
+                joined.append(JoinedSyncResult(
+                    room_id=room_id,
+                    timeline=TimelineBatch(
+                        events=[], prev_batch=now_token, limited=False,
+                    ),
+                    state={},
+                    ephemeral=ephemeral_by_room.get(room_id, []),
+                    account_data=self.account_data_for_room(
+                        room_id, tags_by_room
+                    ),
+                ))
+
+        def sync_archived_room(leave_event):
+            return self.incremental_sync_for_archived_room(
                 sync_config, leave_event, since_token, tags_by_room
             )
-            archived.append(room_sync)
+
+        archived = yield concurrently_execute(
+            sync_archived_room, leave_events, self.room_concurrency,
+        )
 
         invited = [
             InvitedSyncResult(room_id=event.room_id, invite=event)
@@ -516,28 +893,54 @@ class SyncHandler(BaseHandler):
             next_batch=now_token,
         ))
 
+    @staticmethod
+    def _recents_load_limit(sync_config):
+        filtering_factor = 2
+        timeline_limit = sync_config.filter.timeline_limit()
+        return max(timeline_limit * filtering_factor, 100)
+
+    def load_recent_events_for_rooms(self, room_ids, sync_config, now_token,
+                                     since_token=None):
+        """Load the first batch of recent events that `load_filtered_recents`
+        would load for each of the rooms, in bulk.
+
+        :returns a Deferred dict of room_id to the (events, keys) tuple to pass
+            to `load_filtered_recents` as `recent_events`
+        """
+        return self.store.get_recent_events_for_rooms(
+            room_ids,
+            limit=self._recents_load_limit(sync_config) + 1,
+            from_token=since_token.room_key if since_token else None,
+            end_token=now_token.room_key,
+        )
+
     @defer.inlineCallbacks
     def load_filtered_recents(self, room_id, sync_config, now_token,
-                              since_token=None):
+                              since_token=None, recent_events=None):
         """
+        :param recent_events: The first batch of events to filter, if already
+            loaded by `load_recent_events_for_rooms`
         :returns a Deferred TimelineBatch
         """
         limited = True
         recents = []
-        filtering_factor = 2
         timeline_limit = sync_config.filter.timeline_limit()
-        load_limit = max(timeline_limit * filtering_factor, 100)
+        load_limit = self._recents_load_limit(sync_config)
         max_repeat = 3  # Only try a few times per room, otherwise
         room_key = now_token.room_key
         end_key = room_key
 
         while limited and len(recents) < timeline_limit and max_repeat:
-            events, keys = yield self.store.get_recent_events_for_room(
-                room_id,
-                limit=load_limit + 1,
-                from_token=since_token.room_key if since_token else None,
-                end_token=end_key,
-            )
+            if recent_events is not None:
+                events, keys = recent_events
+                recent_events = None
+            else:
+                events, keys = yield self.store.get_recent_events_for_room(
+                    room_id,
+                    limit=load_limit + 1,
+                    from_token=since_token.room_key if since_token else None,
+                    end_token=end_key,
+                )
             (room_key, _) = keys
             end_key = "s" + room_key.split('-')[-1]
             loaded_recents = sync_config.filter.filter_room_timeline(events)
@@ -566,7 +969,8 @@ class SyncHandler(BaseHandler):
     @defer.inlineCallbacks
     def incremental_sync_with_gap_for_room(self, room_id, sync_config,
                                            since_token, now_token,
-                                           ephemeral_by_room, tags_by_room):
+                                           ephemeral_by_room, tags_by_room,
+                                           recent_events=None):
         """ Get the incremental delta needed to bring the client up to date for
         the room. Gives the client the most recent events and the changes to
         state.
@@ -580,6 +984,7 @@ class SyncHandler(BaseHandler):
 
         batch = yield self.load_filtered_recents(
             room_id, sync_config, now_token, since_token,
+            recent_events=recent_events,
         )
 
         logging.debug("Recents %r", batch)
@@ -600,6 +1005,12 @@ class SyncHandler(BaseHandler):
         if just_joined:
             state = yield self.get_state_at(room_id, now_token)
 
+        if sync_config.filter.lazy_load_members():
+            state = yield self.lazy_load_members(
+                sync_config, room_id, batch.events, state,
+                full_state=just_joined,
+            )
+
         room_sync = JoinedSyncResult(
             room_id=room_id,
             timeline=batch,
@@ -696,6 +1107,71 @@ class SyncHandler(BaseHandler):
             state = {}
         defer.returnValue(state)
 
+    @defer.inlineCallbacks
+    def lazy_load_members(self, sync_config, room_id, timeline, state,
+                          full_state):
+        """Strip the membership events that a client which is lazy loading
+        members doesn't need from the state to send it for a room.
+
+        The client gets the membership of the senders of the timeline events
+        (and of the users affected by membership events in it) and its own
+        membership. We remember which membership events each client has been
+        sent, so that incremental syncs tell it about changes to members it
+        knows about and about members it hasn't been sent yet.
+
+        :param list[synapse.events.FrozenEvent] timeline: the timeline events
+            being sent to the client
+        :param dict[(str,str), synapse.events.FrozenEvent] state: the state
+            (or change in state) to send to the client
+        :param bool full_state: whether `state` is the full state of the room,
+            rather than a change since the client's last sync
+        :returns A Deferred dict[(str,str), synapse.events.FrozenEvent]
+        """
+        cache_key = (
+            sync_config.user.to_string(), sync_config.token_id, room_id,
+        )
+        if full_state:
+            sent_members = {}
+        else:
+            sent_members = dict(
+                self.lazy_loaded_members_cache.get(cache_key, {})
+            )
+
+        wanted_members = set([sync_config.user.to_string()])
+        for event in timeline:
+            wanted_members.add(event.sender)
+            if event.type == EventTypes.Member:
+                wanted_members.add(event.state_key)
+
+        result = {}
+        for key, event in state.items():
+            if key[0] != EventTypes.Member:
+                result[key] = event
+            elif key[1] in wanted_members or key[1] in sent_members:
+                result[key] = event
+
+        if not full_state and timeline:
+            # The state is only a change in the state, so look up the members
+            # the client wants but hasn't been sent yet.
+            missing = [
+                user_id for user_id in wanted_members
+                if (EventTypes.Member, user_id) not in result
+                and user_id not in sent_members
+            ]
+            if missing:
+                member_state = yield self.store.get_state_for_event(
+                    timeline[-1].event_id,
+                    types=[(EventTypes.Member, user_id) for user_id in missing],
+                )
+                result.update(member_state)
+
+        for event in itertools.chain(result.values(), timeline):
+            if event.type == EventTypes.Member:
+                sent_members[event.state_key] = event.event_id
+        self.lazy_loaded_members_cache.prefill(cache_key, sent_members)
+
+        defer.returnValue(result)
+
     def compute_state_delta(self, since_token, previous_state, current_state):
         """ Works out the differnce in state between the current state and the
         state the client got when it last performed a sync.
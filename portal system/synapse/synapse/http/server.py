@@ -24,14 +24,17 @@ import synapse.events
 from canonicaljson import (
     encode_canonical_json, encode_pretty_printed_json
 )
+from frozendict import frozendict
+from zope.interface import implementer
 
-from twisted.internet import defer
+from twisted.internet import defer, interfaces
 from twisted.web import server, resource
 from twisted.web.server import NOT_DONE_YET
 from twisted.web.util import redirectTo
 
 import collections
 import logging
+import simplejson
 import urllib
 import ujson
 
@@ -56,6 +59,197 @@ response_timer = metrics.register_distribution(
 _next_request_id = 0
 
 
+def _unwrap_frozendict(obj):
+    if type(obj) is frozendict:
+        # frozendict keeps the wrapped dict in a name mangled attribute. We
+        # hand that straight to the encoder rather than copying it.
+        return getattr(obj, "_frozendict__dict", None) or dict(obj)
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+
+# Encoder for responses that don't need to be canonical, i.e. everything that
+# isn't signed, when frozen dicts are in use. Unlike ujson it understands
+# frozendicts, and it doesn't sort keys.
+_fast_json_encoder = simplejson.JSONEncoder(
+    ensure_ascii=False,
+    separators=(',', ':'),
+    default=_unwrap_frozendict,
+)
+
+
+def encode_fast_json(json_object):
+    """Encodes the JSON object as UTF-8 bytes without sorting keys or
+    otherwise canonicalising it. Only suitable for responses that don't need
+    to be signed, e.g. those to clients.
+    """
+    return _fast_json_encoder.encode(json_object).encode("UTF-8")
+
+
+def _encode_client_json(json_object):
+    """Encodes a response that doesn't need to be canonical as UTF-8 bytes.
+    ujson is several times quicker than `encode_fast_json`, but doesn't
+    understand frozendicts, so is only used when they are turned off.
+    """
+    if synapse.events.USE_FROZEN_DICTS:
+        return encode_fast_json(json_object)
+    return ujson.dumps(json_object, ensure_ascii=False)
+
+
+# Streamed responses are written out in chunks of at least this many bytes.
+# Responses that fit in a single chunk are sent in one go instead.
+STREAMED_RESPONSE_CHUNK_SIZE = 64 * 1024
+
+
+class StreamedJsonObject(object):
+    """A JSON object whose members are only generated as the response is
+    written, so that large responses never need to be held in memory in full.
+
+    If a `JsonResource` callback returns one of these as its response it is
+    encoded and written out a chunk at a time using chunked transfer encoding,
+    unless the response needs to be canonical or pretty printed in which case
+    it is built up in full first. Streamed objects and lists may be nested in
+    one another, but are not looked for inside ordinary dicts or lists.
+
+    Args:
+        items (iterable): The (key, value) pairs of the object. These are only
+            iterated over once, so this can be a generator.
+    """
+
+    def __init__(self, items):
+        self.items = items
+
+
+class StreamedJsonList(object):
+    """A JSON list whose entries are only generated as the response is
+    written. See `StreamedJsonObject`.
+
+    Args:
+        values (iterable): The entries of the list. These are only iterated
+            over once, so this can be a generator.
+    """
+
+    def __init__(self, values):
+        self.values = values
+
+
+def _iterencode_streamed_json(json_object):
+    """Yields the fragments of the non-canonical JSON encoding of the object,
+    only generating the contents of streamed objects and lists as they are
+    reached. The fragments are either unicode or UTF-8 encoded bytes.
+    """
+    if isinstance(json_object, StreamedJsonObject):
+        separator = u"{"
+        for key, value in json_object.items:
+            yield separator + _fast_json_encoder.encode(key) + u":"
+            for fragment in _iterencode_streamed_json(value):
+                yield fragment
+            separator = u","
+        yield u"{}" if separator == u"{" else u"}"
+    elif isinstance(json_object, StreamedJsonList):
+        separator = u"["
+        for value in json_object.values:
+            yield separator
+            for fragment in _iterencode_streamed_json(value):
+                yield fragment
+            separator = u","
+        yield u"[]" if separator == u"[" else u"]"
+    else:
+        yield _encode_client_json(json_object)
+
+
+def _iter_streamed_json_chunks(json_object, chunk_size):
+    """Encodes the object as UTF-8 JSON, yielding it in chunks of at least
+    `chunk_size` bytes (apart from the last).
+    """
+    buf = []
+    buffered = 0
+    for fragment in _iterencode_streamed_json(json_object):
+        if isinstance(fragment, unicode):
+            fragment = fragment.encode("UTF-8")
+        buf.append(fragment)
+        buffered += len(fragment)
+        if buffered >= chunk_size:
+            yield b"".join(buf)
+            buf = []
+            buffered = 0
+
+    if buf:
+        yield b"".join(buf)
+
+
+def _materialize_streamed_json(json_object):
+    """Builds the streamed objects and lists in the given object up into
+    ordinary dicts and lists.
+    """
+    if isinstance(json_object, StreamedJsonObject):
+        return {
+            key: _materialize_streamed_json(value)
+            for key, value in json_object.items
+        }
+    elif isinstance(json_object, StreamedJsonList):
+        return [
+            _materialize_streamed_json(value)
+            for value in json_object.values
+        ]
+    else:
+        return json_object
+
+
+@implementer(interfaces.IPullProducer)
+class _StreamedJsonProducer(object):
+    """Writes a streamed response to a request one chunk at a time.
+
+    This is registered as a pull producer, so the next chunk is only encoded
+    once the transport has sent the previous one on. That bounds the amount of
+    the response held in memory, and lets the reactor get on with other work
+    in between chunks.
+    """
+
+    def __init__(self, request, first_chunk, chunks):
+        self._request = request
+        self._pending = first_chunk
+        self._chunks = chunks
+
+    def start(self):
+        self._request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if self._chunks is None:
+            return
+
+        if self._pending is not None:
+            chunk, self._pending = self._pending, None
+            self._request.write(chunk)
+            return
+
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._stop()
+            self._request.finish()
+            return
+        except:
+            logger.exception(
+                "Failed to stream response to %s", self._request
+            )
+            self._stop()
+            # We've already sent the headers, so the best we can do is to drop
+            # the connection so that the client doesn't mistake the truncated
+            # response for a complete one.
+            self._request.transport.loseConnection()
+            return
+
+        self._request.write(chunk)
+
+    def stopProducing(self):
+        # The connection has gone away, so there's no point carrying on.
+        self._chunks = None
+
+    def _stop(self):
+        self._chunks = None
+        self._request.unregisterProducer()
+
+
 def request_handler(request_handler):
     """Wraps a method that acts as a request handler with the necessary logging
     and exception handling.
@@ -145,7 +339,9 @@ class JsonResource(HttpServer, resource.Resource):
     Register callbacks via register_path()
 
     Callbacks can return a tuple of status code and a dict in which case the
-    the dict will automatically be sent to the client as a JSON object.
+    the dict will automatically be sent to the client as a JSON object. Large
+    responses can instead be returned as a `StreamedJsonObject`, which is
+    written out a chunk at a time.
 
     The JsonResource is primarily intended for returning JSON, but callbacks
     may send something other than JSON, they may do so by using the methods
@@ -268,14 +464,26 @@ class RootRedirect(resource.Resource):
 def respond_with_json(request, code, json_object, send_cors=False,
                       response_code_message=None, pretty_print=False,
                       version_string="", canonical_json=True):
+    is_streamed = isinstance(
+        json_object, (StreamedJsonObject, StreamedJsonList)
+    )
+    if is_streamed and not pretty_print and not canonical_json:
+        return respond_with_json_stream(
+            request, code, json_object,
+            send_cors=send_cors,
+            response_code_message=response_code_message,
+            version_string=version_string,
+        )
+
+    json_object = _materialize_streamed_json(json_object)
+
     if pretty_print:
         json_bytes = encode_pretty_printed_json(json_object) + "\n"
     else:
-        if canonical_json or synapse.events.USE_FROZEN_DICTS:
+        if canonical_json:
             json_bytes = encode_canonical_json(json_object)
         else:
-            # ujson doesn't like frozen_dicts.
-            json_bytes = ujson.dumps(json_object, ensure_ascii=False)
+            json_bytes = _encode_client_json(json_object)
 
     return respond_with_json_bytes(
         request, code, json_bytes,
@@ -298,10 +506,63 @@ def respond_with_json_bytes(request, code, json_bytes, send_cors=False,
     Returns:
         twisted.web.server.NOT_DONE_YET"""
 
+    _set_json_response_headers(
+        request, code, send_cors, version_string, response_code_message,
+    )
+    request.setHeader(b"Content-Length", b"%d" % (len(json_bytes),))
+
+    request.write(json_bytes)
+    request.finish()
+    return NOT_DONE_YET
+
+
+def respond_with_json_stream(request, code, json_object, send_cors=False,
+                             version_string="", response_code_message=None,
+                             chunk_size=STREAMED_RESPONSE_CHUNK_SIZE):
+    """Sends a JSON response containing streamed objects or lists, encoding
+    and writing it out a chunk at a time as the client reads it.
+
+    The response is sent without a Content-Length, so uses chunked transfer
+    encoding. If it turns out to fit in a single chunk it is sent as normal
+    instead.
+
+    Args:
+        request (twisted.web.http.Request): The http request to respond to.
+        code (int): The HTTP response code.
+        json_object: The response, which may contain `StreamedJsonObject` and
+            `StreamedJsonList` objects.
+        send_cors (bool): Whether to send Cross-Origin Resource Sharing headers
+            http://www.w3.org/TR/cors/
+        chunk_size (int): The minimum number of bytes to write at a time.
+    Returns:
+        twisted.web.server.NOT_DONE_YET"""
+    chunks = _iter_streamed_json_chunks(json_object, chunk_size)
+
+    # Encoding the first chunk here means that errors in it can still be
+    # turned into an error response, and that small responses are sent with a
+    # Content-Length as usual.
+    first_chunk = next(chunks, b"")
+    if len(first_chunk) < chunk_size:
+        return respond_with_json_bytes(
+            request, code, first_chunk,
+            send_cors=send_cors,
+            version_string=version_string,
+            response_code_message=response_code_message,
+        )
+
+    _set_json_response_headers(
+        request, code, send_cors, version_string, response_code_message,
+    )
+
+    _StreamedJsonProducer(request, first_chunk, chunks).start()
+    return NOT_DONE_YET
+
+
+def _set_json_response_headers(request, code, send_cors, version_string,
+                               response_code_message):
     request.setResponseCode(code, message=response_code_message)
     request.setHeader(b"Content-Type", b"application/json")
     request.setHeader(b"Server", version_string)
-    request.setHeader(b"Content-Length", b"%d" % (len(json_bytes),))
 
     if send_cors:
         request.setHeader("Access-Control-Allow-Origin", "*")
@@ -310,10 +571,6 @@ def respond_with_json_bytes(request, code, json_bytes, send_cors=False,
         request.setHeader("Access-Control-Allow-Headers",
                           "Origin, X-Requested-With, Content-Type, Accept")
 
-    request.write(json_bytes)
-    request.finish()
-    return NOT_DONE_YET
-
 
 def _request_user_agent_is_curl(request):
     user_agents = request.requestHeaders.getRawHeaders(
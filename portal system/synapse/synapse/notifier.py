@@ -16,12 +16,17 @@
 from twisted.internet import defer
 from synapse.api.constants import EventTypes
 from synapse.api.errors import AuthError
+from synapse.appservice import ApplicationServiceInterestIndex
 
 from synapse.util.logutils import log_function
+from synapse.util.logcontext import (
+    PreserveLoggingContext, preserve_context_over_deferred,
+)
 from synapse.util.async import run_on_reactor, ObservableDeferred
 from synapse.types import StreamToken
 import synapse.metrics
 
+from collections import deque
 import logging
 
 
@@ -31,6 +36,20 @@ metrics = synapse.metrics.get_metrics_for(__name__)
 
 notified_events_counter = metrics.register_counter("notified_events")
 
+# The number of times user streams were woken up, and how many of those were
+# folded into a wake up that was already pending.
+user_stream_wakeups_counter = metrics.register_counter("user_stream_wakeups")
+coalesced_notifications_counter = metrics.register_counter(
+    "coalesced_notifications"
+)
+
+# The number of times a listener was woken up, and how many of those turned
+# out to have nothing new for it.
+listener_wakeups_counter = metrics.register_counter("listener_wakeups")
+wasted_listener_wakeups_counter = metrics.register_counter(
+    "wasted_listener_wakeups"
+)
+
 
 # TODO(paul): Should be shared somewhere
 def count(func, l):
@@ -71,11 +90,15 @@ class _NotifierUserStream(object):
         self.current_token = current_token
         self.last_notified_ms = time_now_ms
 
+        # When this stream was last added to the notifier's expiry queue.
+        self.expiry_queued_ms = None
+
         self.notify_deferred = ObservableDeferred(defer.Deferred())
 
     def notify(self, stream_key, stream_id, time_now_ms):
-        """Notify any listeners for this user of a new event from an
-        event source.
+        """Advance the token for this user to include a new event from an
+        event source. The listeners aren't woken up until `wake_listeners` is
+        called, so that several events in a row only wake them once.
         Args:
             stream_key(str): The stream the event came from.
             stream_id(str): The new id for the stream the event came from.
@@ -85,9 +108,17 @@ class _NotifierUserStream(object):
             stream_key, stream_id
         )
         self.last_notified_ms = time_now_ms
+
+    def wake_listeners(self):
+        """Wake up the listeners for this user with the current token.
+        Returns:
+            int: The number of listeners woken.
+        """
         noify_deferred = self.notify_deferred
+        listeners = len(noify_deferred.observers())
         self.notify_deferred = ObservableDeferred(defer.Deferred())
         noify_deferred.callback(self.current_token)
+        return listeners
 
     def remove(self, notifier):
         """ Remove this listener from all the indexes in the Notifier
@@ -97,6 +128,8 @@ class _NotifierUserStream(object):
         for room in self.rooms:
             lst = notifier.room_to_user_streams.get(room, set())
             lst.discard(self)
+            if not lst:
+                notifier.room_to_user_streams.pop(room, None)
 
         notifier.user_to_user_stream.pop(self.user)
 
@@ -127,6 +160,16 @@ class Notifier(object):
 
     UNUSED_STREAM_EXPIRY_MS = 10 * 60 * 1000
 
+    # How often a user stream that keeps being notified is requeued for
+    # expiry. A stream notified within this long of being queued is only
+    # expired on a later pass, so may outlive UNUSED_STREAM_EXPIRY_MS a bit.
+    STREAM_EXPIRY_REQUEUE_MS = 60 * 1000
+
+    # How long to wait before waking up the user streams that have been
+    # notified. Everything notified in the meantime is handled by a single
+    # wake up of each stream. Zero means waiting for the next reactor tick.
+    NOTIFY_COALESCE_WINDOW_S = 0
+
     def __init__(self, hs):
         self.hs = hs
 
@@ -134,6 +177,22 @@ class Notifier(object):
         self.room_to_user_streams = {}
         self.appservice_to_user_streams = {}
 
+        # An index over the keys of appservice_to_user_streams, rebuilt when
+        # a new appservice starts listening.
+        self._appservice_index = ApplicationServiceInterestIndex([])
+
+        # The user streams in the order they should be checked for expiry, as
+        # (queued_ms, user_stream) tuples. A stream that has been requeued
+        # leaves behind stale entries, which are skipped.
+        self._stream_expiry_queue = deque()
+
+        # The number of requests waiting for events.
+        self._listener_count = 0
+
+        # The user streams which have been notified but not yet woken up.
+        self._pending_user_streams = set()
+        self._wake_up_scheduled = False
+
         self.event_sources = hs.get_event_sources()
         self.store = hs.get_datastore()
         self.pending_new_room_events = []
@@ -148,25 +207,13 @@ class Notifier(object):
             self.remove_expired_streams, self.UNUSED_STREAM_EXPIRY_MS
         )
 
-        # This is not a very cheap test to perform, but it's only executed
-        # when rendering the metrics page, which is likely once per minute at
-        # most when scraping it.
-        def count_listeners():
-            all_user_streams = set()
-
-            for x in self.room_to_user_streams.values():
-                all_user_streams |= x
-            for x in self.user_to_user_stream.values():
-                all_user_streams.add(x)
-            for x in self.appservice_to_user_streams.values():
-                all_user_streams |= x
-
-            return sum(stream.count_listeners() for stream in all_user_streams)
-        metrics.register_callback("listeners", count_listeners)
-
+        metrics.register_callback(
+            "listeners",
+            lambda: self._listener_count,
+        )
         metrics.register_callback(
             "rooms",
-            lambda: count(bool, self.room_to_user_streams.values()),
+            lambda: len(self.room_to_user_streams),
         )
         metrics.register_callback(
             "users",
@@ -225,17 +272,18 @@ class Notifier(object):
 
         app_streams = set()
 
-        for appservice in self.appservice_to_user_streams:
-            # TODO (kegan): Redundant appservice listener checks?
-            # App services will already be in the room_to_user_streams set, but
-            # that isn't enough. They need to be checked here in order to
-            # receive *invites* for users they are interested in. Does this
-            # make the room_to_user_streams check somewhat obselete?
-            if appservice.is_interested(event):
-                app_user_streams = self.appservice_to_user_streams.get(
-                    appservice, set()
-                )
-                app_streams |= app_user_streams
+        # TODO (kegan): Redundant appservice listener checks?
+        # App services will already be in the room_to_user_streams set, but
+        # that isn't enough. They need to be checked here in order to
+        # receive *invites* for users they are interested in. Does this
+        # make the room_to_user_streams check somewhat obselete?
+        for appservice in self._appservice_index.get_interested_services(
+            event
+        ):
+            app_user_streams = self.appservice_to_user_streams.get(
+                appservice, set()
+            )
+            app_streams |= app_user_streams
 
         self.on_new_event(
             "room_key", room_stream_id,
@@ -263,13 +311,50 @@ class Notifier(object):
         for room in rooms:
             user_streams |= self.room_to_user_streams.get(room, set())
 
+        notified_events_counter.inc()
+
         time_now_ms = self.clock.time_msec()
+        pending = self._pending_user_streams
         for user_stream in user_streams:
             try:
                 user_stream.notify(stream_key, new_token, time_now_ms)
             except:
                 logger.exception("Failed to notify listener")
 
+            queued_ms = user_stream.expiry_queued_ms
+            if time_now_ms - queued_ms > self.STREAM_EXPIRY_REQUEUE_MS:
+                self._queue_for_expiry(user_stream, time_now_ms)
+
+            if user_stream in pending:
+                coalesced_notifications_counter.inc()
+            else:
+                pending.add(user_stream)
+
+        if pending and not self._wake_up_scheduled:
+            self._wake_up_scheduled = True
+            self.clock.call_later(
+                self.NOTIFY_COALESCE_WINDOW_S, self._wake_pending_user_streams
+            )
+
+    def _wake_pending_user_streams(self):
+        """Wake up the listeners of the user streams that have been notified
+        since we last did so.
+        """
+        pending = self._pending_user_streams
+        self._pending_user_streams = set()
+        self._wake_up_scheduled = False
+
+        user_stream_wakeups_counter.inc_by(len(pending))
+
+        with PreserveLoggingContext():
+            for user_stream in pending:
+                try:
+                    listener_wakeups_counter.inc_by(
+                        user_stream.wake_listeners()
+                    )
+                except:
+                    logger.exception("Failed to wake up listeners")
+
     @defer.inlineCallbacks
     def wait_for_events(self, user, timeout, callback, room_ids=None,
                         from_token=StreamToken("s0", "0", "0", "0", "0")):
@@ -305,6 +390,7 @@ class Notifier(object):
             timer = self.clock.call_later(timeout/1000., timed_out)
 
             prev_token = from_token
+            woken = False
             while not result:
                 try:
                     current_token = user_stream.current_token
@@ -313,13 +399,21 @@ class Notifier(object):
                     if result:
                         break
 
+                    if woken:
+                        wasted_listener_wakeups_counter.inc()
+
                     # Now we wait for the _NotifierUserStream to be told there
                     # is a new token.
                     # We need to supply the token we supplied to callback so
                     # that we don't miss any current_token updates.
                     prev_token = current_token
                     listener = user_stream.new_listener(prev_token)
-                    yield listener.deferred
+                    self._listener_count += 1
+                    try:
+                        yield preserve_context_over_deferred(listener.deferred)
+                    finally:
+                        self._listener_count -= 1
+                    woken = True
                 except defer.CancelledError:
                     break
 
@@ -419,28 +513,47 @@ class Notifier(object):
 
     @log_function
     def remove_expired_streams(self):
+        """Removes the user streams that have had no listeners and haven't
+        been notified for UNUSED_STREAM_EXPIRY_MS. Only the streams that were
+        queued before then are looked at.
+        """
         time_now_ms = self.clock.time_msec()
-        expired_streams = []
         expire_before_ts = time_now_ms - self.UNUSED_STREAM_EXPIRY_MS
-        for stream in self.user_to_user_stream.values():
-            if stream.count_listeners():
+        queue = self._stream_expiry_queue
+        while queue and queue[0][0] < expire_before_ts:
+            queued_ms, stream = queue.popleft()
+            if queued_ms != stream.expiry_queued_ms:
                 continue
-            if stream.last_notified_ms < expire_before_ts:
-                expired_streams.append(stream)
+            if self.user_to_user_stream.get(stream.user) is not stream:
+                continue
+
+            if (stream.count_listeners() or
+                    stream.last_notified_ms >= expire_before_ts):
+                # It's still in use, so check it again later.
+                self._queue_for_expiry(stream, time_now_ms)
+            else:
+                stream.remove(self)
 
-        for expired_stream in expired_streams:
-            expired_stream.remove(self)
+    def _queue_for_expiry(self, user_stream, time_now_ms):
+        user_stream.expiry_queued_ms = time_now_ms
+        self._stream_expiry_queue.append((time_now_ms, user_stream))
 
     @log_function
     def _register_with_keys(self, user_stream):
         self.user_to_user_stream[user_stream.user] = user_stream
+        self._queue_for_expiry(user_stream, self.clock.time_msec())
 
         for room in user_stream.rooms:
             s = self.room_to_user_streams.setdefault(room, set())
             s.add(user_stream)
 
         if user_stream.appservice:
-            self.appservice_to_user_stream.setdefault(
+            if user_stream.appservice not in self.appservice_to_user_streams:
+                self._appservice_index = ApplicationServiceInterestIndex(
+                    self.appservice_to_user_streams.keys() +
+                    [user_stream.appservice]
+                )
+            self.appservice_to_user_streams.setdefault(
                 user_stream.appservice, set()
             ).add(user_stream)
 
@@ -21,6 +21,7 @@ REQUIREMENTS = {
     "frozendict>=0.4": ["frozendict"],
     "unpaddedbase64>=1.0.1": ["unpaddedbase64>=1.0.1"],
     "canonicaljson>=1.0.0": ["canonicaljson>=1.0.0"],
+    "simplejson>=3.12.0": ["simplejson>=3.12.0"],
     "signedjson>=1.0.0": ["signedjson>=1.0.0"],
     "pynacl>=0.3.0": ["nacl>=0.3.0", "nacl.bindings"],
     "service_identity>=1.0.0": ["service_identity>=1.0.0"],
@@ -15,6 +15,7 @@
 
 from twisted.internet import defer
 
+from synapse.http.server import StreamedJsonList, StreamedJsonObject
 from synapse.streams.config import PaginationConfig
 from base import ClientV1RestServlet, client_path_pattern
 
@@ -30,11 +31,24 @@ class InitialSyncRestServlet(ClientV1RestServlet):
         pagination_config = PaginationConfig.from_request(request)
         handler = self.handlers.message_handler
         include_archived = request.args.get("archived", None) == ["true"]
+        lazy_load_members = (
+            request.args.get("lazy_load_members", None) == ["true"]
+        )
         content = yield handler.snapshot_all_rooms(
             user_id=user.to_string(),
             pagin_config=pagination_config,
             as_client_event=as_client_event,
             include_archived=include_archived,
+            lazy_load_members=lazy_load_members,
+        )
+
+        # Write the rooms out one at a time, rather than encoding the whole of
+        # what can be a very large response in one go. This only saves us
+        # holding the encoded response in memory: the rooms themselves have
+        # all been built by now, as the response is encoded synchronously.
+        rooms = content.pop("rooms")
+        content = StreamedJsonObject(
+            content.items() + [("rooms", StreamedJsonList(rooms))]
         )
 
         defer.returnValue((200, content))
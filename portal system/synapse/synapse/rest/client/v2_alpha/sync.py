@@ -15,6 +15,7 @@
 
 from twisted.internet import defer
 
+from synapse.http.server import StreamedJsonObject
 from synapse.http.servlet import (
     RestServlet, parse_string, parse_integer, parse_boolean
 )
@@ -22,7 +23,8 @@ from synapse.handlers.sync import SyncConfig
 from synapse.types import StreamToken
 from synapse.events import FrozenEvent
 from synapse.events.utils import (
-    serialize_event, format_event_for_client_v2_without_room_id,
+    serialize_event, serialize_event_to_json,
+    format_event_for_client_v2_without_room_id,
 )
 from synapse.api.filtering import FilterCollection
 from ._base import client_v2_pattern
@@ -107,9 +109,16 @@ class SyncRestServlet(RestServlet):
         except:
             filter = FilterCollection({})
 
+        request_key = (user, timeout, since, filter_id, full_state)
+        if filter.lazy_load_members():
+            # What we send depends on what this device has been sent before.
+            request_key += (token_id,)
+
         sync_config = SyncConfig(
             user=user,
             filter=filter,
+            request_key=request_key,
+            token_id=token_id,
         )
 
         if since is not None:
@@ -143,17 +152,20 @@ class SyncRestServlet(RestServlet):
             sync_result.archived, filter, time_now, token_id
         )
 
-        response_content = {
-            "presence": self.encode_presence(
+        # The joined and archived rooms are only encoded as the response is
+        # written out, so that we don't hold the whole of a large initial sync
+        # in memory at once.
+        response_content = StreamedJsonObject([
+            ("next_batch", sync_result.next_batch.to_string()),
+            ("presence", self.encode_presence(
                 sync_result.presence, filter, time_now
-            ),
-            "rooms": {
-                "join": joined,
-                "invite": invited,
-                "leave": archived,
-            },
-            "next_batch": sync_result.next_batch.to_string(),
-        }
+            )),
+            ("rooms", StreamedJsonObject([
+                ("invite", invited),
+                ("join", joined),
+                ("leave", archived),
+            ])),
+        ])
 
         defer.returnValue((200, response_content))
 
@@ -177,16 +189,14 @@ class SyncRestServlet(RestServlet):
         :param int token_id: ID of the user's auth token - used for namespacing
             of transaction IDs
 
-        :return: the joined rooms list, in our response format
-        :rtype: dict[str, dict[str, object]]
+        :return: the joined rooms list, in our response format. The rooms are
+            encoded lazily as the response is written.
+        :rtype: StreamedJsonObject
         """
-        joined = {}
-        for room in rooms:
-            joined[room.room_id] = self.encode_room(
-                room, filter, time_now, token_id
-            )
-
-        return joined
+        return StreamedJsonObject(
+            (room.room_id, self.encode_room(room, filter, time_now, token_id))
+            for room in rooms
+        )
 
     def encode_invited(self, rooms, filter, time_now, token_id):
         """
@@ -229,16 +239,19 @@ class SyncRestServlet(RestServlet):
         :param int token_id: ID of the user's auth token - used for namespacing
             of transaction IDs
 
-        :return: the invited rooms list, in our response format
-        :rtype: dict[str, dict[str, object]]
+        :return: the archived rooms list, in our response format. The rooms
+            are encoded lazily as the response is written.
+        :rtype: StreamedJsonObject
         """
-        joined = {}
-        for room in rooms:
-            joined[room.room_id] = self.encode_room(
-                room, filter, time_now, token_id, joined=False
+        return StreamedJsonObject(
+            (
+                room.room_id,
+                self.encode_room(
+                    room, filter, time_now, token_id, joined=False
+                ),
             )
-
-        return joined
+            for room in rooms
+        )
 
     @staticmethod
     def encode_room(room, filter, time_now, token_id, joined=True):
@@ -258,7 +271,7 @@ class SyncRestServlet(RestServlet):
         """
         def serialize(event):
             # TODO(mjark): Respect formatting requirements in the filter.
-            return serialize_event(
+            return serialize_event_to_json(
                 event, time_now, token_id=token_id,
                 event_format=format_event_for_client_v2_without_room_id,
             )
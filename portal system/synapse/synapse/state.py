@@ -18,6 +18,7 @@ from twisted.internet import defer
 
 from synapse.util.logutils import log_function
 from synapse.util.caches.expiringcache import ExpiringCache
+from synapse.util.statemap import StateMap
 from synapse.api.constants import EventTypes
 from synapse.api.errors import AuthError
 from synapse.api.auth import AuthEventTypes
@@ -39,9 +40,22 @@ EVICTION_TIMEOUT_SECONDS = 20
 
 
 class _StateCacheEntry(object):
-    def __init__(self, state, state_group, ts):
+    def __init__(self, state, state_group, ts, conflicted=None):
         self.state = state
         self.state_group = state_group
+        # map from (type, state_key) to the list of event_ids that had to be
+        # resolved between for that key.
+        self.conflicted = conflicted or {}
+
+    def get_prev_states(self, event_type, state_key):
+        key = (event_type, state_key)
+        if self.state_group is None:
+            return list(self.conflicted.get(key, []))
+
+        prev_state = self.state.get(key, None)
+        if prev_state:
+            return [prev_state.event_id]
+        return []
 
 
 class StateHandler(object):
@@ -56,6 +70,11 @@ class StateHandler(object):
         # dict of set of event_ids -> _StateCacheEntry.
         self._state_cache = None
 
+        # dict of set of state group ids -> _StateCacheEntry. Many different
+        # sets of forward extremities resolve to the same set of state groups
+        # so this saves us resolving the same conflicts over and over.
+        self._resolved_state_cache = None
+
     def start_caching(self):
         logger.debug("start_caching")
 
@@ -69,6 +88,16 @@ class StateHandler(object):
 
         self._state_cache.start()
 
+        self._resolved_state_cache = ExpiringCache(
+            cache_name="resolved_state_cache",
+            clock=self.clock,
+            max_len=SIZE_OF_CACHE,
+            expiry_ms=EVICTION_TIMEOUT_SECONDS*1000,
+            reset_expiry_on_get=True,
+        )
+
+        self._resolved_state_cache.start()
+
     @defer.inlineCallbacks
     def get_current_state(self, room_id, event_type=None, state_key=""):
         """ Retrieves the current state for the room. This is done by
@@ -122,20 +151,13 @@ class StateHandler(object):
             # If this is an outlier, then we know it shouldn't have any current
             # state. Certainly store.get_current_state won't return any, and
             # persisting the event won't store the state group.
-            if old_state:
-                context.current_state = {
-                    (s.type, s.state_key): s for s in old_state
-                }
-            else:
-                context.current_state = {}
+            context.current_state = StateMap.from_events(old_state or [])
             context.prev_state_events = []
             context.state_group = None
             defer.returnValue(context)
 
         if old_state:
-            context.current_state = {
-                (s.type, s.state_key): s for s in old_state
-            }
+            context.current_state = StateMap.from_events(old_state)
             context.state_group = None
 
             if event.is_state():
@@ -161,6 +183,8 @@ class StateHandler(object):
 
         group, curr_state, prev_state = ret
 
+        # This is the StateMap from the cache entry, so is shared rather than
+        # copied.
         context.current_state = curr_state
         context.state_group = group if not event.is_state() else None
 
@@ -181,73 +205,74 @@ class StateHandler(object):
 
         :returns a Deferred tuple of (`state_group`, `state`, `prev_state`).
         `state_group` is the name of a state group if one and only one is
-        involved. `state` is a map from (type, state_key) to event, and
+        involved. `state` is a StateMap from (type, state_key) to event, and
         `prev_state` is a list of event ids.
         """
         logger.debug("resolve_state_groups event_ids %s", event_ids)
 
         if self._state_cache is not None:
             cache = self._state_cache.get(frozenset(event_ids), None)
-            if cache and cache.state_group:
+            if cache:
                 cache.ts = self.clock.time_msec()
-                prev_state = cache.state.get((event_type, state_key), None)
-                if prev_state:
-                    prev_state = prev_state.event_id
-                    prev_states = [prev_state]
-                else:
-                    prev_states = []
-                defer.returnValue(
-                    (cache.state_group, cache.state, prev_states)
-                )
+                defer.returnValue((
+                    cache.state_group,
+                    cache.state,
+                    cache.get_prev_states(event_type, state_key),
+                ))
 
-        state_groups = yield self.store.get_state_groups(
-            room_id, event_ids
-        )
+        cache = None
+        if self._resolved_state_cache is not None:
+            # Look up the state groups first so that we don't have to load
+            # their state if we've already resolved them.
+            group_names = yield self.store.get_state_group_ids(
+                room_id, event_ids
+            )
+            group_names = frozenset(group_names)
+            cache = self._resolved_state_cache.get(group_names, None)
 
-        logger.debug(
-            "resolve_state_groups state_groups %s",
-            state_groups.keys()
-        )
+        if cache:
+            cache.ts = self.clock.time_msec()
+        else:
+            state_groups = yield self.store.get_state_groups(
+                room_id, event_ids
+            )
 
-        group_names = set(state_groups.keys())
-        if len(group_names) == 1:
-            name, state_list = state_groups.items().pop()
-            state = {
-                (e.type, e.state_key): e
-                for e in state_list
-            }
-            prev_state = state.get((event_type, state_key), None)
-            if prev_state:
-                prev_state = prev_state.event_id
-                prev_states = [prev_state]
-            else:
-                prev_states = []
+            logger.debug(
+                "resolve_state_groups state_groups %s",
+                state_groups.keys()
+            )
+
+            group_names = frozenset(state_groups.keys())
 
-            if self._state_cache is not None:
+            if len(group_names) == 1:
+                name, state_list = state_groups.items().pop()
                 cache = _StateCacheEntry(
-                    state=state,
+                    state=StateMap.from_events(state_list),
                     state_group=name,
                     ts=self.clock.time_msec()
                 )
+            else:
+                new_state, conflicted = self._resolve_state_sets(
+                    state_groups.values()
+                )
+                cache = _StateCacheEntry(
+                    state=new_state,
+                    state_group=None,
+                    ts=self.clock.time_msec(),
+                    conflicted=conflicted,
+                )
 
-                self._state_cache[frozenset(event_ids)] = cache
-
-            defer.returnValue((name, state, prev_states))
-
-        new_state, prev_states = self._resolve_events(
-            state_groups.values(), event_type, state_key
-        )
+        if self._resolved_state_cache is not None:
+            self._resolved_state_cache[group_names] = cache
 
         if self._state_cache is not None:
-            cache = _StateCacheEntry(
-                state=new_state,
-                state_group=None,
-                ts=self.clock.time_msec()
-            )
-
             self._state_cache[frozenset(event_ids)] = cache
 
-        defer.returnValue((None, new_state, prev_states))
+        defer.returnValue((
+            cache.state_group,
+            cache.state,
+            cache.get_prev_states(event_type, state_key),
+        ))
 
     def resolve_events(self, state_sets, event):
         if event.is_state():
@@ -259,54 +284,72 @@ class StateHandler(object):
 
     def _resolve_events(self, state_sets, event_type=None, state_key=""):
         """
-        :returns a tuple (new_state, prev_states). new_state is a map
+        :returns a tuple (new_state, prev_states). new_state is a StateMap
         from (type, state_key) to event. prev_states is a list of event_ids.
-        :rtype: (dict[(str, str), synapse.events.FrozenEvent], list[str])
+        :rtype: (StateMap, list[str])
         """
-        state = {}
-        for st in state_sets:
-            for e in st:
-                state.setdefault(
-                    (e.type, e.state_key),
-                    {}
-                )[e.event_id] = e
-
-        unconflicted_state = {
-            k: v.values()[0] for k, v in state.items()
-            if len(v.values()) == 1
-        }
-
-        conflicted_state = {
-            k: v.values()
-            for k, v in state.items()
-            if len(v.values()) > 1
-        }
+        new_state, conflicted = self._resolve_state_sets(state_sets)
 
         if event_type:
-            prev_states_events = conflicted_state.get(
-                (event_type, state_key), []
-            )
-            prev_states = [s.event_id for s in prev_states_events]
+            prev_states = list(conflicted.get((event_type, state_key), []))
         else:
             prev_states = []
 
+        return new_state, prev_states
+
+    def _resolve_state_sets(self, state_sets):
+        """ Merges the given state sets, resolving the keys they disagree on.
+
+        Rather than building up the full list of candidates for every key, we
+        start from the largest set and only look at the keys where the others
+        differ from it. Typically the sets share almost all of their state, so
+        this only leaves a handful of keys to actually resolve.
+
+        :returns a tuple (new_state, conflicted). new_state is a StateMap
+        from (type, state_key) to event. conflicted is a map from (type, state_key)
+        to the list of event_ids that were resolved between for that key.
+        """
+        state_sets = sorted(state_sets, key=len, reverse=True)
+        if not state_sets:
+            return StateMap(), {}
+
+        new_state = {
+            (e.type, e.state_key): e
+            for e in state_sets[0]
+        }
+
+        conflicted_state = {}
+        for st in state_sets[1:]:
+            for e in st:
+                key = (e.type, e.state_key)
+                existing = new_state.setdefault(key, e)
+                if existing.event_id != e.event_id:
+                    conflicted_state.setdefault(
+                        key, {existing.event_id: existing}
+                    )[e.event_id] = e
+
+        if not conflicted_state:
+            return StateMap(new_state), {}
+
         auth_events = {
-            k: e for k, e in unconflicted_state.items()
-            if k[0] in AuthEventTypes
+            k: e for k, e in new_state.items()
+            if k[0] in AuthEventTypes and k not in conflicted_state
         }
 
         try:
             resolved_state = self._resolve_state_events(
-                conflicted_state, auth_events
+                {k: v.values() for k, v in conflicted_state.items()},
+                auth_events,
             )
         except:
             logger.exception("Failed to resolve state")
             raise
 
-        new_state = unconflicted_state
         new_state.update(resolved_state)
 
-        return new_state, prev_states
+        return StateMap(new_state), {
+            k: v.keys() for k, v in conflicted_state.items()
+        }
 
     @log_function
     def _resolve_state_events(self, conflicted_state, auth_events):
@@ -361,20 +404,30 @@ class StateHandler(object):
     def _resolve_auth_events(self, events, auth_events):
         reverse = [i for i in reversed(self._ordered_events(events))]
 
-        auth_events = dict(auth_events)
-
-        prev_event = reverse[0]
-        for event in reverse[1:]:
-            auth_events[(prev_event.type, prev_event.state_key)] = prev_event
-            try:
-                # FIXME: hs.get_auth() is bad style, but we need to do it to
-                # get around circular deps.
-                self.hs.get_auth().check(event, auth_events)
-                prev_event = event
-            except AuthError:
-                return prev_event
+        # auth_events may well hold the membership of everyone in the room,
+        # so rather than copying it we overwrite the one key that we are
+        # resolving and put it back again afterwards.
+        key = (reverse[0].type, reverse[0].state_key)
+        original = auth_events.get(key)
 
-        return event
+        try:
+            prev_event = reverse[0]
+            for event in reverse[1:]:
+                auth_events[key] = prev_event
+                try:
+                    # FIXME: hs.get_auth() is bad style, but we need to do it
+                    # to get around circular deps.
+                    self.hs.get_auth().check(event, auth_events)
+                    prev_event = event
+                except AuthError:
+                    return prev_event
+
+            return event
+        finally:
+            if original is None:
+                auth_events.pop(key, None)
+            else:
+                auth_events[key] = original
 
     def _resolve_normal_events(self, events, auth_events):
         for event in self._ordered_events(events):
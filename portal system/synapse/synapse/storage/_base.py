@@ -45,6 +45,11 @@ sql_query_timer = metrics.register_distribution("query_time", labels=["verb"])
 sql_txn_timer = metrics.register_distribution("transaction_time", labels=["desc"])
 
 
+# The default number of rows _stream_query_txn and stream_query fetch at a
+# time.
+STREAM_CHUNK_SIZE = 1000
+
+
 class LoggingTransaction(object):
     """An object that almost-transparently proxies for the 'txn' object
     passed to the constructor. Adds logging and metrics to the .execute()
@@ -354,6 +359,80 @@ class SQLBaseStore(object):
         )
         return results
 
+    def _stream_query_txn(self, txn, sql, args=(), chunk_size=STREAM_CHUNK_SIZE):
+        """Runs a query and yields its rows in lists of at most chunk_size
+        rows, without ever holding the full result set in memory.
+
+        On PostgreSQL this uses a named server side cursor, on SQLite the
+        statement is stepped through as rows are fetched. The next chunk isn't
+        fetched until the caller asks for it.
+
+        Args:
+            txn : The transaction to run the query in.
+            sql (str): The query to run.
+            args (list): The query args.
+            chunk_size (int): The maximum number of rows to yield at once.
+        Returns:
+            A generator of lists of row tuples.
+        """
+        cursor = LoggingTransaction(
+            self.database_engine.create_streaming_cursor(txn.connection),
+            txn.name, self.database_engine, txn.after_callbacks,
+        )
+        try:
+            cursor.execute(sql, args)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    @defer.inlineCallbacks
+    def stream_query(self, desc, consumer, sql, from_key,
+                     chunk_size=STREAM_CHUNK_SIZE):
+        """Runs a keyset paginated query a batch at a time, passing each batch
+        of rows to the consumer.
+
+        Each batch is fetched in its own transaction, and the consumer is only
+        called once that has finished, so it is free to use the database. The
+        next batch isn't fetched until the consumer is done with the last
+        one, so a slow consumer holds back the scan instead of rows piling up
+        in memory.
+
+        Args:
+            desc (str): The name of the transactions.
+            consumer (func): Called with each list of row tuples. May return a
+                deferred.
+            sql (str): The query to run. It is given the key to start after
+                and the maximum number of rows to return, and must return rows
+                ordered by a unique key in their first column, e.g.
+                "SELECT id, ... FROM t WHERE id > ? ORDER BY id LIMIT ?".
+            from_key: The key to start after.
+            chunk_size (int): The maximum number of rows in each batch.
+        Returns:
+            Deferred: The total number of rows streamed.
+        """
+        def stream_query_txn(txn, key):
+            txn.execute(sql, (key, chunk_size))
+            return txn.fetchall()
+
+        count = 0
+        while True:
+            rows = yield self.runInteraction(desc, stream_query_txn, from_key)
+            if not rows:
+                break
+
+            yield consumer(rows)
+            count += len(rows)
+
+            if len(rows) < chunk_size:
+                break
+            from_key = rows[-1][0]
+
+        defer.returnValue(count)
+
     def _execute(self, desc, decoder, query, *args):
         """Runs a single query for a result set.
 
@@ -84,9 +84,23 @@ class BackgroundUpdateStore(SQLBaseStore):
         self._background_update_queue = []
         self._background_update_handlers = {}
         self._background_update_timer = None
+        self._background_updates_running = False
 
     @defer.inlineCallbacks
     def start_doing_background_updates(self):
+        # Updates can be queued while the server is running, so this may be
+        # called again while we're still working through the queue.
+        if self._background_updates_running:
+            return
+
+        self._background_updates_running = True
+        try:
+            yield self._do_background_updates_until_done()
+        finally:
+            self._background_updates_running = False
+
+    @defer.inlineCallbacks
+    def _do_background_updates_until_done(self):
         while True:
             if self._background_update_timer is not None:
                 return
@@ -17,6 +17,8 @@ from synapse.storage.prepare_database import prepare_database
 
 from ._base import IncorrectDatabaseSetup
 
+import itertools
+
 
 class PostgresEngine(object):
     single_threaded = False
@@ -24,6 +26,7 @@ class PostgresEngine(object):
     def __init__(self, database_module):
         self.module = database_module
         self.module.extensions.register_type(self.module.extensions.UNICODE)
+        self._streaming_cursor_ids = itertools.count()
 
     def check_database(self, txn):
         txn.execute("SHOW SERVER_ENCODING")
@@ -56,3 +59,10 @@ class PostgresEngine(object):
 
     def lock_table(self, txn, table):
         txn.execute("LOCK TABLE %s in EXCLUSIVE MODE" % (table,))
+
+    def create_streaming_cursor(self, conn):
+        """Returns a named, server side cursor that fetches rows from the
+        server as they are asked for, rather than all at once.
+        """
+        cursor_id = next(self._streaming_cursor_ids)
+        return conn.cursor(name="synapse_stream_%d" % (cursor_id,))
@@ -49,6 +49,10 @@ class Sqlite3Engine(object):
     def lock_table(self, txn, table):
         return
 
+    def create_streaming_cursor(self, conn):
+        # SQLite steps through the results as they are fetched anyway.
+        return conn.cursor()
+
 
 # Following functions taken from: https://github.com/coleifer/peewee
 
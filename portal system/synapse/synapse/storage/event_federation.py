@@ -15,7 +15,8 @@
 
 from twisted.internet import defer
 
-from ._base import SQLBaseStore
+from .background_updates import BackgroundUpdateStore
+from synapse.util.async import ObservableDeferred
 from synapse.util.caches.descriptors import cached
 from unpaddedbase64 import encode_base64
 
@@ -26,7 +27,7 @@ from Queue import PriorityQueue, Empty
 logger = logging.getLogger(__name__)
 
 
-class EventFederationStore(SQLBaseStore):
+class EventFederationStore(BackgroundUpdateStore):
     """ Responsible for storing and serving up the various graphs associated
     with an event. Including the main event graph and the auth chains for an
     event.
@@ -34,8 +35,23 @@ class EventFederationStore(SQLBaseStore):
     Also has methods for getting the front (latest) and back (oldest) edges
     of the event graphs. These are used to generate the parents for new events
     and backfilling from another server respectively.
+
+    The auth chains of state events are indexed in `event_auth_chains`, which
+    holds the transitive closure of `event_auth` for each state event
+    (including a row mapping the event to itself, which marks it as indexed).
+    Only state events can be auth events, so this is enough to answer any
+    auth chain query in a fixed number of queries.
     """
 
+    EVENT_AUTH_CHAINS_UPDATE_NAME = "event_auth_chains"
+
+    def __init__(self, hs):
+        super(EventFederationStore, self).__init__(hs)
+        self.register_background_update_handler(
+            self.EVENT_AUTH_CHAINS_UPDATE_NAME,
+            self._background_index_auth_chains,
+        )
+
     def get_auth_chain(self, event_ids):
         return self.get_auth_chain_ids(event_ids).addCallback(self._get_events)
 
@@ -55,11 +71,21 @@ class EventFederationStore(SQLBaseStore):
 
         front = set(event_ids)
         while front:
+            # Pull in the whole chain of anything that has been indexed, and
+            # only walk event_auth for the rest. Usually that is just the
+            # (unindexed) non-state events we started with, whose auth events
+            # are then all indexed.
+            chains = self._get_auth_chain_closures_txn(txn, front)
+            for event_id, chain in chains.items():
+                results.update(
+                    auth_id for auth_id in chain if auth_id != event_id
+                )
+
             new_front = set()
-            front_list = list(front)
+            front_list = list(front - set(chains))
             chunks = [
                 front_list[x:x+100]
-                for x in xrange(0, len(front), 100)
+                for x in xrange(0, len(front_list), 100)
             ]
             for chunk in chunks:
                 txn.execute(
@@ -75,6 +101,238 @@ class EventFederationStore(SQLBaseStore):
 
         return list(results)
 
+    def _get_auth_chain_closures_txn(self, txn, event_ids):
+        """Fetches the indexed auth chains of the given events.
+
+        Returns:
+            dict: event_id -> set of event_ids in its auth chain, including
+            the event itself. Events which haven't been indexed are omitted.
+        """
+        chains = {}
+
+        sql = (
+            "SELECT event_id, auth_id FROM event_auth_chains"
+            " WHERE event_id IN (%s)"
+        )
+
+        event_ids = list(event_ids)
+        for i in xrange(0, len(event_ids), 100):
+            chunk = event_ids[i:i+100]
+            txn.execute(sql % (",".join(["?"] * len(chunk)),), chunk)
+            for event_id, auth_id in txn.fetchall():
+                chains.setdefault(event_id, set()).add(auth_id)
+
+        return chains
+
+    def _store_auth_chain_index_txn(self, txn, event_to_auth_ids):
+        """Indexes the auth chains of the given state events.
+
+        An event can only be indexed once all of its auth events have been, so
+        any events whose auth events are missing (or unindexed) are queued in
+        `event_auth_chains_to_calculate` until they are. Whenever events are
+        indexed, any queued events waiting on them are retried. In the
+        meantime queued events are answered by the slow path in
+        `_get_auth_chain_ids_txn`.
+
+        Args:
+            txn
+            event_to_auth_ids (dict): state event_id -> list of the ids of
+                its auth events.
+        Returns:
+            int: The number of events that were indexed, including any
+            previously queued ones.
+        """
+        if not event_to_auth_ids:
+            return 0
+
+        event_to_auth_ids = dict(event_to_auth_ids)
+
+        chains = self._get_auth_chain_closures_txn(txn, set(
+            auth_id
+            for auth_ids in event_to_auth_ids.values()
+            for auth_id in auth_ids
+        ).union(event_to_auth_ids))
+
+        to_index = set(
+            event_id for event_id in event_to_auth_ids
+            if event_id not in chains
+        )
+        queued = set()
+
+        rows = []
+        indexed = set()
+        # Events may be auth events of others in the same batch, or of queued
+        # ones, so keep going until we stop making progress.
+        while to_index:
+            newly_indexed = []
+            for event_id in to_index:
+                auth_ids = event_to_auth_ids[event_id]
+                if not all(auth_id in chains for auth_id in auth_ids):
+                    continue
+
+                chain = set([event_id])
+                for auth_id in auth_ids:
+                    chain.update(chains[auth_id])
+                chains[event_id] = chain
+                newly_indexed.append(event_id)
+
+                rows.extend(
+                    {"event_id": event_id, "auth_id": auth_id}
+                    for auth_id in chain
+                )
+
+            if not newly_indexed:
+                break
+
+            to_index.difference_update(newly_indexed)
+            indexed.update(newly_indexed)
+
+            waiting = self._get_queued_auth_chain_dependents_txn(
+                txn, newly_indexed
+            )
+            for event_id, auth_ids in waiting.items():
+                if event_id in event_to_auth_ids:
+                    continue
+                event_to_auth_ids[event_id] = auth_ids
+                queued.add(event_id)
+                to_index.add(event_id)
+
+            chains.update(self._get_auth_chain_closures_txn(txn, set(
+                auth_id
+                for auth_ids in waiting.values()
+                for auth_id in auth_ids
+                if auth_id not in chains
+            )))
+
+        self._simple_insert_many_txn(
+            txn,
+            table="event_auth_chains",
+            values=rows,
+        )
+
+        self._dequeue_auth_chain_events_txn(txn, indexed)
+        self._queue_auth_chain_events_txn(txn, to_index - queued)
+
+        return len(indexed)
+
+    def _get_queued_auth_chain_dependents_txn(self, txn, event_ids):
+        """Fetches the queued events which have any of the given events as an
+        auth event.
+
+        Returns:
+            dict: event_id -> list of the ids of its auth events.
+        """
+        results = {}
+
+        sql = (
+            "SELECT a.event_id, a.auth_id FROM event_auth AS a"
+            " INNER JOIN event_auth_chains_to_calculate AS c USING (event_id)"
+            " WHERE a.event_id IN ("
+            "  SELECT event_id FROM event_auth WHERE auth_id IN (%s)"
+            " )"
+        )
+
+        event_ids = list(event_ids)
+        for i in xrange(0, len(event_ids), 100):
+            chunk = event_ids[i:i+100]
+            txn.execute(sql % (",".join(["?"] * len(chunk)),), chunk)
+            for event_id, auth_id in txn.fetchall():
+                results.setdefault(event_id, set()).add(auth_id)
+
+        return {
+            event_id: list(auth_ids)
+            for event_id, auth_ids in results.items()
+        }
+
+    def _queue_auth_chain_events_txn(self, txn, event_ids):
+        event_ids = list(event_ids)
+        for i in xrange(0, len(event_ids), 100):
+            chunk = event_ids[i:i+100]
+            txn.execute(
+                "SELECT event_id FROM event_auth_chains_to_calculate"
+                " WHERE event_id IN (%s)" % (",".join(["?"] * len(chunk)),),
+                chunk
+            )
+            already_queued = set(r[0] for r in txn.fetchall())
+
+            self._simple_insert_many_txn(
+                txn,
+                table="event_auth_chains_to_calculate",
+                values=[
+                    {"event_id": event_id}
+                    for event_id in chunk
+                    if event_id not in already_queued
+                ],
+            )
+
+    def _dequeue_auth_chain_events_txn(self, txn, event_ids):
+        event_ids = list(event_ids)
+        for i in xrange(0, len(event_ids), 100):
+            chunk = event_ids[i:i+100]
+            txn.execute(
+                "DELETE FROM event_auth_chains_to_calculate"
+                " WHERE event_id IN (%s)" % (",".join(["?"] * len(chunk)),),
+                chunk
+            )
+
+    @defer.inlineCallbacks
+    def _background_index_auth_chains(self, progress, batch_size):
+        min_stream_id = progress["min_stream_id_inclusive"]
+        max_stream_id = progress["max_stream_id_exclusive"]
+        rows_indexed = progress.get("rows_indexed", 0)
+
+        def index_auth_chains_txn(txn):
+            txn.execute(
+                "SELECT e.stream_ordering, e.event_id FROM events AS e"
+                " INNER JOIN state_events USING (event_id)"
+                " WHERE ? <= e.stream_ordering AND e.stream_ordering < ?"
+                " ORDER BY e.stream_ordering ASC"
+                " LIMIT ?",
+                (min_stream_id, max_stream_id, batch_size)
+            )
+            rows = txn.fetchall()
+            if not rows:
+                return 0
+
+            event_to_auth_ids = {event_id: [] for _, event_id in rows}
+            event_ids = list(event_to_auth_ids)
+            for i in xrange(0, len(event_ids), 100):
+                chunk = event_ids[i:i+100]
+                txn.execute(
+                    "SELECT event_id, auth_id FROM event_auth"
+                    " WHERE event_id IN (%s)" % (
+                        ",".join(["?"] * len(chunk)),
+                    ),
+                    chunk
+                )
+                for event_id, auth_id in txn.fetchall():
+                    event_to_auth_ids[event_id].append(auth_id)
+
+            indexed = self._store_auth_chain_index_txn(txn, event_to_auth_ids)
+
+            progress = {
+                "min_stream_id_inclusive": rows[-1][0] + 1,
+                "max_stream_id_exclusive": max_stream_id,
+                "rows_indexed": rows_indexed + indexed,
+            }
+
+            self._background_update_progress_txn(
+                txn, self.EVENT_AUTH_CHAINS_UPDATE_NAME, progress
+            )
+
+            return len(rows)
+
+        result = yield self.runInteraction(
+            self.EVENT_AUTH_CHAINS_UPDATE_NAME, index_auth_chains_txn
+        )
+
+        if not result:
+            yield self._end_background_update(
+                self.EVENT_AUTH_CHAINS_UPDATE_NAME
+            )
+
+        defer.returnValue(result)
+
     def get_oldest_events_in_room(self, room_id):
         return self.runInteraction(
             "get_oldest_events_in_room",
@@ -114,6 +372,7 @@ class EventFederationStore(SQLBaseStore):
             retcol="event_id",
         )
 
+    @cached()
     def get_latest_events_in_room(self, room_id):
         return self.runInteraction(
             "get_latest_events_in_room",
@@ -288,6 +547,45 @@ class EventFederationStore(SQLBaseStore):
             txn.call_after(
                 self.get_latest_event_ids_in_room.invalidate, (room_id,)
             )
+            txn.call_after(
+                self.get_latest_events_in_room.invalidate, (room_id,)
+            )
+
+    def _refresh_latest_events_in_room_txn(self, txn, events):
+        """Re-reads the forward extremities of the rooms the given events are
+        in, and replaces the cached copies once the transaction commits.
+
+        This must be called after `_update_extremeties` once the events have
+        been fully stored. Rather than dropping the cached extremities and
+        making the next event sent in the room fetch them again, we read them
+        back while we're here. (We don't try to work out the change in memory
+        since, e.g. when backfilling, whether an event becomes an extremity
+        depends on edges we may not have to hand.)
+        """
+        room_ids = set(
+            ev.room_id for ev in events
+            if not ev.internal_metadata.is_outlier()
+        )
+
+        for room_id in room_ids:
+            latest = self._get_latest_events_in_room(txn, room_id)
+            txn.call_after(
+                self._prefill_latest_events_in_room, room_id, latest
+            )
+
+    def _prefill_latest_events_in_room(self, room_id, latest):
+        """Replaces the cached forward extremities of the room.
+
+        Args:
+            room_id (str)
+            latest (list): The result of `_get_latest_events_in_room`
+        """
+        for cache, value in (
+            (self.get_latest_events_in_room, latest),
+            (self.get_latest_event_ids_in_room, [e_id for e_id, _, _ in latest]),
+        ):
+            cache.invalidate((room_id,))
+            cache.prefill((room_id,), ObservableDeferred(defer.succeed(value)))
 
     def get_backfill_events(self, room_id, event_list, limit):
         """Get a list of Events for a given topic that occurred before (and
@@ -430,3 +728,4 @@ class EventFederationStore(SQLBaseStore):
 
         txn.execute(query, (room_id,))
         txn.call_after(self.get_latest_event_ids_in_room.invalidate, (room_id,))
+        txn.call_after(self.get_latest_events_in_room.invalidate, (room_id,))
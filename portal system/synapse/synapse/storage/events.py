@@ -12,7 +12,8 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from _base import SQLBaseStore, _RollbackButIsFineException
+from _base import _RollbackButIsFineException
+from .background_updates import BackgroundUpdateStore
 
 from twisted.internet import defer, reactor
 
@@ -21,6 +22,7 @@ from synapse.events.utils import prune_event
 
 from synapse.util.logcontext import preserve_context_over_deferred
 from synapse.util.logutils import log_function
+from synapse.util.jsoncompression import event_json_compressor
 from synapse.api.constants import EventTypes
 
 from canonicaljson import encode_canonical_json
@@ -50,7 +52,18 @@ EVENT_QUEUE_ITERATIONS = 3  # No. times we block waiting for requests for events
 EVENT_QUEUE_TIMEOUT_S = 0.1  # Timeout when waiting for requests for events
 
 
-class EventsStore(SQLBaseStore):
+class EventsStore(BackgroundUpdateStore):
+
+    EVENT_JSON_COMPRESSION_UPDATE_NAME = "event_json_compression"
+
+    def __init__(self, hs):
+        super(EventsStore, self).__init__(hs)
+        self._compress_event_json = hs.config.event_json_compression
+        self.register_background_update_handler(
+            self.EVENT_JSON_COMPRESSION_UPDATE_NAME,
+            self._background_compress_event_json,
+        )
+
     @defer.inlineCallbacks
     def persist_events(self, events_and_contexts, backfilled=False,
                        is_new_state=True):
@@ -76,6 +89,7 @@ class EventsStore(SQLBaseStore):
         with stream_ordering_manager as stream_orderings:
             for (event, _), stream in zip(events_and_contexts, stream_orderings):
                 event.internal_metadata.stream_ordering = stream
+                yield self._event_stream_has_changed(event, stream)
 
             chunks = [
                 events_and_contexts[x:x+100]
@@ -115,6 +129,7 @@ class EventsStore(SQLBaseStore):
         try:
             with stream_ordering_manager as stream_ordering:
                 event.internal_metadata.stream_ordering = stream_ordering
+                yield self._event_stream_has_changed(event, stream_ordering)
                 yield self.runInteraction(
                     "persist_event",
                     self._persist_event_txn,
@@ -130,6 +145,19 @@ class EventsStore(SQLBaseStore):
         max_persisted_id = yield self._stream_id_gen.get_max_token(self)
         defer.returnValue((stream_ordering, max_persisted_id))
 
+    @defer.inlineCallbacks
+    def _event_stream_has_changed(self, event, stream_ordering):
+        """Record the event in the stream change caches, so that the room
+        (and, for membership events, the user) is known to have changed.
+        """
+        yield self._events_stream_cache.entity_has_changed(
+            event.room_id, stream_ordering
+        )
+        if event.type == EventTypes.Member:
+            yield self._membership_stream_cache.entity_has_changed(
+                event.state_key, stream_ordering
+            )
+
     @defer.inlineCallbacks
     def get_event(self, event_id, check_redacted=True,
                   get_prev_content=False, allow_rejected=False,
@@ -161,6 +189,32 @@ class EventsStore(SQLBaseStore):
 
         defer.returnValue(events[0] if events else None)
 
+    @defer.inlineCallbacks
+    def get_events(self, event_ids, check_redacted=True,
+                   get_prev_content=False, allow_rejected=False):
+        """Get events from the database by event_id.
+
+        Args:
+            event_ids (list): The event_ids of the events to fetch
+            check_redacted (bool): If True, check if events have been redacted
+                and redact them.
+            get_prev_content (bool): If True and event is a state event,
+                include the previous states content in the unsigned field.
+            allow_rejected (bool): If True return rejected events.
+
+        Returns:
+            Deferred : Dict from event_id to FrozenEvent. Events which
+            couldn't be found are left out.
+        """
+        events = yield self._get_events(
+            event_ids,
+            check_redacted=check_redacted,
+            get_prev_content=get_prev_content,
+            allow_rejected=allow_rejected,
+        )
+
+        defer.returnValue({e.event_id: e for e in events})
+
     @log_function
     def _persist_event_txn(self, txn, event, context, backfilled,
                            is_new_state=True, current_state=None):
@@ -172,6 +226,10 @@ class EventsStore(SQLBaseStore):
             txn.call_after(self.get_users_in_room.invalidate, (event.room_id,))
             txn.call_after(self.get_joined_hosts_for_room.invalidate, (event.room_id,))
             txn.call_after(self.get_room_name_and_aliases, event.room_id)
+            txn.call_after(
+                self._set_current_state_ids_cache, event.room_id,
+                {(s.type, s.state_key): s.event_id for s in current_state},
+            )
 
             self._simple_delete_txn(
                 txn,
@@ -217,6 +275,21 @@ class EventsStore(SQLBaseStore):
         for room_id, depth in depth_updates.items():
             self._update_min_depth_for_room_txn(txn, room_id, depth)
 
+        # Events can land in the middle of a room's history, e.g. when
+        # backfilling, so drop any pagination read-ahead they might affect.
+        min_depths = {}
+        for event, _ in events_and_contexts:
+            if event.internal_metadata.is_outlier():
+                continue
+            min_depths[event.room_id] = min(
+                event.depth, min_depths.get(event.room_id, event.depth)
+            )
+
+        for room_id, depth in min_depths.items():
+            txn.call_after(
+                self._invalidate_read_ahead_for_room, room_id, depth
+            )
+
         txn.execute(
             "SELECT event_id, outlier FROM events WHERE event_id in (%s)" % (
                 ",".join(["?"] * len(events_and_contexts)),
@@ -282,6 +355,7 @@ class EventsStore(SQLBaseStore):
                 )
 
                 self._update_extremeties(txn, [event])
+                self._refresh_latest_events_in_room_txn(txn, [event])
 
         events_and_contexts = filter(
             lambda ec: ec[0] not in to_remove,
@@ -335,18 +409,30 @@ class EventsStore(SQLBaseStore):
                 ]
             }
 
+        def event_json_values(event):
+            event_json = encode_json(event_dict(event))
+            if self._compress_event_json:
+                return {
+                    "json": "",
+                    "compressed_json": buffer(
+                        event_json_compressor.compress(event_json)
+                    ),
+                }
+            else:
+                return {"json": event_json.decode("UTF-8")}
+
         self._simple_insert_many_txn(
             txn,
             table="event_json",
             values=[
-                {
-                    "event_id": event.event_id,
-                    "room_id": event.room_id,
-                    "internal_metadata": encode_json(
+                dict(
+                    event_json_values(event),
+                    event_id=event.event_id,
+                    room_id=event.room_id,
+                    internal_metadata=encode_json(
                         event.internal_metadata.get_dict()
                     ).decode("UTF-8"),
-                    "json": encode_json(event_dict(event)).decode("UTF-8"),
-                }
+                )
                 for event, _ in events_and_contexts
             ],
         )
@@ -389,6 +475,12 @@ class EventsStore(SQLBaseStore):
             ],
         )
 
+        self._store_auth_chain_index_txn(txn, {
+            event.event_id: [auth_id for auth_id, _ in event.auth_events]
+            for event, _ in events_and_contexts
+            if event.is_state()
+        })
+
         self._store_event_reference_hashes_txn(
             txn, [event for event, _ in events_and_contexts]
         )
@@ -441,6 +533,10 @@ class EventsStore(SQLBaseStore):
                         self.get_current_state_for_key.invalidate,
                         (event.room_id, event.type, event.state_key,)
                     )
+                    txn.call_after(
+                        self._update_current_state_ids_cache, event.room_id,
+                        {(event.type, event.state_key): event.event_id},
+                    )
 
                     if event.type in [EventTypes.Name, EventTypes.Aliases]:
                         txn.call_after(
@@ -461,6 +557,10 @@ class EventsStore(SQLBaseStore):
                         }
                     )
 
+        self._refresh_latest_events_in_room_txn(
+            txn, [event for event, _ in events_and_contexts]
+        )
+
         return
 
     def _store_redaction(self, txn, event):
@@ -738,6 +838,7 @@ class EventsStore(SQLBaseStore):
                 " e.event_id as event_id, "
                 " e.internal_metadata,"
                 " e.json,"
+                " e.compressed_json,"
                 " r.redacts as redacts,"
                 " rej.event_id as rejects "
                 " FROM event_json as e"
@@ -749,6 +850,12 @@ class EventsStore(SQLBaseStore):
             txn.execute(sql, evs)
             rows.extend(self.cursor_to_dict(txn))
 
+        for row in rows:
+            if row["compressed_json"] is not None:
+                row["json"] = event_json_compressor.decompress(
+                    row["compressed_json"]
+                )
+
         return rows
 
     def _fetch_events_txn(self, txn, events, check_redacted=True,
@@ -948,8 +1055,8 @@ class EventsStore(SQLBaseStore):
 
             txn.execute(
                 "SELECT COUNT(*) as messages"
-                " FROM events NATURAL JOIN event_json"
-                " WHERE json like '%m.room.message%'"
+                " FROM events"
+                " WHERE type = 'm.room.message'"
                 " AND stream_ordering > ?"
                 " AND stream_ordering <= ?",
                 (
@@ -964,3 +1071,124 @@ class EventsStore(SQLBaseStore):
 
         ret = yield self.runInteraction("count_messages", _count_messages)
         defer.returnValue(ret)
+
+    def queue_event_json_compression(self):
+        """Queues a background update to compress any event JSON that was
+        stored before `event_json_compression` was turned on.
+
+        Returns:
+            A deferred that completes once the update has been queued, or once
+            we have decided that there is nothing to do.
+        """
+        def queue_event_json_compression_txn(txn):
+            existing = self._simple_select_one_onecol_txn(
+                txn,
+                table="background_updates",
+                keyvalues={
+                    "update_name": self.EVENT_JSON_COMPRESSION_UPDATE_NAME,
+                },
+                retcol="update_name",
+                allow_none=True,
+            )
+            if existing:
+                return
+
+            txn.execute(
+                "SELECT MIN(stream_ordering), MAX(stream_ordering)"
+                " FROM events AS e"
+                " INNER JOIN event_json AS j USING (event_id)"
+                " WHERE j.compressed_json IS NULL"
+            )
+            min_stream_id, max_stream_id = txn.fetchone()
+            if min_stream_id is None:
+                return
+
+            progress = {
+                "target_min_stream_id_inclusive": min_stream_id,
+                "max_stream_id_exclusive": max_stream_id + 1,
+                "rows_compressed": 0,
+            }
+
+            self._simple_insert_txn(
+                txn,
+                table="background_updates",
+                values={
+                    "update_name": self.EVENT_JSON_COMPRESSION_UPDATE_NAME,
+                    "progress_json": json.dumps(progress),
+                },
+            )
+            txn.call_after(self._clear_background_update_queue)
+
+        return self.runInteraction(
+            "queue_event_json_compression", queue_event_json_compression_txn
+        )
+
+    def _clear_background_update_queue(self):
+        # Forces do_background_update to pick up a newly queued update.
+        self._background_update_queue = []
+
+    @defer.inlineCallbacks
+    def _background_compress_event_json(self, progress, batch_size):
+        if not self._compress_event_json:
+            # Compression has been turned off again since the update was
+            # queued. It will be queued afresh if it is turned back on.
+            yield self._end_background_update(
+                self.EVENT_JSON_COMPRESSION_UPDATE_NAME
+            )
+            defer.returnValue(0)
+
+        target_min_stream_id = progress["target_min_stream_id_inclusive"]
+        max_stream_id = progress["max_stream_id_exclusive"]
+        rows_compressed = progress.get("rows_compressed", 0)
+
+        def compress_event_json_txn(txn):
+            txn.execute(
+                "SELECT e.stream_ordering, j.event_id, j.json"
+                " FROM events AS e"
+                " INNER JOIN event_json AS j USING (event_id)"
+                " WHERE ? <= e.stream_ordering AND e.stream_ordering < ?"
+                " AND j.compressed_json IS NULL"
+                " ORDER BY e.stream_ordering DESC"
+                " LIMIT ?",
+                (target_min_stream_id, max_stream_id, batch_size)
+            )
+            rows = txn.fetchall()
+            if not rows:
+                return 0
+
+            txn.executemany(
+                "UPDATE event_json SET json = '', compressed_json = ?"
+                " WHERE event_id = ?",
+                [
+                    (
+                        buffer(event_json_compressor.compress(
+                            js.encode("UTF-8")
+                        )),
+                        event_id,
+                    )
+                    for _, event_id, js in rows
+                ]
+            )
+
+            progress = {
+                "target_min_stream_id_inclusive": target_min_stream_id,
+                "max_stream_id_exclusive": rows[-1][0],
+                "rows_compressed": rows_compressed + len(rows),
+            }
+
+            self._background_update_progress_txn(
+                txn, self.EVENT_JSON_COMPRESSION_UPDATE_NAME, progress
+            )
+
+            return len(rows)
+
+        result = yield self.runInteraction(
+            self.EVENT_JSON_COMPRESSION_UPDATE_NAME, compress_event_json_txn
+        )
+
+        if not result:
+            yield self._end_background_update(
+                self.EVENT_JSON_COMPRESSION_UPDATE_NAME
+            )
+
+        defer.returnValue(result)
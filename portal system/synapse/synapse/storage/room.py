@@ -15,10 +15,11 @@
 
 from twisted.internet import defer
 
+from synapse.api.constants import EventTypes
 from synapse.api.errors import StoreError
 
 from ._base import SQLBaseStore
-from synapse.util.caches.descriptors import cachedInlineCallbacks
+from synapse.util.caches.descriptors import cached, cachedInlineCallbacks
 from .engines import PostgresEngine, Sqlite3Engine
 
 import collections
@@ -210,8 +211,47 @@ class RoomStore(SQLBaseStore):
             )
 
     def _store_history_visibility_txn(self, txn, event):
+        txn.call_after(
+            self.get_history_visibilities_for_room.invalidate, (event.room_id,)
+        )
         self._store_content_index_txn(txn, event, "history_visibility")
 
+    @cached(max_entries=5000)
+    def get_history_visibilities_for_room(self, room_id):
+        """Get every history visibility that the room has had, including
+        "shared" if it has had the default at any point.
+
+        Outliers are included, as they can still be part of the state at an
+        event.
+
+        Args:
+            room_id (str): The room to look in.
+        Returns:
+            Deferred: Results in a set of history visibilities.
+        """
+        def f(txn):
+            sql = (
+                "SELECT h.history_visibility"
+                " FROM state_events AS s"
+                " LEFT JOIN history_visibility AS h"
+                " ON h.event_id = s.event_id"
+                " LEFT JOIN rejections AS rej ON rej.event_id = s.event_id"
+                " WHERE s.room_id = ? AND s.type = ? AND s.state_key = ?"
+                " AND rej.event_id IS NULL"
+            )
+
+            txn.execute(sql, (room_id, EventTypes.RoomHistoryVisibility, ""))
+
+            # Rooms start off with the default, and an event without a
+            # history_visibility key resets the visibility to it.
+            visibilities = set(["shared"])
+            visibilities.update(
+                visibility or "shared" for visibility, in txn.fetchall()
+            )
+            return visibilities
+
+        return self.runInteraction("get_history_visibilities_for_room", f)
+
     def _store_guest_access_txn(self, txn, event):
         self._store_content_index_txn(txn, event, "guest_access")
 
@@ -0,0 +1,33 @@
+/* Copyright 2015 OpenMarket Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+
+/* Maps the hash of the contents of a state group to the first state group in
+ * the room with those contents. Filled in by the state group deduplication
+ * background update. */
+CREATE TABLE IF NOT EXISTS state_group_hashes(
+    room_id TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    state_group BIGINT NOT NULL,
+    UNIQUE (room_id, hash)
+);
+
+CREATE INDEX event_to_state_groups_state_group
+    ON event_to_state_groups(state_group);
+
+/* There's nothing to do on a new database. */
+INSERT into background_updates (update_name, progress_json)
+    SELECT 'state_group_dedup', '{}'
+    WHERE EXISTS (SELECT * FROM state_groups);
@@ -0,0 +1,29 @@
+/* Copyright 2015 OpenMarket Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+
+/* The latest snapshot of the rooms of an initial /sync for each user and
+ * filter, which later initial syncs can start from. The snapshot JSON refers
+ * to events by event_id. */
+CREATE TABLE IF NOT EXISTS sync_snapshots(
+    user_id TEXT NOT NULL,
+    filter_key TEXT NOT NULL,
+    stream_token TEXT NOT NULL,
+    ts BIGINT NOT NULL,
+    snapshot_json TEXT NOT NULL,
+    UNIQUE (user_id, filter_key)
+);
+
+CREATE INDEX sync_snapshots_ts ON sync_snapshots(ts);
@@ -13,19 +13,36 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from ._base import SQLBaseStore
+from .background_updates import BackgroundUpdateStore
+from .engines import PostgresEngine
+from synapse.util.async import ObservableDeferred
 from synapse.util.caches.descriptors import (
     cached, cachedInlineCallbacks, cachedList
 )
 
 from twisted.internet import defer
 
+import synapse.metrics
+
+import hashlib
 import logging
 
 logger = logging.getLogger(__name__)
 
+metrics = synapse.metrics.get_metrics_for(__name__)
+
+dedup_groups_examined_counter = metrics.register_counter(
+    "dedup_state_groups_examined"
+)
+dedup_groups_merged_counter = metrics.register_counter(
+    "dedup_state_groups_merged"
+)
+dedup_rows_deleted_counter = metrics.register_counter(
+    "dedup_state_group_rows_deleted"
+)
 
-class StateStore(SQLBaseStore):
+
+class StateStore(BackgroundUpdateStore):
     """ Keeps track of the state at a given event.
 
     This is done by the concept of `state groups`. Every event is a assigned
@@ -42,8 +59,34 @@ class StateStore(SQLBaseStore):
         room id.
       * `event_to_state_groups`: Maps events to state groups.
       * `state_groups_state`: Maps state group to state events.
+
+    Forks, backfill and outliers can leave a room with many state groups that
+    have exactly the same state. The `state_group_dedup` background update
+    merges them: it hashes the contents of each group, remembering the first
+    group in the room with each hash in `state_group_hashes`, and points the
+    events of any later group with the same hash at that first group. The
+    state of the later group is deleted by the next batch of the update,
+    after repointing any events that were added to it in the meantime. The
+    update is re-queued periodically to pick up groups created since it last
+    ran.
     """
 
+    STATE_GROUP_DEDUP_UPDATE_NAME = "state_group_dedup"
+    STATE_GROUP_DEDUP_INTERVAL_MS = 60 * 60 * 1000
+
+    def __init__(self, hs):
+        super(StateStore, self).__init__(hs)
+
+        # Map from state groups that have been merged away to the state group
+        # they were merged into. Events can be persisted with a state group
+        # that was looked up before the merge, so those get redirected.
+        self._merged_state_groups = {}
+
+        self.register_background_update_handler(
+            self.STATE_GROUP_DEDUP_UPDATE_NAME,
+            self._background_deduplicate_state_groups,
+        )
+
     @defer.inlineCallbacks
     def get_state_groups(self, room_id, event_ids):
         """ Get the state groups for the given list of event_ids
@@ -65,6 +108,32 @@ class StateStore(SQLBaseStore):
             for group, state_map in group_to_state.items()
         })
 
+    @defer.inlineCallbacks
+    def get_state_group_ids(self, room_id, event_ids):
+        """ Get the ids of the state groups for the given list of event_ids,
+        without loading their state.
+
+        The return value is the set of state group ids, as would be the keys
+        of the dict returned by `get_state_groups`.
+        """
+        if not event_ids:
+            defer.returnValue(set())
+
+        event_to_groups = yield self._get_state_group_for_events(
+            event_ids,
+        )
+
+        defer.returnValue(set(event_to_groups.values()))
+
+    def get_state_group_for_events(self, event_ids):
+        """ Get the state group of each of the given events.
+
+        Returns:
+            Deferred: Results in a dict mapping event_id to state group,
+            which is None for events without one (e.g. outliers).
+        """
+        return self._get_state_group_for_events(event_ids)
+
     def _store_state_groups_txn(self, txn, event, context):
         return self._store_mult_state_groups_txn(txn, [(event, context)])
 
@@ -75,13 +144,17 @@ class StateStore(SQLBaseStore):
                 continue
 
             if context.state_group is not None:
-                state_groups[event.event_id] = context.state_group
+                state_groups[event.event_id] = self._get_merged_state_group(
+                    context.state_group
+                )
                 continue
 
-            state_events = dict(context.current_state)
+            state_events = context.current_state
 
             if event.is_state():
-                state_events[(event.type, event.state_key)] = event
+                state_events = state_events.set(
+                    (event.type, event.state_key), event
+                )
 
             state_group = self._state_groups_id_gen.get_next_txn(txn)
             self._simple_insert_txn(
@@ -123,82 +196,352 @@ class StateStore(SQLBaseStore):
             ],
         )
 
+    def _get_merged_state_group(self, state_group):
+        """Returns the state group that the given state group was merged into
+        by the dedup background update, or the group itself if it hasn't been.
+        """
+        while state_group in self._merged_state_groups:
+            state_group = self._merged_state_groups[state_group]
+        return state_group
+
     @defer.inlineCallbacks
-    def get_current_state(self, room_id, event_type=None, state_key=""):
-        if event_type and state_key is not None:
-            result = yield self.get_current_state_for_key(
-                room_id, event_type, state_key
+    def _background_deduplicate_state_groups(self, progress, batch_size):
+        last_state_group = progress.get("last_state_group", 0)
+
+        # The merges made by the previous batch, whose state we can now
+        # delete. (JSON turns the keys into strings.)
+        pending_merges = {
+            int(state_group): merged_into
+            for state_group, merged_into in progress.get(
+                "pending_merges", {}
+            ).items()
+        }
+
+        # The merges may have been made before a restart, so make sure events
+        # persisted with the merged groups are redirected before deleting them.
+        self._merged_state_groups.update(pending_merges)
+
+        def deduplicate_state_groups_txn(txn):
+            rows_deleted = self._delete_merged_state_groups_txn(
+                txn, pending_merges
             )
-            defer.returnValue(result)
 
-        def f(txn):
-            sql = (
-                "SELECT event_id FROM current_state_events"
-                " WHERE room_id = ? "
+            txn.execute(
+                "SELECT id, room_id FROM state_groups"
+                " WHERE id > ? ORDER BY id ASC LIMIT ?",
+                (last_state_group, batch_size)
             )
+            groups = txn.fetchall()
 
-            if event_type and state_key is not None:
-                sql += " AND type = ? AND state_key = ? "
-                args = (room_id, event_type, state_key)
-            elif event_type:
-                sql += " AND type = ?"
-                args = (room_id, event_type)
-            else:
-                args = (room_id, )
+            merges = {}
+            for state_group, room_id in groups:
+                merged_into = self._deduplicate_state_group_txn(
+                    txn, room_id, state_group
+                )
+                if merged_into is not None:
+                    merges[state_group] = merged_into
+
+            if merges:
+                # Redirect any events that are about to be persisted with the
+                # merged groups. It doesn't matter if this transaction then
+                # fails, as the groups have the same state either way.
+                self._merged_state_groups.update(merges)
+
+                for state_group in merges:
+                    txn.call_after(
+                        self._state_group_cache.invalidate, state_group
+                    )
+                txn.call_after(self._get_state_group_for_event.invalidate_all)
+
+            if groups or merges:
+                progress = {
+                    "last_state_group": (
+                        groups[-1][0] if groups else last_state_group
+                    ),
+                    "pending_merges": merges,
+                }
+                self._background_update_progress_txn(
+                    txn, self.STATE_GROUP_DEDUP_UPDATE_NAME, progress
+                )
+
+            return len(groups), len(merges), rows_deleted
+
+        examined, merged, rows_deleted = yield self.runInteraction(
+            self.STATE_GROUP_DEDUP_UPDATE_NAME, deduplicate_state_groups_txn
+        )
+
+        dedup_groups_examined_counter.inc_by(examined)
+        dedup_groups_merged_counter.inc_by(merged)
+        dedup_rows_deleted_counter.inc_by(rows_deleted)
+
+        if not examined and not merged:
+            yield self._end_background_update(
+                self.STATE_GROUP_DEDUP_UPDATE_NAME
+            )
+
+        defer.returnValue(examined + len(pending_merges))
+
+    def start_state_group_dedup(self):
+        """Periodically re-queues the state group dedup background update, so
+        that state groups created since it last ran get merged too.
+        """
+        self._clock.looping_call(
+            self.queue_state_group_dedup, self.STATE_GROUP_DEDUP_INTERVAL_MS
+        )
+
+    @defer.inlineCallbacks
+    def queue_state_group_dedup(self):
+        """Queues the state group dedup background update to examine any state
+        groups it hasn't yet, unless it is already queued.
+
+        Returns:
+            Deferred: True if the update was queued.
+        """
+        def get_dedup_start_txn(txn):
+            txn.execute(
+                "SELECT update_name FROM background_updates"
+                " WHERE update_name = ?",
+                (self.STATE_GROUP_DEDUP_UPDATE_NAME,)
+            )
+            if txn.fetchall():
+                return None
+
+            # Every group that has been examined and not merged away has an
+            # entry here, and merged groups have been deleted, so we can carry
+            # on from the last of them.
+            txn.execute("SELECT MAX(state_group) FROM state_group_hashes")
+            last_state_group = txn.fetchall()[0][0] or 0
+
+            txn.execute(
+                "SELECT id FROM state_groups WHERE id > ? LIMIT 1",
+                (last_state_group,)
+            )
+            if not txn.fetchall():
+                return None
+
+            return last_state_group
+
+        try:
+            last_state_group = yield self.runInteraction(
+                "queue_state_group_dedup", get_dedup_start_txn
+            )
+            if last_state_group is not None:
+                yield self.start_background_update(
+                    self.STATE_GROUP_DEDUP_UPDATE_NAME,
+                    {"last_state_group": last_state_group},
+                )
+        except Exception:
+            logger.exception("Failed to queue state group dedup")
+            last_state_group = None
+
+        if last_state_group is None:
+            defer.returnValue(False)
+
+        self.start_doing_background_updates()
+        defer.returnValue(True)
+
+    def _deduplicate_state_group_txn(self, txn, room_id, state_group):
+        """Hashes the contents of a state group and, if there is an earlier
+        state group in the room with the same contents, points the group's
+        events at that instead.
+
+        Returns:
+            The state group that it was merged into, or None.
+        """
+        txn.execute(
+            "SELECT type, state_key, event_id FROM state_groups_state"
+            " WHERE state_group = ?",
+            (state_group,)
+        )
+        state_hash = hashlib.sha1()
+        for row in sorted(txn.fetchall()):
+            state_hash.update(u"\0".join(row).encode("utf-8"))
+            state_hash.update(b"\0\0")
+        state_hash = state_hash.hexdigest()
+
+        merged_into = self._simple_select_one_onecol_txn(
+            txn,
+            table="state_group_hashes",
+            keyvalues={
+                "room_id": room_id,
+                "hash": state_hash,
+            },
+            retcol="state_group",
+            allow_none=True,
+        )
+
+        if merged_into is None:
+            self._simple_insert_txn(
+                txn,
+                table="state_group_hashes",
+                values={
+                    "room_id": room_id,
+                    "hash": state_hash,
+                    "state_group": state_group,
+                },
+            )
+            return None
+
+        if merged_into == state_group:
+            return None
+
+        txn.execute(
+            "UPDATE event_to_state_groups SET state_group = ?"
+            " WHERE state_group = ?",
+            (merged_into, state_group)
+        )
+
+        return merged_into
+
+    def _delete_merged_state_groups_txn(self, txn, merges):
+        """Deletes state groups that have been merged into another, after
+        pointing any events that have since been given them at the group
+        they were merged into.
+
+        Returns:
+            The number of state_groups_state rows deleted.
+        """
+        rows_deleted = 0
+        for state_group, merged_into in merges.items():
+            txn.execute(
+                "UPDATE event_to_state_groups SET state_group = ?"
+                " WHERE state_group = ?",
+                (merged_into, state_group)
+            )
+            if txn.rowcount:
+                txn.call_after(self._get_state_group_for_event.invalidate_all)
+
+            txn.execute(
+                "DELETE FROM state_groups_state WHERE state_group = ?",
+                (state_group,)
+            )
+            rows_deleted += txn.rowcount
+
+            txn.execute(
+                "DELETE FROM state_groups WHERE id = ?", (state_group,)
+            )
 
-            txn.execute(sql, args)
-            results = txn.fetchall()
+        return rows_deleted
 
-            return [r[0] for r in results]
+    @defer.inlineCallbacks
+    def get_current_state(self, room_id, event_type=None, state_key=""):
+        current_state = yield self.get_current_state_ids(room_id)
+
+        if event_type and state_key is not None:
+            event_id = current_state.get((event_type, state_key))
+            event_ids = [event_id] if event_id else []
+        elif event_type:
+            event_ids = [
+                event_id for (typ, _), event_id in current_state.items()
+                if typ == event_type
+            ]
+        else:
+            event_ids = current_state.values()
 
-        event_ids = yield self.runInteraction("get_current_state", f)
         events = yield self._get_events(event_ids, get_prev_content=False)
         defer.returnValue(events)
 
     @cachedInlineCallbacks(num_args=3)
     def get_current_state_for_key(self, room_id, event_type, state_key):
-        def f(txn):
-            sql = (
-                "SELECT event_id FROM current_state_events"
-                " WHERE room_id = ? AND type = ? AND state_key = ?"
-            )
+        current_state = yield self.get_current_state_ids(room_id)
+
+        event_id = current_state.get((event_type, state_key))
+        event_ids = [event_id] if event_id else []
 
-            args = (room_id, event_type, state_key)
-            txn.execute(sql, args)
-            results = txn.fetchall()
-            return [r[0] for r in results]
-        event_ids = yield self.runInteraction("get_current_state_for_key", f)
         events = yield self._get_events(event_ids, get_prev_content=False)
         defer.returnValue(events)
 
+    @cached()
+    def get_current_state_ids(self, room_id):
+        """Get the current state of a room, as recorded in
+        `current_state_events`.
+
+        The cached result is kept up to date by the persistence path, which
+        replaces it with an updated copy rather than invalidating it. It must
+        not be modified by the caller.
+
+        Returns:
+            Deferred: A dict mapping (type, state_key) -> event_id
+        """
+        def f(txn):
+            txn.execute(
+                "SELECT type, state_key, event_id FROM current_state_events"
+                " WHERE room_id = ?",
+                (room_id,)
+            )
+            return {
+                (typ, state_key): event_id
+                for typ, state_key, event_id in txn.fetchall()
+            }
+
+        return self.runInteraction("get_current_state_ids", f)
+
+    def _set_current_state_ids_cache(self, room_id, current_state):
+        """Replaces the cached current state of a room. Called after the
+        `current_state_events` for the room have been rewritten.
+        """
+        self.get_current_state_ids.invalidate((room_id,))
+        self.get_current_state_ids.prefill(
+            (room_id,), ObservableDeferred(defer.succeed(current_state))
+        )
+
+    def _update_current_state_ids_cache(self, room_id, updates):
+        """Applies changes to the `current_state_events` of a room to the
+        cached current state, if we have it.
+
+        Args:
+            room_id (str)
+            updates (dict): (type, state_key) -> new event_id
+        """
+        cached_state = self.get_current_state_ids.cache.get((room_id,), None)
+        if cached_state is None:
+            return
+
+        if not cached_state.called:
+            # The SELECT may have started before our write, so we can't
+            # safely update the result when it arrives.
+            self.get_current_state_ids.invalidate((room_id,))
+            return
+
+        def prefill_updated_copy(state):
+            # Callers may still be holding the old dict, so don't modify it.
+            state = dict(state)
+            state.update(updates)
+            self.get_current_state_ids.prefill(
+                (room_id,), ObservableDeferred(defer.succeed(state))
+            )
+
+        cached_state.observe().addCallback(prefill_updated_copy)
+
     def _get_state_groups_from_groups(self, groups_and_types):
         """Returns dictionary state_group -> state event ids
 
+        Groups that are asked for with the same types are fetched together,
+        so that the usual case of asking for the same few types from many
+        groups is a single query.
+
         Args:
             groups_and_types (list): list of 2-tuple (`group`, `types`)
         """
+        groups_by_types = {}
+        for group, types in groups_and_types:
+            if types is not None:
+                types = frozenset(types)
+            groups_by_types.setdefault(types, []).append(group)
+
         def f(txn):
             results = {}
-            for group, types in groups_and_types:
-                if types is not None:
-                    where_clause = "AND (%s)" % (
-                        " OR ".join(["(type = ? AND state_key = ?)"] * len(types)),
-                    )
-                else:
-                    where_clause = ""
-
-                sql = (
-                    "SELECT event_id FROM state_groups_state WHERE"
-                    " state_group = ? %s"
-                ) % (where_clause,)
-
-                args = [group]
-                if types is not None:
-                    args.extend([i for typ in types for i in typ])
+            for types, groups in groups_by_types.items():
+                for i in xrange(0, len(groups), 100):
+                    chunk = groups[i:i+100]
+                    results.update({group: [] for group in chunk})
 
-                txn.execute(sql, args)
-
-                results[group] = [r[0] for r in txn.fetchall()]
+                    sql, args = self._get_state_groups_from_groups_sql(
+                        chunk, types
+                    )
+                    txn.execute(sql, args)
+                    for group, event_id in txn.fetchall():
+                        results[group].append(event_id)
 
             return results
 
@@ -207,6 +550,75 @@ class StateStore(SQLBaseStore):
             f,
         )
 
+    def _get_state_groups_from_groups_sql(self, groups, types):
+        """Builds the query for the state of the given groups, filtered by
+        `types` if it isn't None. A `state_key` of None in `types` matches all
+        state_keys of that type.
+
+        Returns:
+            2-tuple of the SQL and its args, which selects `state_group,
+            event_id` rows.
+        """
+        select_sql = (
+            "SELECT s.state_group, s.event_id FROM state_groups_state AS s"
+        )
+        groups_clause = "s.state_group IN (%s)" % (
+            ",".join(["?"] * len(groups)),
+        )
+
+        if types is None:
+            return "%s WHERE %s" % (select_sql, groups_clause), list(groups)
+
+        keys = [
+            (typ, state_key) for typ, state_key in types
+            if state_key is not None
+        ]
+        wildcard_types = [
+            typ for typ, state_key in types if state_key is None
+        ]
+
+        clauses = []
+        args = []
+        if keys:
+            if isinstance(self.database_engine, PostgresEngine):
+                # Postgres can join the keys against the index as a table.
+                clauses.append(
+                    "%s INNER JOIN (VALUES %s) AS t(type, state_key)"
+                    " ON s.type = t.type AND s.state_key = t.state_key"
+                    " WHERE %s" % (
+                        select_sql,
+                        ",".join(["(?, ?)"] * len(keys)),
+                        groups_clause,
+                    )
+                )
+                args.extend(i for key in keys for i in key)
+                args.extend(groups)
+            else:
+                clauses.append(
+                    "%s WHERE %s AND (%s)" % (
+                        select_sql,
+                        groups_clause,
+                        " OR ".join(
+                            ["(s.type = ? AND s.state_key = ?)"] * len(keys)
+                        ),
+                    )
+                )
+                args.extend(groups)
+                args.extend(i for key in keys for i in key)
+
+        if wildcard_types:
+            clauses.append(
+                "%s WHERE %s AND s.type IN (%s)" % (
+                    select_sql,
+                    groups_clause,
+                    ",".join(["?"] * len(wildcard_types)),
+                )
+            )
+            args.extend(groups)
+            args.extend(wildcard_types)
+
+        return " UNION ".join(clauses), args
+
     @defer.inlineCallbacks
     def get_state_for_events(self, event_ids, types):
         """Given a list of event_ids and type tuples, return a list of state
@@ -315,6 +727,10 @@ class StateStore(SQLBaseStore):
                 if (typ, state_key) not in state_dict:
                     missing_types.add((typ, state_key))
 
+        if is_all:
+            # We have the whole of the group, so nothing can be missing.
+            missing_types = set()
+
         sentinel = object()
 
         def include(typ, state_key):
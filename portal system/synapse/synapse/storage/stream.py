@@ -36,11 +36,16 @@ what sort order was used:
 from twisted.internet import defer
 
 from ._base import SQLBaseStore
-from synapse.util.caches.descriptors import cachedInlineCallbacks
+from .engines import PostgresEngine
+from synapse.util.async import ObservableDeferred
+from synapse.util.caches.descriptors import Cache, cachedInlineCallbacks
+from synapse.util.caches.stream_change_cache import StreamChangeCache
 from synapse.api.constants import EventTypes
 from synapse.types import RoomStreamToken
+from synapse.util.logcontext import PreserveLoggingContext
 from synapse.util.logutils import log_function
 
+from collections import OrderedDict
 import logging
 
 
@@ -49,6 +54,20 @@ logger = logging.getLogger(__name__)
 
 MAX_STREAM_SIZE = 1000
 
+# The number of rooms we keep pagination read-ahead results for.
+READ_AHEAD_MAX_ROOMS = 1000
+# The number of pages we read ahead in each room. Once a room has this many
+# the oldest is dropped to make room for the next.
+READ_AHEAD_MAX_PAGES_PER_ROOM = 2
+# How long a read-ahead page is kept for if nobody asks for it.
+READ_AHEAD_PAGE_EXPIRY_MS = 60 * 1000
+# The number of read-aheads we allow to run at once across all rooms.
+READ_AHEAD_MAX_IN_FLIGHT = 10
+
+# The number of rooms to fetch the recent events of in each query in
+# `get_recent_events_for_rooms`.
+RECENT_EVENTS_ROOMS_PER_QUERY = 100
+
 
 _STREAM_TOKEN = "stream"
 _TOPOLOGICAL_TOKEN = "topological"
@@ -77,6 +96,61 @@ def upper_bound(token):
 
 
 class StreamStore(SQLBaseStore):
+    def __init__(self, hs):
+        super(StreamStore, self).__init__(hs)
+
+        self._pagination_read_ahead = hs.config.pagination_read_ahead
+        self._pagination_read_ahead_events = (
+            hs.config.pagination_read_ahead_events
+        )
+
+        # The stream orderings of the latest event in each room, and of the
+        # latest membership event for each user. Filled in by EventsStore as
+        # events are persisted.
+        self._events_stream_cache = StreamChangeCache(
+            "EventsRoomStreamChangeCache",
+            lambda: self._stream_id_gen.get_max_token(self),
+        )
+        self._membership_stream_cache = StreamChangeCache(
+            "MembershipStreamChangeCache",
+            lambda: self._stream_id_gen.get_max_token(self),
+        )
+
+        # Maps room_id to an OrderedDict, oldest first, of (from_key, to_key,
+        # limit) to a (read_ahead_ts, ObservableDeferred) tuple giving the
+        # (rows, next_token) for that page.
+        self._read_ahead_cache = Cache(
+            "pagination_read_ahead", max_entries=READ_AHEAD_MAX_ROOMS,
+        )
+        self._read_ahead_in_flight = 0
+
+    def get_rooms_with_new_events(self, room_ids, from_key):
+        """Get the rooms that may have had events since the given stream
+        token, without going to the database.
+
+        Args:
+            room_ids (list): The rooms to check.
+            from_key (str): The room stream token to check from.
+        Returns:
+            Deferred: A set of room_ids.
+        """
+        from_id = RoomStreamToken.parse_stream_token(from_key).stream
+        return self._events_stream_cache.get_entities_changed(room_ids, from_id)
+
+    def has_membership_changed_for_user(self, user_id, from_key):
+        """Check whether there may have been membership events for the user
+        since the given stream token, without going to the database.
+
+        Args:
+            user_id (str): The user to check.
+            from_key (str): The room stream token to check from.
+        Returns:
+            Deferred: A bool.
+        """
+        from_id = RoomStreamToken.parse_stream_token(from_key).stream
+        return self._membership_stream_cache.has_entity_changed(
+            user_id, from_id
+        )
 
     @defer.inlineCallbacks
     def get_appservice_room_stream(self, service, from_key, to_key, limit=0):
@@ -255,6 +329,41 @@ class StreamStore(SQLBaseStore):
     @defer.inlineCallbacks
     def paginate_room_events(self, room_id, from_key, to_key=None,
                              direction='b', limit=-1):
+        read_ahead = (
+            self._pagination_read_ahead and direction == 'b' and int(limit) > 0
+        )
+
+        result = None
+        if read_ahead:
+            page = self._pop_read_ahead_page(room_id, from_key, to_key, limit)
+            if page is not None:
+                result = yield page.observe()
+
+        if result is None:
+            result = yield self.runInteraction(
+                "paginate_room_events", self._paginate_room_events_txn,
+                room_id, from_key, to_key, direction, limit,
+            )
+
+        rows, token = result
+
+        if read_ahead and rows:
+            # Clients scrolling back will most likely ask for the next page
+            # next, so start fetching it now.
+            with PreserveLoggingContext():
+                self._read_ahead_room_events(room_id, token, to_key, limit)
+
+        events = yield self._get_events(
+            [r["event_id"] for r in rows],
+            get_prev_content=True
+        )
+
+        self._set_before_and_after(events, rows)
+
+        defer.returnValue((events, token))
+
+    def _paginate_room_events_txn(self, txn, room_id, from_key, to_key,
+                                  direction, limit):
         # Tokens really represent positions between elements, but we use
         # the convention of pointing to the event before the gap. Hence
         # we have a bit of asymmetry when it comes to equalities.
@@ -291,38 +400,120 @@ class StreamStore(SQLBaseStore):
             "limit": limit_str
         }
 
-        def f(txn):
-            txn.execute(sql, args)
+        txn.execute(sql, args)
 
-            rows = self.cursor_to_dict(txn)
+        rows = self.cursor_to_dict(txn)
 
-            if rows:
-                topo = rows[-1]["topological_ordering"]
-                toke = rows[-1]["stream_ordering"]
-                if direction == 'b':
-                    # Tokens are positions between events.
-                    # This token points *after* the last event in the chunk.
-                    # We need it to point to the event before it in the chunk
-                    # when we are going backwards so we subtract one from the
-                    # stream part.
-                    toke -= 1
-                next_token = str(RoomStreamToken(topo, toke))
-            else:
-                # TODO (erikj): We should work out what to do here instead.
-                next_token = to_key if to_key else from_key
+        if rows:
+            topo = rows[-1]["topological_ordering"]
+            toke = rows[-1]["stream_ordering"]
+            if direction == 'b':
+                # Tokens are positions between events.
+                # This token points *after* the last event in the chunk.
+                # We need it to point to the event before it in the chunk
+                # when we are going backwards so we subtract one from the
+                # stream part.
+                toke -= 1
+            next_token = str(RoomStreamToken(topo, toke))
+        else:
+            # TODO (erikj): We should work out what to do here instead.
+            next_token = to_key if to_key else from_key
+
+        return rows, next_token,
+
+    def _pop_read_ahead_page(self, room_id, from_key, to_key, limit):
+        room_pages = self._read_ahead_cache.get((room_id,), None)
+        if room_pages is None:
+            return None
+        self._expire_read_ahead_pages(room_pages)
+        page = room_pages.pop((from_key, to_key, limit), None)
+        if page is None:
+            return None
+        return page[1]
+
+    def _expire_read_ahead_pages(self, room_pages):
+        """Drops the pages that have gone unused for too long, so that
+        abandoned pages neither go stale nor stop the room from reading ahead.
+        """
+        expire_before = self._clock.time_msec() - READ_AHEAD_PAGE_EXPIRY_MS
+        while room_pages:
+            key, (read_ahead_ts, _) = next(room_pages.iteritems())
+            if read_ahead_ts >= expire_before:
+                break
+            del room_pages[key]
+
+    def _read_ahead_room_events(self, room_id, from_key, to_key, limit):
+        """Starts fetching the page of events before from_key in the
+        background, so that it can be returned from memory by
+        paginate_room_events.
+        """
+        if self._read_ahead_in_flight >= READ_AHEAD_MAX_IN_FLIGHT:
+            return
 
-            return rows, next_token,
+        room_pages = self._read_ahead_cache.get((room_id,), None)
+        if room_pages is None:
+            room_pages = OrderedDict()
+            self._read_ahead_cache.prefill((room_id,), room_pages)
 
-        rows, token = yield self.runInteraction("paginate_room_events", f)
+        key = (from_key, to_key, limit)
+        if key in room_pages:
+            return
 
-        events = yield self._get_events(
-            [r["event_id"] for r in rows],
-            get_prev_content=True
+        self._expire_read_ahead_pages(room_pages)
+        while len(room_pages) >= READ_AHEAD_MAX_PAGES_PER_ROOM:
+            room_pages.popitem(last=False)
+
+        self._read_ahead_in_flight += 1
+
+        d = self.runInteraction(
+            "paginate_room_events_read_ahead", self._paginate_room_events_txn,
+            room_id, from_key, to_key, 'b', limit,
         )
 
-        self._set_before_and_after(events, rows)
+        if self._pagination_read_ahead_events:
+            @defer.inlineCallbacks
+            def prefetch_events(result):
+                rows, _ = result
+                # This pulls the events into the event cache.
+                yield self._get_events(
+                    [r["event_id"] for r in rows],
+                    get_prev_content=True
+                )
+                defer.returnValue(result)
+            d.addCallback(prefetch_events)
 
-        defer.returnValue((events, token))
+        def on_error(f):
+            logger.warn(
+                "Failed to read ahead events in %s: %s", room_id, f.value
+            )
+            room_pages.pop(key, None)
+            # Callers treat None as a miss and do the query themselves.
+            return None
+
+        def finished(result):
+            self._read_ahead_in_flight -= 1
+            return result
+
+        d.addErrback(on_error)
+        d.addBoth(finished)
+
+        room_pages[key] = (
+            self._clock.time_msec(), ObservableDeferred(d, consumeErrors=True)
+        )
+
+    def _invalidate_read_ahead_for_room(self, room_id, depth):
+        """Drops any read-ahead pages for the room that a new event with the
+        given depth could have been inserted into.
+        """
+        room_pages = self._read_ahead_cache.get((room_id,), None)
+        if not room_pages:
+            return
+
+        for from_key, _, _ in room_pages:
+            topological = RoomStreamToken.parse(from_key).topological
+            if topological is None or topological >= depth:
+                self._read_ahead_cache.invalidate((room_id,))
+                return
 
     @cachedInlineCallbacks(num_args=4)
     def get_recent_events_for_room(self, room_id, limit, end_token, from_token=None):
@@ -360,21 +551,7 @@ class StreamStore(SQLBaseStore):
 
             rows.reverse()  # As we selected with reverse ordering
 
-            if rows:
-                # Tokens are positions between events.
-                # This token points *after* the last event in the chunk.
-                # We need it to point to the event before it in the chunk
-                # since we are going backwards so we subtract one from the
-                # stream part.
-                topo = rows[0]["topological_ordering"]
-                toke = rows[0]["stream_ordering"] - 1
-                start_token = str(RoomStreamToken(topo, toke))
-
-                token = (start_token, str(end_token))
-            else:
-                token = (str(end_token), str(end_token))
-
-            return rows, token
+            return rows, self._recent_events_token(rows, end_token)
 
         rows, token = yield self.runInteraction(
             "get_recent_events_for_room", get_recent_events_for_room_txn
@@ -391,6 +568,136 @@ class StreamStore(SQLBaseStore):
 
         defer.returnValue((events, token))
 
+    @staticmethod
+    def _recent_events_token(rows, end_token):
+        if rows:
+            # Tokens are positions between events.
+            # This token points *after* the last event in the chunk.
+            # We need it to point to the event before it in the chunk
+            # since we are going backwards so we subtract one from the
+            # stream part.
+            topo = rows[0]["topological_ordering"]
+            toke = rows[0]["stream_ordering"] - 1
+            start_token = str(RoomStreamToken(topo, toke))
+
+            return (start_token, str(end_token))
+        else:
+            return (str(end_token), str(end_token))
+
+    @defer.inlineCallbacks
+    def get_recent_events_for_rooms(self, room_ids, limit, end_token,
+                                    from_token=None):
+        """Get the most recent events in each of a list of rooms, as
+        `get_recent_events_for_room` would, but in a handful of queries
+        rather than one per room.
+
+        Args:
+            room_ids (list): The rooms to get events for.
+            limit (int): The most events to return per room.
+            end_token (str): Get events at or before this stream position.
+            from_token (str|None): If given, only get events after this stream
+                position.
+        Returns:
+            Deferred: Results in a dict mapping room_id to an (events, token)
+            tuple, as returned by `get_recent_events_for_room`.
+        """
+        room_ids = list(room_ids)
+        end_token = RoomStreamToken.parse_stream_token(end_token)
+        if from_token is not None:
+            from_token = RoomStreamToken.parse_stream_token(from_token)
+
+        def get_recent_events_for_rooms_txn(txn):
+            rows_by_room = {room_id: [] for room_id in room_ids}
+            for i in xrange(0, len(room_ids), RECENT_EVENTS_ROOMS_PER_QUERY):
+                chunk = room_ids[i:i + RECENT_EVENTS_ROOMS_PER_QUERY]
+                sql, args = self._get_recent_events_for_rooms_sql(
+                    chunk, limit, end_token, from_token,
+                )
+                txn.execute(sql, args)
+                for row in self.cursor_to_dict(txn):
+                    rows_by_room[row["room_id"]].append(row)
+
+            for rows in rows_by_room.values():
+                rows.sort(key=lambda r: (
+                    r["topological_ordering"], r["stream_ordering"]
+                ))
+
+            return rows_by_room
+
+        rows_by_room = yield self.runInteraction(
+            "get_recent_events_for_rooms", get_recent_events_for_rooms_txn
+        )
+
+        events = yield self._get_events(
+            [r["event_id"] for rows in rows_by_room.values() for r in rows],
+            get_prev_content=True,
+        )
+        event_map = {e.event_id: e for e in events}
+
+        results = {}
+        for room_id, rows in rows_by_room.items():
+            token = self._recent_events_token(rows, end_token)
+            rows = [r for r in rows if r["event_id"] in event_map]
+            room_events = [event_map[r["event_id"]] for r in rows]
+            self._set_before_and_after(room_events, rows)
+            results[room_id] = (room_events, token)
+
+        defer.returnValue(results)
+
+    def _get_recent_events_for_rooms_sql(self, room_ids, limit, end_token,
+                                         from_token):
+        """Builds the query for `get_recent_events_for_rooms`.
+
+        Returns:
+            (str, list): The SQL and its arguments.
+        """
+        where_clause = "stream_ordering <= ? AND outlier = ?"
+        where_args = [end_token.stream, False]
+        if from_token is not None:
+            where_clause += " AND stream_ordering > ?"
+            where_args.append(from_token.stream)
+
+        if from_token is not None and isinstance(
+            self.database_engine, PostgresEngine
+        ):
+            # The window function has to number every event in the range for
+            # each room, so we only use it when the range is bounded below.
+            sql = (
+                "SELECT room_id, stream_ordering, topological_ordering,"
+                " event_id FROM ("
+                " SELECT room_id, stream_ordering, topological_ordering,"
+                " event_id, ROW_NUMBER() OVER ("
+                " PARTITION BY room_id"
+                " ORDER BY topological_ordering DESC, stream_ordering DESC"
+                " ) AS row_num"
+                " FROM events"
+                " WHERE room_id IN (%s) AND %s"
+                " ) AS e WHERE row_num <= ?"
+            ) % (",".join("?" for _ in room_ids), where_clause,)
+
+            return sql, list(room_ids) + where_args + [limit]
+
+        # Otherwise pick out the latest events of each room separately, which
+        # lets the database stop after `limit` rows of the index for each.
+        subquery = (
+            "SELECT * FROM ("
+            "SELECT room_id, stream_ordering, topological_ordering, event_id"
+            " FROM events"
+            " WHERE room_id = ? AND %s"
+            " ORDER BY topological_ordering DESC, stream_ordering DESC"
+            " LIMIT ?"
+            ") AS e%%d"
+        ) % (where_clause,)
+
+        sql = " UNION ALL ".join(subquery % (i,) for i in range(len(room_ids)))
+        args = []
+        for room_id in room_ids:
+            args.append(room_id)
+            args.extend(where_args)
+            args.append(limit)
+
+        return sql, args
+
     @defer.inlineCallbacks
     def get_room_events_max_id(self, direction='f'):
         token = yield self._stream_id_gen.get_max_token(self)
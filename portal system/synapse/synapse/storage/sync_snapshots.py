@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ._base import SQLBaseStore
+from twisted.internet import defer
+
+import ujson as json
+
+
+class SyncSnapshotStore(SQLBaseStore):
+
+    @defer.inlineCallbacks
+    def get_sync_snapshot(self, user_id, filter_key):
+        """Get the latest snapshot of an initial sync for a user.
+
+        Args:
+            user_id(str): The user the snapshot is for.
+            filter_key(str): Identifies the filter the snapshot was made with.
+        Returns:
+            A deferred (stream_token, snapshot) tuple, where stream_token is
+            the string token the snapshot was made at and snapshot is the dict
+            passed to `store_sync_snapshot`, or None if there is no snapshot.
+        """
+        row = yield self._simple_select_one(
+            table="sync_snapshots",
+            keyvalues={
+                "user_id": user_id,
+                "filter_key": filter_key,
+            },
+            retcols=("stream_token", "snapshot_json"),
+            allow_none=True,
+            desc="get_sync_snapshot",
+        )
+
+        if row is None:
+            defer.returnValue(None)
+
+        defer.returnValue(
+            (row["stream_token"], json.loads(row["snapshot_json"]))
+        )
+
+    def store_sync_snapshot(self, user_id, filter_key, stream_token, snapshot):
+        """Replace the snapshot of an initial sync for a user.
+
+        Args:
+            user_id(str): The user the snapshot is for.
+            filter_key(str): Identifies the filter the snapshot was made with.
+            stream_token(str): The token the snapshot was made at.
+            snapshot(dict): The JSON-serialisable snapshot.
+        Returns:
+            A deferred that completes once the snapshot has been stored.
+        """
+        return self._simple_upsert(
+            table="sync_snapshots",
+            keyvalues={
+                "user_id": user_id,
+                "filter_key": filter_key,
+            },
+            values={
+                "stream_token": stream_token,
+                "ts": self._clock.time_msec(),
+                "snapshot_json": json.dumps(snapshot),
+            },
+            desc="store_sync_snapshot",
+        )
+
+    def prune_sync_snapshots(self, max_age_ms):
+        """Delete the snapshots which haven't been replaced for a while, e.g.
+        because their user has stopped syncing with that filter.
+
+        Args:
+            max_age_ms(int): How old a snapshot must be to be deleted.
+        Returns:
+            A deferred that completes once the snapshots have been deleted.
+        """
+        def prune_sync_snapshots_txn(txn):
+            txn.execute(
+                "DELETE FROM sync_snapshots WHERE ts < ?",
+                (self._clock.time_msec() - max_age_ms,)
+            )
+
+        return self.runInteraction(
+            "prune_sync_snapshots", prune_sync_snapshots_txn
+        )
@@ -15,6 +15,7 @@
 
 from ._base import SQLBaseStore
 from synapse.util.caches.descriptors import cached
+from synapse.util.caches.stream_change_cache import StreamChangeCache
 from twisted.internet import defer
 from .util.id_generators import StreamIdGenerator
 
@@ -31,6 +32,10 @@ class TagsStore(SQLBaseStore):
         self._account_data_id_gen = StreamIdGenerator(
             "account_data_max_stream_id", "stream_id"
         )
+        self._account_data_stream_cache = StreamChangeCache(
+            "AccountDataAndTagsChangeCache",
+            self.get_max_account_data_stream_id,
+        )
 
     def get_max_account_data_stream_id(self):
         """Get the current max stream id for the private user data stream
@@ -78,6 +83,12 @@ class TagsStore(SQLBaseStore):
             A deferred dict mapping from room_id strings to lists of tag
             strings for all the rooms that changed since the stream_id token.
         """
+        changed = yield self._account_data_stream_cache.has_entity_changed(
+            user_id, int(stream_id)
+        )
+        if not changed:
+            defer.returnValue({})
+
         def get_updated_tags_txn(txn):
             sql = (
                 "SELECT room_id from room_tags_revisions"
@@ -145,6 +156,9 @@ class TagsStore(SQLBaseStore):
             self._update_revision_txn(txn, user_id, room_id, next_id)
 
         with (yield self._account_data_id_gen.get_next(self)) as next_id:
+            yield self._account_data_stream_cache.entity_has_changed(
+                user_id, next_id
+            )
             yield self.runInteraction("add_tag", add_tag_txn, next_id)
 
         self.get_tags_for_user.invalidate((user_id,))
@@ -167,6 +181,9 @@ class TagsStore(SQLBaseStore):
             self._update_revision_txn(txn, user_id, room_id, next_id)
 
         with (yield self._account_data_id_gen.get_next(self)) as next_id:
+            yield self._account_data_stream_cache.entity_has_changed(
+                user_id, next_id
+            )
             yield self.runInteraction("remove_tag", remove_tag_txn, next_id)
 
         self.get_tags_for_user.invalidate((user_id,))
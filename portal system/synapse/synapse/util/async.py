@@ -17,6 +17,7 @@
 from twisted.internet import defer, reactor
 
 from .logcontext import preserve_context_over_deferred
+from synapse.util import unwrapFirstError
 
 
 def sleep(seconds):
@@ -32,6 +33,37 @@ def run_on_reactor():
     return sleep(0)
 
 
+def concurrently_execute(func, args, limit):
+    """Calls `func` with each of `args`, with at most `limit` calls in flight
+    at once.
+
+    Args:
+        func (callable): Called with a single argument, returning a Deferred.
+        args (iterable): The arguments to call `func` with.
+        limit (int): The most calls to have outstanding at once. Values
+            below 1 are treated as 1.
+    Returns:
+        Deferred: Results in a list of the results of the calls, in the same
+        order as `args`. If any call fails then the first failure is passed
+        on.
+    """
+    args = list(args)
+    results = [None] * len(args)
+    it = iter(enumerate(args))
+
+    @defer.inlineCallbacks
+    def worker():
+        # Each worker takes the next argument as soon as its last call
+        # finishes, so the slow calls don't hold the others up.
+        for i, arg in it:
+            results[i] = yield func(arg)
+
+    return defer.gatherResults(
+        [worker() for _ in xrange(min(max(1, limit), len(args)))],
+        consumeErrors=True,
+    ).addErrback(unwrapFirstError).addCallback(lambda _: results)
+
+
 class ObservableDeferred(object):
     """Wraps a deferred object so that we can add observer deferreds. These
     observer deferreds do not affect the callback chain of the original
@@ -201,6 +201,7 @@ class CacheDescriptor(object):
         wrapped.invalidate = self.cache.invalidate
         wrapped.invalidate_all = self.cache.invalidate_all
         wrapped.prefill = self.cache.prefill
+        wrapped.cache = self.cache
 
         obj.__dict__[self.orig.__name__] = wrapped
 
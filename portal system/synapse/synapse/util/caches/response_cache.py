@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.util.async import ObservableDeferred
+
+
+class ResponseCache(object):
+    """Caches the deferred response to a request, so that identical requests
+    made while the response is being computed share the one computation.
+
+    Successful responses are kept for `timeout_ms` after they complete, so
+    that a client retrying straight away gets the same response for free.
+    Failures, and responses which `keep_result` rejects, are dropped as soon
+    as they complete.
+
+    Args:
+        clock (Clock)
+        timeout_ms (int): How long to keep completed responses for.
+        keep_result (callable|None): Called with a successful response to
+            decide whether it is worth keeping after it completes.
+    """
+
+    def __init__(self, clock, timeout_ms=0, keep_result=None):
+        self.clock = clock
+        self.timeout_sec = timeout_ms / 1000.
+        self.keep_result = keep_result
+
+        self.pending_result_cache = {}
+
+    def __len__(self):
+        return len(self.pending_result_cache)
+
+    def get(self, key):
+        """Get a deferred for the response to an earlier identical request.
+
+        Returns:
+            Deferred|None: A new observer of the response, or None if there
+            is no response cached for the key.
+        """
+        result = self.pending_result_cache.get(key)
+        if result is not None:
+            return result.observe()
+        else:
+            return None
+
+    def set(self, key, deferred):
+        """Cache the response to a request.
+
+        Args:
+            key: The parameters of the request.
+            deferred (Deferred): The response being computed.
+        Returns:
+            Deferred: An observer of the response, to be used in place of
+            `deferred`.
+        """
+        result = ObservableDeferred(deferred, consumeErrors=True)
+        self.pending_result_cache[key] = result
+
+        def remove():
+            if self.pending_result_cache.get(key) is result:
+                del self.pending_result_cache[key]
+
+        def on_success(r):
+            if not self.timeout_sec:
+                remove()
+            elif self.keep_result and not self.keep_result(r):
+                remove()
+            else:
+                self.clock.call_later(self.timeout_sec, remove)
+
+        def on_error(f):
+            # The failure is passed on to the observers of the response.
+            remove()
+
+        result.observe().addCallbacks(on_success, on_error)
+
+        return result.observe()
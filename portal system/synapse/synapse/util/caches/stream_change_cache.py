@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.util.caches import cache_counter, caches_by_name
+
+from twisted.internet import defer
+
+from blist import sorteddict
+
+
+class StreamChangeCache(object):
+    """Keeps track of the stream position of the latest change to each entity
+    (e.g. room or user) in a stream.
+
+    Given some entities and a stream position this can tell which of them may
+    have changed since that position, without going to the database. It only
+    knows about changes since it was created, or since the oldest change it
+    has had to forget to stay within its size limit. For positions before that
+    it has to assume that everything may have changed.
+
+    Args:
+        name (str): The name of the cache, for metrics.
+        get_current_stream_pos (callable): Returns a deferred current position
+            of the stream. Called once, the first time the cache is used.
+        max_size (int): The most changes to remember.
+    """
+
+    def __init__(self, name, get_current_stream_pos, max_size=10000):
+        self.name = name
+        self._get_current_stream_pos = get_current_stream_pos
+        self._max_size = max_size
+        # The stream position each entity last changed at, and the entities
+        # that last changed at each position.
+        self._entity_to_key = {}
+        self._cache = sorteddict()
+        self._earliest_known_stream_pos = None
+        caches_by_name[name] = self._entity_to_key
+
+    @defer.inlineCallbacks
+    def _get_earliest_known_stream_pos(self):
+        if self._earliest_known_stream_pos is None:
+            stream_pos = yield self._get_current_stream_pos()
+            # Someone else may have filled it in while we were waiting.
+            if self._earliest_known_stream_pos is None:
+                self._earliest_known_stream_pos = int(stream_pos)
+
+        defer.returnValue(self._earliest_known_stream_pos)
+
+    @defer.inlineCallbacks
+    def has_entity_changed(self, entity, stream_pos):
+        """Returns True if the entity may have changed since the given
+        position.
+        """
+        stream_pos = int(stream_pos)
+        earliest = yield self._get_earliest_known_stream_pos()
+
+        if stream_pos < earliest:
+            cache_counter.inc_misses(self.name)
+            defer.returnValue(True)
+
+        cache_counter.inc_hits(self.name)
+        defer.returnValue(
+            self._entity_to_key.get(entity, earliest) > stream_pos
+        )
+
+    @defer.inlineCallbacks
+    def get_entities_changed(self, entities, stream_pos):
+        """Returns the subset of the given entities that may have changed
+        since the given position. If the position is too old to tell, this is
+        all of them.
+        """
+        stream_pos = int(stream_pos)
+        earliest = yield self._get_earliest_known_stream_pos()
+
+        if stream_pos < earliest:
+            cache_counter.inc_misses(self.name)
+            defer.returnValue(set(entities))
+
+        cache_counter.inc_hits(self.name)
+
+        keys = self._cache.keys()
+        i = keys.bisect_right(stream_pos)
+        if len(keys) - i < len(entities):
+            result = set()
+            for k in keys[i:]:
+                result.update(self._cache[k])
+            result.intersection_update(entities)
+        else:
+            result = set(
+                entity for entity in entities
+                if self._entity_to_key.get(entity, earliest) > stream_pos
+            )
+
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def has_any_entity_changed(self, stream_pos):
+        """Returns True if any entity may have changed since the given
+        position.
+        """
+        stream_pos = int(stream_pos)
+        earliest = yield self._get_earliest_known_stream_pos()
+
+        if stream_pos < earliest:
+            cache_counter.inc_misses(self.name)
+            defer.returnValue(True)
+
+        cache_counter.inc_hits(self.name)
+        defer.returnValue(
+            bool(self._cache) and self._cache.keys()[-1] > stream_pos
+        )
+
+    @defer.inlineCallbacks
+    def entity_has_changed(self, entity, stream_pos):
+        """Informs the cache that the entity has changed at the given position.
+        This should be called before the change becomes visible at that
+        position, i.e. before the stream token is advanced past it.
+        """
+        stream_pos = int(stream_pos)
+        earliest = yield self._get_earliest_known_stream_pos()
+
+        if stream_pos <= earliest:
+            return
+
+        old_key = self._entity_to_key.get(entity)
+        if old_key is not None:
+            if old_key >= stream_pos:
+                return
+            entities = self._cache[old_key]
+            entities.discard(entity)
+            if not entities:
+                del self._cache[old_key]
+
+        self._cache.setdefault(stream_pos, set()).add(entity)
+        self._entity_to_key[entity] = stream_pos
+
+        while len(self._entity_to_key) > self._max_size:
+            key = self._cache.keys()[0]
+            for forgotten in self._cache.pop(key):
+                self._entity_to_key.pop(forgotten, None)
+            self._earliest_known_stream_pos = max(
+                key, self._earliest_known_stream_pos
+            )
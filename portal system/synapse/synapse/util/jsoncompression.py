@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compression of small JSON blobs against a shared dictionary.
+
+Individual events are too small for zlib to find much redundancy in on their
+own, but most of their bytes are keys and values that every event repeats. We
+prime a raw deflate stream with a dictionary of those common fragments and
+then compress each blob as a continuation of that stream, so back-references
+into the dictionary cost only a few bits. (The stdlib zlib module in python 2
+does not expose preset dictionaries, so we get the same effect by copying a
+compressor which has already been fed the dictionary.)
+
+Compressed blobs are prefixed with a single byte giving the version of the
+dictionary used, so that the dictionary can be retrained without having to
+rewrite existing rows.
+"""
+
+import zlib
+
+
+# Fragments that occur in most events. Deflate prefers nearby matches, so the
+# most common fragments are towards the end.
+_EVENT_JSON_DICTIONARY_V1 = b"".join([
+    b'"m.room.power_levels","content":{"ban":50,"events":{},"events_default"',
+    b':0,"kick":50,"redact":50,"state_default":50,"users":{},"users_default"',
+    b':0},"m.room.join_rules","content":{"join_rule":"invite"}},"public",',
+    b'"m.room.history_visibility","content":{"history_visibility":"shared"}',
+    b',"m.room.create","content":{"creator":"@","m.room.name","m.room.topic',
+    b'","m.room.aliases","content":{"aliases":["#"]},"m.room.redaction",',
+    b'"redacts":"$","m.room.message","content":{"msgtype":"m.text","body":"',
+    b'"membership":"invite"},"membership":"leave"},"membership":"join",',
+    b'"displayname":"","avatar_url":"mxc://"},"type":"m.room.member",',
+    b'"state_key":"@","prev_state":[],"prev_events":[["$",{"sha256":""}]],',
+    b'"auth_events":[["$",{"sha256":""}]],"depth":1,"hashes":{"sha256":"',
+    b'"},"signatures":{"":{"ed25519:auto":""}},"origin":"","origin_server_ts"',
+    b':1,"unsigned":{"age_ts":1},"room_id":"!","sender":"@","user_id":"@",',
+    b'"event_id":"$',
+])
+
+
+class JsonCompressor(object):
+    """Compresses and decompresses JSON blobs against a set of versioned
+    shared dictionaries.
+
+    Args:
+        dictionaries (dict): Map from version number (0-255) to the
+            dictionary for that version.
+        current_version (int): The version to compress new blobs with.
+        level (int): The zlib compression level.
+    """
+
+    def __init__(self, dictionaries, current_version, level=6):
+        self.current_version = current_version
+        self._compressors = {}
+        self._decompressors = {}
+
+        for version, dictionary in dictionaries.items():
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            prefix = compressor.compress(dictionary)
+            prefix += compressor.flush(zlib.Z_SYNC_FLUSH)
+
+            decompressor = zlib.decompressobj(-15)
+            decompressor.decompress(prefix)
+
+            self._compressors[version] = compressor
+            self._decompressors[version] = decompressor
+
+    def compress(self, data):
+        """Compress a byte string with the current dictionary.
+
+        Returns:
+            str: The version byte followed by the raw deflate data.
+        """
+        compressor = self._compressors[self.current_version].copy()
+        return b"".join([
+            chr(self.current_version),
+            compressor.compress(data),
+            compressor.flush(),
+        ])
+
+    def decompress(self, data):
+        """Decompress a blob produced by `compress`.
+
+        Args:
+            data (str|buffer): The compressed blob, as returned by the
+                database.
+        Returns:
+            str: The original byte string.
+        """
+        data = bytes(data)
+        decompressor = self._decompressors[ord(data[0])].copy()
+        return decompressor.decompress(data[1:]) + decompressor.flush()
+
+
+event_json_compressor = JsonCompressor({1: _EVENT_JSON_DICTIONARY_V1}, 1)
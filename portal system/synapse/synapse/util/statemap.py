@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+
+
+# Don't bother folding changes into a new base until there are at least this
+# many of them.
+_MIN_CHANGES_TO_FOLD = 16
+
+
+class StateMap(collections.Mapping):
+    """An immutable map from (type, state_key) to state event, which can be
+    cheaply derived from another.
+
+    The map is made up of a base dict, which is never modified once the map
+    has been built, and a dict of the keys that have been changed on top of
+    it. Deriving a new map with `set` or `set_many` shares the base and only
+    copies the changes, so costs O(changes) rather than O(size of the state).
+    Once the changes outgrow the square root of the size of the base they are
+    folded into a new base, which keeps the cost of long chains of updates
+    down.
+
+    Args:
+        state (dict|None): The initial state. This is not copied, so must not
+            be modified afterwards.
+    """
+
+    def __init__(self, state=None):
+        self._base = state if state is not None else {}
+        self._changes = {}
+        self._len = len(self._base)
+
+    @staticmethod
+    def from_events(events):
+        """Builds a StateMap from an iterable of state events."""
+        return StateMap({(e.type, e.state_key): e for e in events})
+
+    @staticmethod
+    def _derive(base, changes):
+        if len(changes) > max(_MIN_CHANGES_TO_FOLD, len(base) ** 0.5):
+            base = dict(base)
+            base.update(changes)
+            changes = {}
+
+        state_map = StateMap()
+        state_map._base = base
+        state_map._changes = changes
+        state_map._len = len(base) + sum(
+            1 for key in changes if key not in base
+        )
+        return state_map
+
+    def set(self, key, event):
+        """Returns a new StateMap with `key` set to `event`."""
+        changes = dict(self._changes)
+        changes[key] = event
+        return StateMap._derive(self._base, changes)
+
+    def set_many(self, state):
+        """Returns a new StateMap with the keys in the given dict (or
+        StateMap) set.
+        """
+        if not state:
+            return self
+
+        changes = dict(self._changes)
+        changes.update(state)
+        return StateMap._derive(self._base, changes)
+
+    def __getitem__(self, key):
+        try:
+            return self._changes[key]
+        except KeyError:
+            return self._base[key]
+
+    def get(self, key, default=None):
+        try:
+            return self._changes[key]
+        except KeyError:
+            return self._base.get(key, default)
+
+    def __contains__(self, key):
+        return key in self._changes or key in self._base
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def iterkeys(self):
+        for key in self._base:
+            yield key
+        for key in self._changes:
+            if key not in self._base:
+                yield key
+
+    def iteritems(self):
+        changes = self._changes
+        for key, event in self._base.iteritems():
+            if key not in changes:
+                yield key, event
+        for item in changes.iteritems():
+            yield item
+
+    def itervalues(self):
+        for _, event in self.iteritems():
+            yield event
+
+    def keys(self):
+        if not self._changes:
+            return self._base.keys()
+        return list(self.iterkeys())
+
+    def items(self):
+        if not self._changes:
+            return self._base.items()
+        return list(self.iteritems())
+
+    def values(self):
+        if not self._changes:
+            return self._base.values()
+        return list(self.itervalues())
+
+    def __repr__(self):
+        return "StateMap(%r)" % (dict(self.iteritems()),)
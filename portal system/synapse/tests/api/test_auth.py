@@ -17,11 +17,14 @@ from twisted.internet import defer
 
 from mock import Mock
 
-from synapse.api.auth import Auth
+from synapse.api.auth import Auth, AuthContext
+from synapse.api.constants import EventTypes, Membership
 from synapse.api.errors import AuthError
+from synapse.events import FrozenEvent
 from synapse.types import UserID
 from tests.utils import setup_test_homeserver
 
+import itertools
 import pymacaroons
 
 
@@ -293,3 +296,113 @@ class AuthTestCase(unittest.TestCase):
         #     yield self.auth._get_user_from_macaroon(macaroon.serialize())
         # self.assertEqual(401, cm.exception.code)
         # self.assertIn("Invalid macaroon", cm.exception.msg)
+
+
+class AuthCheckTestCase(unittest.TestCase):
+    ROOM_ID = "!room:test"
+    CREATOR = "@creator:test"
+
+    def setUp(self):
+        self.auth = Auth(Mock())
+        self.event_ids = itertools.count()
+
+        self.create = self.create_event(
+            EventTypes.Create, "", {"creator": self.CREATOR},
+        )
+        self.power_levels = self.create_event(
+            EventTypes.PowerLevels, "", {
+                "users": {self.CREATOR: 100, "@zero:test": 0},
+                "users_default": 10,
+                "events": {"m.room.name": 20},
+            },
+        )
+        self.auth_events = {
+            (EventTypes.Create, ""): self.create,
+            (EventTypes.PowerLevels, ""): self.power_levels,
+        }
+        for user_id in (self.CREATOR, "@zero:test", "@other:test"):
+            self.add_member(user_id, Membership.JOIN)
+
+    def create_event(self, type, state_key, content, sender=None):
+        event_dict = {
+            "event_id": "$%d:test" % (next(self.event_ids),),
+            "room_id": self.ROOM_ID,
+            "type": type,
+            "sender": sender or self.CREATOR,
+            "content": content,
+            "prev_events": [],
+            "auth_events": [],
+            "depth": 1,
+        }
+        if state_key is not None:
+            event_dict["state_key"] = state_key
+        return FrozenEvent(event_dict)
+
+    def add_member(self, user_id, membership):
+        event = self.create_event(
+            EventTypes.Member, user_id, {"membership": membership},
+            sender=user_id,
+        )
+        self.auth_events[(EventTypes.Member, user_id)] = event
+        return event
+
+    def test_compiled_power_levels(self):
+        context = self.auth.compile_auth_events(None, self.auth_events)
+
+        self.assertIsInstance(context, AuthContext)
+        self.assertEquals(
+            set(context.keys()),
+            {(EventTypes.Create, ""), (EventTypes.PowerLevels, "")},
+        )
+        self.assertEquals(context.get_user_power_level(self.CREATOR), 100)
+        # A level of zero falls back to the default.
+        self.assertEquals(context.get_user_power_level("@zero:test"), 10)
+        self.assertEquals(context.get_user_power_level("@other:test"), 10)
+        self.assertEquals(context.get_named_level("ban", 50), 50)
+        self.assertEquals(context.get_send_level("m.room.name", True), 20)
+        self.assertEquals(context.get_send_level("m.room.topic", True), 50)
+        self.assertEquals(context.get_send_level("m.room.message", False), 0)
+
+    def test_compiled_contexts_shared(self):
+        event = self.create_event(
+            EventTypes.Message, None, {}, sender="@other:test",
+        )
+        context = self.auth.compile_auth_events(event, self.auth_events)
+
+        # Adding unrelated state doesn't change the context
+        self.add_member("@unrelated:test", Membership.JOIN)
+        self.assertIs(
+            self.auth.compile_auth_events(event, self.auth_events), context
+        )
+        self.assertEquals(
+            context.memberships, {"@other:test": Membership.JOIN},
+        )
+
+    def test_check_memoized(self):
+        event = self.create_event(
+            EventTypes.Name, "", {"name": "Room"}, sender="@other:test",
+        )
+        self.auth._check = Mock(wraps=self.auth._check)
+
+        with self.assertRaises(AuthError):
+            self.auth.check(event, self.auth_events)
+        with self.assertRaises(AuthError):
+            self.auth.check(event, self.auth_events)
+        self.assertEquals(self.auth._check.call_count, 1)
+
+        # Changing an auth event that the check depends on means we check
+        # again.
+        self.add_member("@other:test", Membership.LEAVE)
+        with self.assertRaises(AuthError):
+            self.auth.check(event, self.auth_events)
+        self.assertEquals(self.auth._check.call_count, 2)
+
+        self.add_member("@other:test", Membership.JOIN)
+        self.auth_events[(EventTypes.PowerLevels, "")] = self.create_event(
+            EventTypes.PowerLevels, "", {
+                "users_default": 20,
+                "events": {"m.room.name": 20},
+            },
+        )
+        self.auth.check(event, self.auth_events)
+        self.assertEquals(self.auth._check.call_count, 3)
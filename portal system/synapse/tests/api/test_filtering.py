@@ -23,6 +23,7 @@ from tests.utils import (
 )
 
 from synapse.types import UserID
+from synapse.api.errors import SynapseError
 from synapse.api.filtering import FilterCollection, Filter
 
 user_localpart = "test_user"
@@ -505,3 +506,25 @@ class FilteringTestCase(unittest.TestCase):
         )
 
         self.assertEquals(filter.filter_json, user_filter_json)
+
+    def test_lazy_load_members(self):
+        self.assertFalse(FilterCollection({}).lazy_load_members())
+        self.assertTrue(FilterCollection({
+            "room": {
+                "state": {
+                    "lazy_load_members": True
+                }
+            }
+        }).lazy_load_members())
+
+        with self.assertRaises(SynapseError):
+            self.filtering.add_user_filter(
+                user_localpart=user_localpart,
+                user_filter={
+                    "room": {
+                        "state": {
+                            "lazy_load_members": "yes"
+                        }
+                    }
+                },
+            )
@@ -12,7 +12,9 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from synapse.appservice import ApplicationService
+from synapse.appservice import (
+    ApplicationService, ApplicationServiceInterestIndex,
+)
 
 from mock import Mock, PropertyMock
 from tests import unittest
@@ -227,3 +229,110 @@ class ApplicationServiceTestCase(unittest.TestCase):
             event=self.event,
             member_list=join_list
         ))
+
+
+class ApplicationServiceInterestIndexTestCase(unittest.TestCase):
+
+    def _mkservice(self, users=[], aliases=[], rooms=[], sender=None):
+        return ApplicationService(
+            url="some_url",
+            token="some_token",
+            sender=sender,
+            namespaces={
+                ApplicationService.NS_USERS: [_regex(r) for r in users],
+                ApplicationService.NS_ALIASES: [_regex(r) for r in aliases],
+                ApplicationService.NS_ROOMS: [_regex(r) for r in rooms],
+            }
+        )
+
+    def setUp(self):
+        self.irc = self._mkservice(
+            users=["@irc_.*"], aliases=["#irc_.*"], sender="@irc:matrix.org",
+        )
+        self.xmpp = self._mkservice(
+            users=["@xmpp_.*", "@irc_bridged_.*"], rooms=["!xmpp.*"],
+        )
+        self.services = [self.irc, self.xmpp]
+        self.index = ApplicationServiceInterestIndex(self.services)
+
+        self.event = Mock(
+            type="m.something", room_id="!foo:bar", sender="@someone:somewhere"
+        )
+
+    def _assert_matches_is_interested(self, **kwargs):
+        self.assertEquals(
+            self.index.get_interested_services(self.event, **kwargs),
+            [s for s in self.services if s.is_interested(self.event, **kwargs)]
+        )
+
+    def test_no_match(self):
+        self.assertEquals(self.index.get_interested_services(self.event), [])
+
+    def test_sender_match(self):
+        self.event.sender = "@irc_foo:matrix.org"
+        self._assert_matches_is_interested()
+        self.assertEquals(
+            self.index.get_interested_services(self.event), [self.irc]
+        )
+
+    def test_multiple_services(self):
+        self.event.sender = "@irc_bridged_foo:matrix.org"
+        self.assertEquals(
+            self.index.get_interested_services(self.event),
+            [self.irc, self.xmpp]
+        )
+
+        # Again, now that the result is cached.
+        self.assertEquals(
+            self.index.get_interested_services(self.event),
+            [self.irc, self.xmpp]
+        )
+
+    def test_service_sender(self):
+        self.event.sender = "@irc:matrix.org"
+        self.assertEquals(
+            self.index.get_interested_services(self.event), [self.irc]
+        )
+
+    def test_member_state_key(self):
+        self.event.type = "m.room.member"
+        self.event.state_key = "@xmpp_foo:matrix.org"
+        self._assert_matches_is_interested()
+        self.assertEquals(
+            self.index.get_interested_services(self.event), [self.xmpp]
+        )
+
+    def test_room_alias_and_members(self):
+        self.event.room_id = "!xmpp:matrix.org"
+        kwargs = {
+            "aliases_for_event": ["#irc_foo:matrix.org"],
+            "member_list": ["@xmpp_foo:matrix.org"],
+        }
+        self._assert_matches_is_interested(**kwargs)
+        self.assertEquals(
+            self.index.get_interested_services(self.event, **kwargs),
+            [self.irc, self.xmpp]
+        )
+
+    def test_restrict_to(self):
+        self.event.sender = "@irc_foo:matrix.org"
+        self.event.room_id = "!xmpp:matrix.org"
+        for ns in ApplicationService.NS_LIST:
+            self._assert_matches_is_interested(restrict_to=ns)
+
+        self.assertEquals(
+            self.index.get_interested_services(
+                None, restrict_to=ApplicationService.NS_ALIASES,
+                aliases_for_event=["#irc_foo:matrix.org"],
+            ),
+            [self.irc]
+        )
+
+    def test_uncombinable_regexes(self):
+        backref = self._mkservice(users=[r"@(a)\1.*"])
+        index = ApplicationServiceInterestIndex([self.irc, backref])
+
+        self.event.sender = "@aa:matrix.org"
+        self.assertEquals(index.get_interested_services(self.event), [backref])
+        self.event.sender = "@ab:matrix.org"
+        self.assertEquals(index.get_interested_services(self.event), [])
@@ -17,7 +17,17 @@
 from .. import unittest
 
 from synapse.events import FrozenEvent
-from synapse.events.utils import prune_event
+from synapse.events.utils import (
+    prune_event, serialize_event, serialize_event_to_json,
+    format_event_for_client_v1, format_event_for_client_v2_without_room_id,
+)
+
+from canonicaljson import encode_canonical_json
+
+import json
+import simplejson
+import ujson
+
 
 class PruneEventTestCase(unittest.TestCase):
     """ Asserts that a new event constructed with `evdict` will look like
@@ -113,3 +123,76 @@ class PruneEventTestCase(unittest.TestCase):
                 'unsigned': {},
             }
         )
+
+
+class SerializeEventToJsonTestCase(unittest.TestCase):
+    """ Asserts that the cached JSON serialization of an event matches what
+    `serialize_event` would produce. """
+    def decode(self, raw_json):
+        return json.loads(encode_canonical_json({"e": raw_json}))["e"]
+
+    def make_event(self, **unsigned):
+        ev = FrozenEvent({
+            'type': 'm.room.message',
+            'room_id': '!1:domain',
+            'sender': '@2:domain',
+            'event_id': '$3:domain',
+            'content': {'body': u'caf\xe9'},
+            'unsigned': unsigned,
+        })
+        ev.internal_metadata.token_id = 5
+        ev.internal_metadata.txn_id = "txn"
+        return ev
+
+    def test_matches_serialize_event(self):
+        for event_format in (
+            format_event_for_client_v1,
+            format_event_for_client_v2_without_room_id,
+        ):
+            ev = self.make_event(age_ts=1000, replaces_state="$0:domain")
+            self.assertEquals(
+                self.decode(serialize_event_to_json(
+                    ev, 1500, event_format=event_format, token_id=5,
+                )),
+                serialize_event(
+                    ev, 1500, event_format=event_format, token_id=5,
+                ),
+            )
+
+    def test_per_request_fields(self):
+        ev = self.make_event(age_ts=1000)
+        event_format = format_event_for_client_v2_without_room_id
+
+        first = self.decode(serialize_event_to_json(
+            ev, 1500, event_format=event_format, token_id=5,
+        ))
+        second = self.decode(serialize_event_to_json(
+            ev, 2500, event_format=event_format,
+        ))
+
+        self.assertEquals(first["unsigned"], {
+            "age": 500, "transaction_id": "txn",
+        })
+        self.assertEquals(second["unsigned"], {"age": 1500})
+
+    def test_new_event_object_replaces_entry(self):
+        ev = self.make_event()
+        self.decode(serialize_event_to_json(ev, 0))
+
+        pruned = prune_event(ev)
+        self.assertEquals(
+            self.decode(serialize_event_to_json(pruned, 0)),
+            serialize_event(pruned, 0),
+        )
+
+    def test_encoders_embed_json(self):
+        ev = self.make_event(age_ts=1000)
+        response = {"chunk": [serialize_event_to_json(ev, 1500)]}
+        expected = {"chunk": [serialize_event(ev, 1500)]}
+
+        for encoded in (
+            encode_canonical_json(response),
+            simplejson.dumps(response, ensure_ascii=False),
+            ujson.dumps(response, ensure_ascii=False),
+        ):
+            self.assertEquals(json.loads(encoded), expected)
@@ -16,6 +16,7 @@
 from twisted.internet import defer
 from .. import unittest
 
+from synapse.appservice import ApplicationService
 from synapse.handlers.appservice import ApplicationServicesHandler
 
 from mock import Mock
@@ -26,6 +27,8 @@ class AppServiceHandlerTestCase(unittest.TestCase):
 
     def setUp(self):
         self.mock_store = Mock()
+        self.mock_store.get_aliases_for_room = Mock(return_value=[])
+        self.mock_store.get_users_in_room = Mock(return_value=[])
         self.mock_as_api = Mock()
         self.mock_scheduler = Mock()
         hs = Mock()
@@ -132,8 +135,13 @@ class AppServiceHandlerTestCase(unittest.TestCase):
 
 
     def _mkservice(self, is_interested):
-        service = Mock()
-        service.is_interested = Mock(return_value=is_interested)
-        service.token = "mock_service_token"
-        service.url = "mock_service_url"
-        return service
+        regexes = [{"regex": ".*", "exclusive": False}] if is_interested else []
+        return ApplicationService(
+            token="mock_service_token",
+            url="mock_service_url",
+            namespaces={
+                ApplicationService.NS_USERS: list(regexes),
+                ApplicationService.NS_ALIASES: list(regexes),
+                ApplicationService.NS_ROOMS: list(regexes),
+            },
+        )
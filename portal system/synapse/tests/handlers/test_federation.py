@@ -128,3 +128,112 @@ class FederationTestCase(unittest.TestCase):
         self.notifier.on_new_room_event.assert_called_once_with(
             ANY, 1, 1, extra_users=[]
         )
+
+
+class FilterEventsForServerTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(
+            "test",
+            datastore=NonCallableMock(spec_set=[
+                "get_state_group_for_events",
+                "get_state_for_events",
+            ]),
+            resource_for_federation=NonCallableMock(),
+            http_client=NonCallableMock(spec_set=[]),
+            keyring=Mock(),
+        )
+
+        self.datastore = hs.get_datastore()
+        self.handler = FederationHandler(hs)
+
+        self.groups = {}
+        self.state = {}
+
+        def get_state_group_for_events(event_ids):
+            return defer.succeed({e: self.groups.get(e) for e in event_ids})
+        self.datastore.get_state_group_for_events.side_effect = (
+            get_state_group_for_events
+        )
+
+        def get_state_for_events(event_ids, types):
+            results = {}
+            for event_id in event_ids:
+                results[event_id] = {
+                    key: ev
+                    for key, ev in self.state[self.groups[event_id]].items()
+                    if (key[0], key[1]) in types or (key[0], None) in types
+                }
+            return defer.succeed(results)
+        self.datastore.get_state_for_events.side_effect = get_state_for_events
+
+    def add_group(self, group, visibility, members):
+        state = {
+            (EventTypes.RoomHistoryVisibility, ""): FrozenEvent({
+                "type": EventTypes.RoomHistoryVisibility,
+                "event_id": "$vis%d:test" % (group,),
+                "room_id": "!room:test",
+                "state_key": "",
+                "content": {"history_visibility": visibility},
+            }),
+        }
+        for user_id, membership in members.items():
+            state[(EventTypes.Member, user_id)] = FrozenEvent({
+                "type": EventTypes.Member,
+                "event_id": "$member%d%s" % (group, user_id,),
+                "room_id": "!room:test",
+                "state_key": user_id,
+                "content": {"membership": membership},
+            })
+        self.state[group] = state
+
+    def create_event(self, event_id, group):
+        self.groups[event_id] = group
+        return FrozenEvent({
+            "type": EventTypes.Message,
+            "event_id": event_id,
+            "room_id": "!room:test",
+            "sender": "@alice:test",
+            "content": {"body": "secret"},
+        })
+
+    @defer.inlineCallbacks
+    def test_filter_events_for_server(self):
+        self.add_group(1, "joined", {"@bob:remote": "join"})
+        self.add_group(2, "shared", {})
+        self.add_group(3, "invited", {"@carol:other": "invite"})
+
+        events = [
+            self.create_event("$a:test", 1),
+            self.create_event("$b:test", 1),
+            self.create_event("$c:test", 2),
+            self.create_event("$d:test", 3),
+            self.create_event("$e:test", None),
+        ]
+
+        def visible(filtered):
+            return [e.event_id for e in filtered if "body" in e.content]
+
+        filtered = yield self.handler._filter_events_for_server(
+            "remote", "!room:test", events
+        )
+        self.assertEquals(
+            ["$a:test", "$b:test", "$c:test", "$e:test"], visible(filtered)
+        )
+
+        # Each state group is only looked at once, and the membership only for
+        # the groups where it matters.
+        calls = self.datastore.get_state_for_events.call_args_list
+        self.assertEquals(2, len(calls))
+        self.assertItemsEqual(["$a:test", "$c:test", "$d:test"], calls[0][0][0])
+        self.assertItemsEqual(["$a:test", "$d:test"], calls[1][0][0])
+
+        # Another server can be answered from the cache.
+        filtered = yield self.handler._filter_events_for_server(
+            "other", "!room:test", events
+        )
+        self.assertEquals(
+            ["$c:test", "$d:test", "$e:test"], visible(filtered)
+        )
+        self.assertEquals(2, self.datastore.get_state_for_events.call_count)
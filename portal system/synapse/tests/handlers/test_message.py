@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes, Membership
+from synapse.crypto.event_signing import add_hashes_and_signatures
+from synapse.types import UserID, RoomID
+from tests.storage.event_injector import EventInjector
+
+from tests.utils import setup_test_homeserver
+
+from mock import Mock
+
+
+class FilterEventsForClientTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.hs = hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+
+        self.store = hs.get_datastore()
+        self.event_builder_factory = hs.get_event_builder_factory()
+        self.event_injector = EventInjector(hs)
+        self.message_handler = hs.get_handlers().message_handler
+        self.state_handler = hs.get_state_handler()
+        self.auth = hs.get_auth()
+
+        self.alice = UserID.from_string("@alice:test")
+        self.bob = UserID.from_string("@bob:test")
+        self.room = RoomID.from_string("!abc123:test")
+
+        # The caches are shared between homeservers, so make sure we don't
+        # see the history of another test's room.
+        self.store.get_history_visibilities_for_room.invalidate_all()
+
+    @defer.inlineCallbacks
+    def inject_visibility(self, visibility):
+        builder = self.event_builder_factory.new({
+            "type": EventTypes.RoomHistoryVisibility,
+            "sender": self.alice.to_string(),
+            "state_key": "",
+            "room_id": self.room.to_string(),
+            "content": {"history_visibility": visibility},
+        })
+
+        event, context = yield self.message_handler._create_new_client_event(
+            builder
+        )
+
+        yield self.store.persist_event(event, context)
+
+        defer.returnValue(event)
+
+    @defer.inlineCallbacks
+    def inject_messages(self, count):
+        events = []
+        for i in range(count):
+            event = yield self.event_injector.inject_message(
+                self.room, self.alice, u"message %d" % (i,)
+            )
+            events.append(event)
+        defer.returnValue(events)
+
+    @defer.inlineCallbacks
+    def filter_events(self, events, fast_path=True):
+        if not fast_path:
+            self.message_handler._get_events_visible_from_history = Mock(
+                return_value=defer.succeed(set())
+            )
+        try:
+            filtered = yield self.message_handler._filter_events_for_client(
+                self.bob.to_string(), events,
+            )
+        finally:
+            self.message_handler.__dict__.pop(
+                "_get_events_visible_from_history", None
+            )
+        defer.returnValue([e.event_id for e in filtered])
+
+    @defer.inlineCallbacks
+    def test_shared_room(self):
+        yield self.event_injector.create_room(self.room)
+        yield self.event_injector.inject_room_member(
+            self.room, self.alice, Membership.JOIN
+        )
+        yield self.inject_visibility("world_readable")
+        events = yield self.inject_messages(2)
+        events.append((yield self.inject_visibility("shared")))
+        events.extend((yield self.inject_messages(2)))
+
+        self.store.get_state_for_events = Mock(
+            side_effect=AssertionError("state should not be looked up")
+        )
+
+        filtered = yield self.filter_events(events)
+        self.assertEquals([e.event_id for e in events], filtered)
+
+    @defer.inlineCallbacks
+    def test_event_forked_from_before_join(self):
+        yield self.event_injector.create_room(self.room)
+        yield self.event_injector.inject_room_member(
+            self.room, self.alice, Membership.JOIN
+        )
+        yield self.inject_visibility("joined")
+        before_join = yield self.event_injector.inject_message(
+            self.room, self.alice, u"before"
+        )
+        yield self.event_injector.inject_room_member(
+            self.room, self.bob, Membership.JOIN
+        )
+
+        # A message sent concurrently with bob's join comes after it in the
+        # stream, but bob wasn't in the room as far as it is concerned.
+        builder = self.event_builder_factory.new({
+            "type": EventTypes.Message,
+            "sender": self.alice.to_string(),
+            "room_id": self.room.to_string(),
+            "content": {"body": u"forked", "msgtype": u"m.text"},
+        })
+        builder.prev_events = yield self.store.add_event_hashes(
+            [before_join.event_id]
+        )
+        builder.depth = before_join.depth + 1
+        context = yield self.state_handler.compute_event_context(builder)
+        yield self.auth.add_auth_events(builder, context)
+        add_hashes_and_signatures(
+            builder, self.hs.hostname, self.hs.config.signing_key[0]
+        )
+        forked = builder.build()
+        yield self.store.persist_event(forked, context)
+
+        filtered = yield self.filter_events([forked])
+        self.assertEquals([], filtered)
+
+    @defer.inlineCallbacks
+    def test_membership_and_visibility_changes(self):
+        yield self.event_injector.create_room(self.room)
+        yield self.event_injector.inject_room_member(
+            self.room, self.alice, Membership.JOIN
+        )
+        events = yield self.inject_messages(2)
+        events.append((yield self.inject_visibility("joined")))
+        events.extend((yield self.inject_messages(2)))
+        events.append((yield self.event_injector.inject_room_member(
+            self.room, self.bob, Membership.JOIN
+        )))
+        events.extend((yield self.inject_messages(2)))
+        events.append((yield self.event_injector.inject_room_member(
+            self.room, self.bob, Membership.LEAVE
+        )))
+        events.extend((yield self.inject_messages(2)))
+        events.append((yield self.inject_visibility("shared")))
+        events.extend((yield self.inject_messages(2)))
+
+        expected = yield self.filter_events(events, fast_path=False)
+        filtered = yield self.filter_events(events)
+
+        self.assertEquals(expected, filtered)
+
+        # Bob's leave and the messages sent while the room was visible to
+        # joined members only and bob wasn't in it should have been hidden.
+        self.assertEquals(len(events) - 5, len(filtered))
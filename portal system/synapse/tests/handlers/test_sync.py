@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes, Membership
+from synapse.api.filtering import FilterCollection
+from synapse.handlers.sync import SyncConfig, SYNC_SNAPSHOT_MAX_AGE_MS
+from synapse.types import UserID, RoomID
+from tests.storage.event_injector import EventInjector
+
+from tests.utils import setup_test_homeserver
+
+from mock import Mock
+
+
+class SyncTestCase(unittest.TestCase):
+    """Base class for tests which sync as @alice:test against a test
+    homeserver.
+    """
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+
+        self.event_injector = EventInjector(hs)
+        self.store = hs.get_datastore()
+        self.sync_handler = hs.get_handlers().sync_handler
+        self.clock = hs.get_clock()
+
+        self.alice = UserID.from_string("@alice:test")
+
+    def make_sync_config(self, filter_json):
+        return SyncConfig(
+            user=self.alice,
+            filter=FilterCollection(filter_json),
+            request_key=None,
+            token_id=1,
+        )
+
+    def ignore_ephemeral_events(self):
+        self.sync_handler.ephemeral_by_room = Mock(
+            side_effect=lambda config, now_token, since_token=None: (
+                defer.succeed((now_token, {}))
+            )
+        )
+
+
+class LazyLoadMembersTestCase(SyncTestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(LazyLoadMembersTestCase, self).setUp()
+
+        # We're not interested in the ephemeral events here.
+        self.ignore_ephemeral_events()
+
+        self.bob = UserID.from_string("@bob:test")
+        self.carol = UserID.from_string("@carol:test")
+        self.room = RoomID.from_string("!abc123:test")
+
+        self.sync_config = self.make_sync_config({
+            "room": {
+                "timeline": {"limit": 2},
+                "state": {"lazy_load_members": True},
+            },
+        })
+
+    def members(self, room_sync):
+        return sorted(
+            state_key for (event_type, state_key) in room_sync.state
+            if event_type == EventTypes.Member
+        )
+
+    @defer.inlineCallbacks
+    def test_lazy_load_members(self):
+        for user in (self.alice, self.bob, self.carol):
+            yield self.event_injector.inject_room_member(
+                self.room, user, Membership.JOIN
+            )
+        for i in range(3):
+            yield self.event_injector.inject_message(
+                self.room, self.bob, u"test %d" % (i,)
+            )
+
+        result = yield self.sync_handler.full_state_sync(
+            self.sync_config, None
+        )
+        room_sync, = result.joined
+        self.assertEquals(
+            ["@alice:test", "@bob:test"], self.members(room_sync)
+        )
+
+        # Carol is sent once she speaks, but bob isn't sent again.
+        yield self.event_injector.inject_message(
+            self.room, self.carol, u"hello"
+        )
+
+        result = yield self.sync_handler.incremental_sync_with_gap(
+            self.sync_config, result.next_batch
+        )
+        room_sync, = result.joined
+        self.assertEquals(["@carol:test"], self.members(room_sync))
+
+
+class SyncSnapshotTestCase(SyncTestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(SyncSnapshotTestCase, self).setUp()
+
+        self.sync_handler.sync_snapshots = True
+        self.ignore_ephemeral_events()
+
+        # Count the rooms which get synced from scratch.
+        full_state_sync_for_joined_room = (
+            self.sync_handler.full_state_sync_for_joined_room
+        )
+        self.sync_handler.full_state_sync_for_joined_room = Mock(
+            side_effect=full_state_sync_for_joined_room
+        )
+
+        self.rooms = [
+            RoomID.from_string("!room%d:test" % (i,)) for i in range(3)
+        ]
+
+        self.sync_config = self.make_sync_config(
+            {"room": {"timeline": {"limit": 2}}}
+        )
+
+    def synced_rooms(self):
+        synced = sorted(
+            call[1]["room_id"] for call in
+            self.sync_handler.full_state_sync_for_joined_room.call_args_list
+        )
+        self.sync_handler.full_state_sync_for_joined_room.reset_mock()
+        return synced
+
+    def summarise(self, result):
+        return {
+            room_sync.room_id: (
+                [e.event_id for e in room_sync.timeline.events],
+                room_sync.timeline.limited,
+                sorted(e.event_id for e in room_sync.state.values()),
+            )
+            for room_sync in result.joined
+        }
+
+    @defer.inlineCallbacks
+    def test_snapshot(self):
+        for room in self.rooms:
+            yield self.event_injector.inject_room_member(
+                room, self.alice, Membership.JOIN
+            )
+            for i in range(3):
+                yield self.event_injector.inject_message(
+                    room, self.alice, u"test %d" % (i,)
+                )
+
+        first = yield self.sync_handler.full_state_sync(self.sync_config, None)
+        self.assertEquals(
+            sorted(room.to_string() for room in self.rooms),
+            self.synced_rooms(),
+        )
+
+        snapshot = yield self.store.get_sync_snapshot(
+            self.alice.to_string(),
+            self.sync_handler._sync_snapshot_key(self.sync_config),
+        )
+        self.assertEquals(first.next_batch.to_string(), snapshot[0])
+
+        # Nothing has changed, so the whole sync comes from the snapshot.
+        second = yield self.sync_handler.full_state_sync(
+            self.sync_config, None
+        )
+        self.assertEquals([], self.synced_rooms())
+        self.assertEquals(self.summarise(first), self.summarise(second))
+
+        # Only the room with a new message is synced again.
+        yield self.event_injector.inject_message(
+            self.rooms[1], self.alice, u"hello"
+        )
+        third = yield self.sync_handler.full_state_sync(self.sync_config, None)
+        self.assertEquals([self.rooms[1].to_string()], self.synced_rooms())
+
+        expected = self.summarise(first)
+        room_sync, = [
+            r for r in third.joined if r.room_id == self.rooms[1].to_string()
+        ]
+        self.assertEquals(u"hello", room_sync.timeline.events[-1].content["body"])
+        expected[room_sync.room_id] = self.summarise(third)[room_sync.room_id]
+        self.assertEquals(expected, self.summarise(third))
+
+        # The snapshot was updated, so the next sync doesn't need any rooms.
+        yield self.sync_handler.full_state_sync(self.sync_config, None)
+        self.assertEquals([], self.synced_rooms())
+
+
+    @defer.inlineCallbacks
+    def test_prune_snapshots(self):
+        yield self.event_injector.inject_room_member(
+            self.rooms[0], self.alice, Membership.JOIN
+        )
+        yield self.sync_handler.full_state_sync(self.sync_config, None)
+        self.synced_rooms()
+
+        snapshot_key = self.sync_handler._sync_snapshot_key(self.sync_config)
+
+        self.clock.advance_time_msec(SYNC_SNAPSHOT_MAX_AGE_MS / 2)
+        yield self.sync_handler._prune_sync_snapshots()
+        snapshot = yield self.store.get_sync_snapshot(
+            self.alice.to_string(), snapshot_key
+        )
+        self.assertIsNotNone(snapshot)
+
+        self.clock.advance_time_msec(SYNC_SNAPSHOT_MAX_AGE_MS)
+        yield self.sync_handler._prune_sync_snapshots()
+        snapshot = yield self.store.get_sync_snapshot(
+            self.alice.to_string(), snapshot_key
+        )
+        self.assertIsNone(snapshot)
+
+        # So the next initial sync starts from scratch.
+        yield self.sync_handler.full_state_sync(self.sync_config, None)
+        self.assertEquals([self.rooms[0].to_string()], self.synced_rooms())
+
+class IncrementalSyncTestCase(SyncTestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(IncrementalSyncTestCase, self).setUp()
+
+        self.rooms = [
+            RoomID.from_string("!room%d:test" % (i,)) for i in range(5)
+        ]
+
+        self.sync_config = self.make_sync_config(
+            {"room": {"timeline": {"limit": 2}}}
+        )
+
+    @defer.inlineCallbacks
+    def count_queries(self, d):
+        queries = []
+        run_interaction = self.store.runInteraction
+
+        def record_interaction(desc, func, *args, **kwargs):
+            queries.append(desc)
+            return run_interaction(desc, func, *args, **kwargs)
+
+        self.store.runInteraction = record_interaction
+        try:
+            result = yield d()
+        finally:
+            self.store.runInteraction = run_interaction
+
+        defer.returnValue((result, queries))
+
+    @defer.inlineCallbacks
+    def test_only_changed_rooms(self):
+        for room in self.rooms:
+            yield self.event_injector.inject_room_member(
+                room, self.alice, Membership.JOIN
+            )
+
+        result = yield self.sync_handler.full_state_sync(
+            self.sync_config, None
+        )
+        since_token = result.next_batch
+
+        # Nothing has happened, so we shouldn't need the database at all.
+        result, queries = yield self.count_queries(
+            lambda: self.sync_handler.incremental_sync_with_gap(
+                self.sync_config, since_token
+            )
+        )
+        self.assertEquals([], result.joined)
+        self.assertEquals([], queries)
+
+        yield self.event_injector.inject_message(
+            self.rooms[3], self.alice, u"hello"
+        )
+
+        result, queries = yield self.count_queries(
+            lambda: self.sync_handler.incremental_sync_with_gap(
+                self.sync_config, since_token
+            )
+        )
+        room_sync, = result.joined
+        self.assertEquals(self.rooms[3].to_string(), room_sync.room_id)
+        self.assertEquals(
+            [u"hello"], [e.content["body"] for e in room_sync.timeline.events]
+        )
+        self.assertEquals(["get_room_events_stream"], queries)
+
+        # A sync that gets cut off at the timeline limit also only looks at
+        # the rooms which changed.
+        for i in range(3):
+            yield self.event_injector.inject_message(
+                self.rooms[1], self.alice, u"test %d" % (i,)
+            )
+
+        get_recent_events_for_room = Mock(
+            side_effect=self.store.get_recent_events_for_room
+        )
+        self.store.get_recent_events_for_room = get_recent_events_for_room
+
+        result = yield self.sync_handler.incremental_sync_with_gap(
+            self.sync_config, since_token
+        )
+        changed_rooms = [self.rooms[1].to_string(), self.rooms[3].to_string()]
+        self.assertEquals(
+            sorted(changed_rooms),
+            sorted(room_sync.room_id for room_sync in result.joined),
+        )
+        # The timeline and state are only looked up for the changed rooms.
+        self.assertTrue(get_recent_events_for_room.called)
+        self.assertLessEqual(
+            set(c[0][0] for c in get_recent_events_for_room.call_args_list),
+            set(changed_rooms),
+        )
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+
+from twisted.test.proto_helpers import StringTransport
+from twisted.web import http
+
+from synapse.http.server import (
+    StreamedJsonObject, StreamedJsonList, encode_fast_json, respond_with_json,
+    respond_with_json_stream,
+)
+
+from synapse.events.utils import EncodedEventJSON
+
+from frozendict import frozendict
+from mock import patch
+from simplejson import RawJSON
+
+import json
+import ujson
+
+
+class EncodeFastJsonTestCase(unittest.TestCase):
+
+    def test_frozendicts(self):
+        obj = frozendict({
+            "content": frozendict({
+                "body": "hello",
+                "info": frozendict({"w": 1, "h": 2}),
+            }),
+            "unsigned": frozendict(),
+            "list": [frozendict({"a": frozendict()})],
+        })
+        self.assertEquals(json.loads(encode_fast_json(obj)), {
+            "content": {"body": "hello", "info": {"w": 1, "h": 2}},
+            "unsigned": {},
+            "list": [{"a": {}}],
+        })
+        self.assertEquals(encode_fast_json(frozendict()), "{}")
+
+    def test_raw_json(self):
+        obj = {
+            "event": RawJSON('{"type":"m.room.message"}'),
+            "events": [RawJSON('{"a":1}'), RawJSON("[]")],
+        }
+        self.assertEquals(
+            encode_fast_json(obj["events"]), '[{"a":1},[]]'
+        )
+        self.assertEquals(json.loads(encode_fast_json(obj)), {
+            "event": {"type": "m.room.message"},
+            "events": [{"a": 1}, []],
+        })
+
+    def test_utf8(self):
+        encoded = encode_fast_json({u"caf\xe9": [u"\u2603"]})
+        self.assertIsInstance(encoded, bytes)
+        self.assertEquals(
+            encoded, u'{"caf\xe9":["\u2603"]}'.encode("UTF-8")
+        )
+        self.assertNotIn("\\u", encoded)
+
+    def test_matches_ujson(self):
+        obj = {
+            "next_batch": "s72594_4483_1934",
+            "rooms": {
+                "join": {
+                    "!726s6s6q:example.com": {
+                        "timeline": {
+                            "events": [{
+                                "content": {"body": u"I am a fish \u2603"},
+                                "origin_server_ts": 1417731086795,
+                                "age": -3,
+                                "ratio": 0.5,
+                            }],
+                            "limited": True,
+                            "prev_batch": None,
+                        },
+                        "state": {"events": []},
+                    },
+                },
+            },
+        }
+        self.assertEquals(
+            json.loads(encode_fast_json(obj)),
+            json.loads(ujson.dumps(obj, ensure_ascii=False)),
+        )
+
+
+class StreamedJsonResponseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = StringTransport()
+        channel = http.HTTPChannel()
+        channel.makeConnection(self.transport)
+
+        self.request = http.Request(channel, False)
+        self.request.gotLength(0)
+        channel.requests.append(self.request)
+        self.request.method = "GET"
+        self.request.clientproto = "HTTP/1.1"
+
+    def pump(self):
+        while self.transport.producer is not None:
+            self.transport.producer.resumeProducing()
+
+    def parse_response(self):
+        head, body = self.transport.value().split("\r\n\r\n", 1)
+        headers = dict(
+            line.split(": ", 1) for line in head.split("\r\n")[1:]
+        )
+
+        if headers.get("Transfer-Encoding") == "chunked":
+            chunks = []
+            decoder = http._ChunkedTransferDecoder(chunks.append, lambda _: None)
+            decoder.dataReceived(body)
+            body = b"".join(chunks)
+
+        return headers, json.loads(body)
+
+    def make_rooms(self, generated):
+        for i in range(100):
+            generated.append(i)
+            yield (
+                "!room%d:test" % (i,),
+                {"timeline": {"events": [{"body": u"☃" * i}]}},
+            )
+
+    def test_streamed(self):
+        generated = []
+        response = StreamedJsonObject([
+            ("next_batch", "s1"),
+            ("rooms", StreamedJsonObject([
+                ("join", StreamedJsonObject(self.make_rooms(generated))),
+                ("leave", StreamedJsonObject([])),
+            ])),
+            ("presence", StreamedJsonList(iter([1, 2, 3]))),
+            ("empty", StreamedJsonList([])),
+        ])
+
+        respond_with_json_stream(self.request, 200, response, chunk_size=256)
+
+        # Only enough of the rooms to fill the first chunk get encoded before
+        # the transport asks for more.
+        self.assertLess(len(generated), 100)
+
+        self.pump()
+
+        self.assertEquals(len(generated), 100)
+        self.assertTrue(self.request.finished)
+
+        headers, body = self.parse_response()
+        self.assertEquals(headers["Transfer-Encoding"], "chunked")
+        self.assertNotIn("Content-Length", headers)
+        self.assertEquals(body, {
+            "next_batch": "s1",
+            "rooms": {
+                "join": {
+                    "!room%d:test" % (i,): {
+                        "timeline": {"events": [{"body": u"☃" * i}]},
+                    }
+                    for i in range(100)
+                },
+                "leave": {},
+            },
+            "presence": [1, 2, 3],
+            "empty": [],
+        })
+
+    def test_small_response_not_chunked(self):
+        response = StreamedJsonObject([
+            ("rooms", StreamedJsonList(iter([{"room_id": "!a:test"}]))),
+        ])
+
+        respond_with_json_stream(self.request, 200, response)
+
+        self.assertIsNone(self.transport.producer)
+        self.assertTrue(self.request.finished)
+
+        headers, body = self.parse_response()
+        self.assertNotIn("Transfer-Encoding", headers)
+        self.assertEquals(headers["Content-Length"], "33")
+        self.assertEquals(body, {"rooms": [{"room_id": "!a:test"}]})
+
+    def test_error_drops_connection(self):
+        def rooms():
+            for i in range(10):
+                yield {"room_id": "!room%d:test" % (i,)}
+            raise Exception("Failed to encode room")
+
+        respond_with_json_stream(
+            self.request, 200, StreamedJsonList(rooms()), chunk_size=32,
+        )
+        self.pump()
+
+        self.assertFalse(self.request.finished)
+        self.assertTrue(self.transport.disconnecting)
+
+    @patch("synapse.events.USE_FROZEN_DICTS", False)
+    def test_ujson_without_frozen_dicts(self):
+        response = {
+            "chunk": [EncodedEventJSON('{"type":"m.room.message"}')],
+            "body": u"\u2603",
+        }
+
+        respond_with_json(self.request, 200, response, canonical_json=False)
+
+        _, body = self.parse_response()
+        self.assertEquals(body, {
+            "chunk": [{"type": "m.room.message"}],
+            "body": u"\u2603",
+        })
+
+    @patch("synapse.events.USE_FROZEN_DICTS", False)
+    def test_streamed_ujson_without_frozen_dicts(self):
+        response = StreamedJsonObject([
+            ("rooms", StreamedJsonObject(self.make_rooms([]))),
+        ])
+
+        respond_with_json_stream(self.request, 200, response, chunk_size=256)
+        self.pump()
+
+        _, body = self.parse_response()
+        self.assertEquals(body, {
+            "rooms": {
+                "!room%d:test" % (i,): {
+                    "timeline": {"events": [{"body": u"\u2603" * i}]},
+                }
+                for i in range(100)
+            },
+        })
+
+    def test_canonical_json_not_streamed(self):
+        response = StreamedJsonObject([
+            ("b", StreamedJsonList(iter([1, 2]))),
+            ("a", StreamedJsonObject(iter([("c", 3)]))),
+        ])
+
+        respond_with_json(self.request, 200, response, canonical_json=True)
+
+        self.assertTrue(self.request.finished)
+        self.assertTrue(
+            self.transport.value().endswith('{"a":{"c":3},"b":[1,2]}')
+        )
@@ -79,3 +79,5 @@ class EventInjector:
         )
 
         yield self.store.persist_event(event, context)
+
+        defer.returnValue(event)
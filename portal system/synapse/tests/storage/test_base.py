@@ -26,6 +26,8 @@ from synapse.server import HomeServer
 from synapse.storage._base import SQLBaseStore
 from synapse.storage.engines import create_engine
 
+from tests.utils import setup_test_homeserver
+
 
 class SQLBaseStoreTestCase(unittest.TestCase):
     """ Test the "simple" SQL generating methods in SQLBaseStore. """
@@ -198,3 +200,60 @@ class SQLBaseStoreTestCase(unittest.TestCase):
                 "DELETE FROM tablename WHERE keycol = ?",
                 ["Go away"]
         )
+
+
+class StreamQueryTestCase(unittest.TestCase):
+    """ Test streaming query results out of SQLBaseStore in chunks. """
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver()
+        self.store = hs.get_datastore()
+
+        def create_table(txn):
+            txn.execute("CREATE TABLE streamed (id INTEGER)")
+            txn.executemany(
+                "INSERT INTO streamed (id) VALUES (?)",
+                [(i,) for i in range(25)],
+            )
+
+        yield self.store.runInteraction("create_table", create_table)
+
+    @defer.inlineCallbacks
+    def test_stream_query_txn(self):
+        def stream_txn(txn):
+            return list(self.store._stream_query_txn(
+                txn, "SELECT id FROM streamed WHERE id >= ? ORDER BY id", (5,),
+                chunk_size=10,
+            ))
+
+        chunks = yield self.store.runInteraction("stream", stream_txn)
+
+        self.assertEquals([10, 10], [len(c) for c in chunks])
+        self.assertEquals(
+            range(5, 25), [row[0] for chunk in chunks for row in chunk]
+        )
+
+    @defer.inlineCallbacks
+    def test_stream_query(self):
+        chunks = []
+
+        @defer.inlineCallbacks
+        def consumer(rows):
+            chunks.append([row[0] for row in rows])
+            # The consumer is free to use the database, even with a single
+            # connection, and the next chunk is only fetched once it's done.
+            yield self.store.runInteraction(
+                "consume", lambda txn: txn.execute("SELECT 1")
+            )
+
+        count = yield self.store.stream_query(
+            "stream", consumer,
+            "SELECT id FROM streamed WHERE id > ? ORDER BY id LIMIT ?", 2,
+            chunk_size=10,
+        )
+
+        self.assertEquals(22, count)
+        self.assertEquals(
+            [range(3, 13), range(13, 23), range(23, 25)], chunks
+        )
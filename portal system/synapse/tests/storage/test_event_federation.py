@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from mock import Mock
+from synapse.types import RoomID, UserID
+
+from tests import unittest
+from twisted.internet import defer
+from tests.storage.event_injector import EventInjector
+
+from tests.utils import setup_test_homeserver
+
+
+class EventFederationStoreTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+        self.store = self.hs.get_datastore()
+        self.db_pool = self.hs.get_db_pool()
+        self.event_injector = EventInjector(self.hs)
+
+    @defer.inlineCallbacks
+    def _inject_room(self):
+        room = RoomID.from_string("!abc123:test")
+        alice = UserID.from_string("@alice:test")
+        bob = UserID.from_string("@bob:test")
+
+        yield self.event_injector.create_room(room)
+        yield self.event_injector.inject_room_member(room, alice, "join")
+        yield self.event_injector.inject_room_member(room, bob, "join")
+        message = yield self.event_injector.inject_message(room, bob, "Hi")
+        leave = yield self.event_injector.inject_room_member(
+            room, bob, "leave"
+        )
+
+        defer.returnValue((message, leave))
+
+    @defer.inlineCallbacks
+    def _get_auth_chain_ids_by_walking(self, event_ids):
+        # Walk event_auth directly, for comparison with the index.
+        results = set()
+        front = set(event_ids)
+        while front:
+            rows = yield self.db_pool.runQuery(
+                "SELECT auth_id FROM event_auth WHERE event_id IN (%s)" % (
+                    ",".join(["?"] * len(front)),
+                ),
+                list(front),
+            )
+            front = set(r[0] for r in rows) - results
+            results.update(front)
+
+        defer.returnValue(results)
+
+    @defer.inlineCallbacks
+    def test_auth_chain_index(self):
+        message, leave = yield self._inject_room()
+
+        rows = yield self.db_pool.runQuery(
+            "SELECT COUNT(*) FROM event_auth_chains WHERE event_id = ?",
+            (leave.event_id,)
+        )
+        self.assertGreater(rows[0][0], 1)
+
+        for event_ids in (
+            [message.event_id],
+            [leave.event_id],
+            [message.event_id, leave.event_id],
+        ):
+            expected = yield self._get_auth_chain_ids_by_walking(event_ids)
+            self.assertTrue(expected)
+
+            chain = yield self.store.get_auth_chain_ids(event_ids)
+            self.assertItemsEqual(expected, chain)
+
+    @defer.inlineCallbacks
+    def test_background_index_auth_chains(self):
+        message, leave = yield self._inject_room()
+
+        expected = yield self._get_auth_chain_ids_by_walking(
+            [message.event_id, leave.event_id]
+        )
+
+        yield self.db_pool.runQuery("DELETE FROM event_auth_chains")
+
+        # Still answered correctly by walking event_auth.
+        chain = yield self.store.get_auth_chain_ids(
+            [message.event_id, leave.event_id]
+        )
+        self.assertItemsEqual(expected, chain)
+
+        yield self.store.start_background_update(
+            self.store.EVENT_AUTH_CHAINS_UPDATE_NAME,
+            {
+                "min_stream_id_inclusive": 0,
+                "max_stream_id_exclusive": (
+                    leave.internal_metadata.stream_ordering + 1
+                ),
+            }
+        )
+        result = yield self.store.do_background_update(100)
+        self.assertIsNotNone(result)
+
+        rows = yield self.db_pool.runQuery(
+            "SELECT COUNT(*) FROM event_auth_chains WHERE event_id = ?",
+            (leave.event_id,)
+        )
+        self.assertGreater(rows[0][0], 1)
+
+        chain = yield self.store.get_auth_chain_ids(
+            [message.event_id, leave.event_id]
+        )
+        self.assertItemsEqual(expected, chain)
+
+    @defer.inlineCallbacks
+    def test_queued_auth_chains_indexed_with_auth_events(self):
+        message, leave = yield self._inject_room()
+
+        expected = yield self._get_auth_chain_ids_by_walking(
+            [leave.event_id]
+        )
+
+        yield self.db_pool.runQuery("DELETE FROM event_auth_chains")
+
+        # The leave is persisted "after" the upgrade, before its auth events
+        # have been indexed, so it gets queued.
+        indexed = yield self.store.runInteraction(
+            "test", self.store._store_auth_chain_index_txn,
+            {leave.event_id: [auth_id for auth_id, _ in leave.auth_events]},
+        )
+        self.assertEquals(0, indexed)
+
+        rows = yield self.db_pool.runQuery(
+            "SELECT event_id FROM event_auth_chains_to_calculate"
+        )
+        self.assertEquals([(leave.event_id,)], rows)
+
+        # The background update doesn't cover the leave itself, but picks it
+        # up once its auth events are indexed.
+        yield self.store.start_background_update(
+            self.store.EVENT_AUTH_CHAINS_UPDATE_NAME,
+            {
+                "min_stream_id_inclusive": 0,
+                "max_stream_id_exclusive": (
+                    leave.internal_metadata.stream_ordering
+                ),
+            }
+        )
+        yield self.store.do_background_update(100)
+
+        rows = yield self.db_pool.runQuery(
+            "SELECT event_id FROM event_auth_chains_to_calculate"
+        )
+        self.assertEquals([], rows)
+
+        rows = yield self.db_pool.runQuery(
+            "SELECT auth_id FROM event_auth_chains WHERE event_id = ?",
+            (leave.event_id,)
+        )
+        self.assertItemsEqual(
+            expected | set([leave.event_id]), [r[0] for r in rows]
+        )
+
+    @defer.inlineCallbacks
+    def test_latest_events_cache(self):
+        message, leave = yield self._inject_room()
+        room_id = message.room_id
+
+        self.store.runInteraction = Mock(side_effect=AssertionError)
+
+        latest_ids = yield self.store.get_latest_event_ids_in_room(room_id)
+        self.assertEquals([leave.event_id], latest_ids)
+
+        latest = yield self.store.get_latest_events_in_room(room_id)
+        self.assertEquals(
+            [(leave.event_id, leave.depth)],
+            [(e_id, depth) for e_id, _, depth in latest]
+        )
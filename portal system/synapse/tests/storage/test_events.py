@@ -114,3 +114,53 @@ class EventsStoreTestCase(unittest.TestCase):
             "SELECT reported_stream_token, reported_time FROM stats_reporting"
         )
         self.assertEqual([(self.base_event + messages, time,)], rows)
+
+    @defer.inlineCallbacks
+    def test_compressed_event_json(self):
+        room = RoomID.from_string("!abc123:test")
+        user = UserID.from_string("@raccoonlover:test")
+        yield self.event_injector.create_room(room)
+
+        self.store._compress_event_json = True
+        event = yield self.event_injector.inject_message(
+            room, user, u"Raccoons are really cute \u2603"
+        )
+
+        rows = yield self.db_pool.runQuery(
+            "SELECT json, compressed_json FROM event_json WHERE event_id = ?",
+            (event.event_id,)
+        )
+        self.assertEquals(u"", rows[0][0])
+        self.assertIsNotNone(rows[0][1])
+
+        self.store._get_event_cache.invalidate_all()
+        fetched = yield self.store.get_event(event.event_id)
+        self.assertEquals(event.get_dict(), fetched.get_dict())
+
+    @defer.inlineCallbacks
+    def test_background_compress_event_json(self):
+        room = RoomID.from_string("!abc123:test")
+        user = UserID.from_string("@raccoonlover:test")
+        yield self.event_injector.create_room(room)
+        events = []
+        for i in range(3):
+            event = yield self.event_injector.inject_message(
+                room, user, "Raccoon fact %d" % (i,)
+            )
+            events.append(event)
+
+        self.store._compress_event_json = True
+        yield self.store.queue_event_json_compression()
+
+        result = yield self.store.do_background_update(100)
+        self.assertIsNotNone(result)
+
+        rows = yield self.db_pool.runQuery(
+            "SELECT COUNT(*) FROM event_json WHERE compressed_json IS NULL"
+        )
+        self.assertEquals([(0,)], rows)
+
+        self.store._get_event_cache.invalidate_all()
+        for event in events:
+            fetched = yield self.store.get_event(event.event_id)
+            self.assertEquals(event.get_dict(), fetched.get_dict())
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+
+from mock import Mock
+from synapse.api.constants import EventTypes, Membership
+from synapse.types import RoomID, UserID
+
+from tests import unittest
+from twisted.internet import defer
+from tests.storage.event_injector import EventInjector
+
+from tests.utils import setup_test_homeserver
+
+
+class CurrentStateTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+        self.store = self.hs.get_datastore()
+        self.event_injector = EventInjector(self.hs)
+
+        # The cache lives on the class, so is shared between tests.
+        self.store.get_current_state_ids.invalidate_all()
+
+        self.room = RoomID.from_string("!abc123:test")
+        self.alice = UserID.from_string("@alice:test")
+        self.bob = UserID.from_string("@bob:test")
+
+    @defer.inlineCallbacks
+    def test_current_state_cache(self):
+        yield self.event_injector.create_room(self.room)
+        yield self.event_injector.inject_room_member(
+            self.room, self.alice, Membership.JOIN
+        )
+
+        state = yield self.store.get_current_state(self.room.to_string())
+        self.assertItemsEqual(
+            [(EventTypes.Member, "@alice:test")],
+            [(e.type, e.state_key) for e in state]
+        )
+
+        interactions = []
+        run_interaction = self.store.runInteraction
+
+        def record_interaction(desc, *args, **kwargs):
+            interactions.append(desc)
+            return run_interaction(desc, *args, **kwargs)
+
+        self.store.runInteraction = record_interaction
+
+        join = yield self.event_injector.inject_room_member(
+            self.room, self.bob, Membership.JOIN
+        )
+        leave = yield self.event_injector.inject_room_member(
+            self.room, self.alice, Membership.LEAVE
+        )
+
+        del interactions[:]
+
+        state = yield self.store.get_current_state(self.room.to_string())
+        self.assertItemsEqual(
+            [join.event_id, leave.event_id],
+            [e.event_id for e in state]
+        )
+
+        members = yield self.store.get_current_state(
+            self.room.to_string(), EventTypes.Member, "@bob:test"
+        )
+        self.assertEquals([join.event_id], [e.event_id for e in members])
+
+        members = yield self.store.get_current_state(
+            self.room.to_string(), EventTypes.Member, state_key=None,
+        )
+        self.assertEquals(2, len(members))
+
+        self.assertNotIn("get_current_state_ids", interactions)
+
+
+    @defer.inlineCallbacks
+    def test_current_state_cache_update_copies(self):
+        yield self.event_injector.create_room(self.room)
+        yield self.event_injector.inject_room_member(
+            self.room, self.alice, Membership.JOIN
+        )
+
+        old_state = yield self.store.get_current_state_ids(
+            self.room.to_string()
+        )
+        old_items = dict(old_state)
+
+        join = yield self.event_injector.inject_room_member(
+            self.room, self.bob, Membership.JOIN
+        )
+
+        # A dict already handed out isn't modified by the update...
+        self.assertEquals(old_items, old_state)
+
+        # ... but the cache returns the new state.
+        new_state = yield self.store.get_current_state_ids(
+            self.room.to_string()
+        )
+        self.assertEquals(
+            join.event_id, new_state[(EventTypes.Member, "@bob:test")]
+        )
+        self.assertEquals(len(old_items) + 1, len(new_state))
+
+class StateGroupDedupTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+        self.store = self.hs.get_datastore()
+        self.event_injector = EventInjector(self.hs)
+
+        self.room = RoomID.from_string("!abc123:test")
+        self.alice = UserID.from_string("@alice:test")
+
+    def _copy_state_group(self, state_group, new_state_group, event_id):
+        def copy_state_group_txn(txn):
+            txn.execute(
+                "INSERT INTO state_groups (id, room_id, event_id)"
+                " SELECT ?, room_id, ? FROM state_groups WHERE id = ?",
+                (new_state_group, event_id, state_group)
+            )
+            txn.execute(
+                "INSERT INTO state_groups_state"
+                " (state_group, room_id, type, state_key, event_id)"
+                " SELECT ?, room_id, type, state_key, event_id"
+                " FROM state_groups_state WHERE state_group = ?",
+                (new_state_group, state_group)
+            )
+            txn.execute(
+                "UPDATE event_to_state_groups SET state_group = ?"
+                " WHERE event_id = ?",
+                (new_state_group, event_id)
+            )
+
+        return self.store.runInteraction(
+            "copy_state_group", copy_state_group_txn
+        )
+
+    @defer.inlineCallbacks
+    def _run_update(self):
+        progress = yield self.store._simple_select_one_onecol(
+            "background_updates",
+            keyvalues={"update_name": "state_group_dedup"},
+            retcol="progress_json",
+        )
+        result = yield self.store._background_deduplicate_state_groups(
+            json.loads(progress), 100
+        )
+        defer.returnValue(result)
+
+    def _count_state_rows(self, state_group):
+        return self.store._simple_select_list(
+            "state_groups_state",
+            keyvalues={"state_group": state_group},
+            retcols=("event_id",),
+        ).addCallback(len)
+
+    @defer.inlineCallbacks
+    def test_deduplicate_state_groups(self):
+        yield self.event_injector.create_room(self.room)
+        yield self.event_injector.inject_room_member(
+            self.room, self.alice, Membership.JOIN
+        )
+        message = yield self.event_injector.inject_message(
+            self.room, self.alice, "Hello"
+        )
+        room_id = self.room.to_string()
+
+        state_group = yield self.store._get_state_group_for_event(
+            room_id, message.event_id
+        )
+        state = yield self.store.get_state_groups(room_id, [message.event_id])
+
+        duplicate = state_group + 100
+        yield self._copy_state_group(state_group, duplicate, message.event_id)
+        self.store._get_state_group_for_event.invalidate_all()
+
+        yield self.store.start_background_update("state_group_dedup", {})
+
+        # The first batch points the event back at the original group...
+        result = yield self._run_update()
+        self.assertTrue(result)
+        self.assertEquals(
+            {duplicate: state_group}, self.store._merged_state_groups
+        )
+        group = yield self.store._get_state_group_for_event(
+            room_id, message.event_id
+        )
+        self.assertEquals(state_group, group)
+
+        rows = yield self._count_state_rows(duplicate)
+        self.assertTrue(rows)
+
+        # ... and the next deletes the duplicate, and finishes the update.
+        result = yield self._run_update()
+        self.assertTrue(result)
+        rows = yield self._count_state_rows(duplicate)
+        self.assertEquals(0, rows)
+
+        progress = yield self.store._simple_select_one_onecol(
+            "background_updates",
+            keyvalues={"update_name": "state_group_dedup"},
+            retcol="progress_json",
+            allow_none=True,
+        )
+        self.assertIsNone(progress)
+
+        new_state = yield self.store.get_state_groups(
+            room_id, [message.event_id]
+        )
+        self.assertEquals(state, new_state)
+
+
+    @defer.inlineCallbacks
+    def test_deduplicate_state_groups_after_restart(self):
+        yield self.event_injector.create_room(self.room)
+        message = yield self.event_injector.inject_message(
+            self.room, self.alice, "Hello"
+        )
+        room_id = self.room.to_string()
+
+        state_group = yield self.store._get_state_group_for_event(
+            room_id, message.event_id
+        )
+        duplicate = state_group + 100
+        yield self._copy_state_group(state_group, duplicate, message.event_id)
+
+        yield self.store.start_background_update("state_group_dedup", {})
+        yield self._run_update()
+
+        # Forget the merges, as if we had restarted.
+        self.store._merged_state_groups.clear()
+
+        yield self._run_update()
+        self.assertEquals(
+            {duplicate: state_group}, self.store._merged_state_groups
+        )
+        rows = yield self._count_state_rows(duplicate)
+        self.assertEquals(0, rows)
+
+    @defer.inlineCallbacks
+    def test_queue_state_group_dedup(self):
+        yield self.event_injector.create_room(self.room)
+        message = yield self.event_injector.inject_message(
+            self.room, self.alice, "Hello"
+        )
+        room_id = self.room.to_string()
+
+        yield self.store.start_background_update("state_group_dedup", {})
+        queued = yield self.store.queue_state_group_dedup()
+        self.assertFalse(queued)
+
+        result = yield self._run_update()
+        while result:
+            result = yield self._run_update()
+
+        # Nothing new to examine.
+        queued = yield self.store.queue_state_group_dedup()
+        self.assertFalse(queued)
+
+        # A duplicate group created after the update finished...
+        state_group = yield self.store._get_state_group_for_event(
+            room_id, message.event_id
+        )
+        duplicate = state_group + 100
+        yield self._copy_state_group(state_group, duplicate, message.event_id)
+
+        queued = yield self.store.queue_state_group_dedup()
+        self.assertTrue(queued)
+
+        progress = yield self.store._simple_select_one_onecol(
+            "background_updates",
+            keyvalues={"update_name": "state_group_dedup"},
+            retcol="progress_json",
+        )
+        self.assertEquals(
+            {"last_state_group": state_group}, json.loads(progress)
+        )
+
+        # ... is merged by the next run.
+        yield self._run_update()
+        yield self._run_update()
+        rows = yield self._count_state_rows(duplicate)
+        self.assertEquals(0, rows)
+
+class StateForEventsTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+        self.store = self.hs.get_datastore()
+        self.event_injector = EventInjector(self.hs)
+
+        self.room = RoomID.from_string("!abc123:test")
+        self.alice = UserID.from_string("@alice:test")
+        self.bob = UserID.from_string("@bob:test")
+
+    @defer.inlineCallbacks
+    def test_get_typed_state_for_events(self):
+        yield self.event_injector.create_room(self.room)
+        alice_join = yield self.event_injector.inject_room_member(
+            self.room, self.alice, Membership.JOIN
+        )
+        bob_join = yield self.event_injector.inject_room_member(
+            self.room, self.bob, Membership.JOIN
+        )
+        event_ids = [alice_join.event_id, bob_join.event_id]
+
+        state = yield self.store.get_state_for_events(
+            event_ids, [(EventTypes.Member, self.alice.to_string())]
+        )
+        self.assertEquals(
+            {
+                alice_join.event_id: [alice_join.event_id],
+                bob_join.event_id: [alice_join.event_id],
+            },
+            {k: [e.event_id for e in v.values()] for k, v in state.items()}
+        )
+
+        self.store._state_group_cache.invalidate_all()
+        state = yield self.store.get_state_for_events(
+            event_ids, [
+                (EventTypes.Member, None),
+                (EventTypes.Name, ""),
+            ]
+        )
+        self.assertItemsEqual(
+            [(EventTypes.Member, "@alice:test")],
+            state[alice_join.event_id].keys(),
+        )
+        self.assertItemsEqual(
+            [
+                (EventTypes.Member, "@alice:test"),
+                (EventTypes.Member, "@bob:test"),
+            ],
+            state[bob_join.event_id].keys(),
+        )
+
+    @defer.inlineCallbacks
+    def test_typed_state_query_uses_index(self):
+        sql, args = self.store._get_state_groups_from_groups_sql(
+            [1, 2, 3], [
+                (EventTypes.RoomHistoryVisibility, ""),
+                (EventTypes.Member, "@alice:test"),
+                (EventTypes.Member, None),
+            ]
+        )
+
+        def explain_txn(txn):
+            txn.execute("EXPLAIN QUERY PLAN " + sql, args)
+            return [row[-1] for row in txn.fetchall()]
+
+        plan = yield self.store.runInteraction("explain", explain_txn)
+
+        scans = [
+            step for step in plan
+            if "state_groups_state" in step or "AS s" in step
+        ]
+        self.assertTrue(scans)
+        for step in scans:
+            self.assertIn("state_groups_state_type_idx", step)
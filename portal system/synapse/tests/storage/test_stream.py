@@ -18,6 +18,7 @@ from tests import unittest
 from twisted.internet import defer
 
 from synapse.api.constants import EventTypes, Membership
+from synapse.storage.stream import READ_AHEAD_PAGE_EXPIRY_MS
 from synapse.types import UserID, RoomID
 from tests.storage.event_injector import EventInjector
 
@@ -183,3 +184,129 @@ class StreamStoreTestCase(unittest.TestCase):
             "prev_content" in event.unsigned,
             msg="No prev_content key"
         )
+
+    @defer.inlineCallbacks
+    def test_paginate_read_ahead(self):
+        yield self.event_injector.inject_room_member(
+            self.room1, self.u_alice, Membership.JOIN
+        )
+        for i in range(6):
+            yield self.event_injector.inject_message(
+                self.room1, self.u_alice, u"test %d" % (i,)
+            )
+
+        room_id = self.room1.to_string()
+        start = yield self.store.get_room_events_max_id(direction='b')
+
+        # Fetch the pages we expect without any read-ahead.
+        _, token = yield self.store.paginate_room_events(
+            room_id, start, limit=2,
+        )
+        expected, expected_token = yield self.store.paginate_room_events(
+            room_id, token, limit=2,
+        )
+
+        self.store._pagination_read_ahead = True
+
+        yield self.store.paginate_room_events(room_id, start, limit=2)
+        self.assertIn(
+            (token, None, 2),
+            self.store._read_ahead_cache.get((room_id,)),
+        )
+
+        events, next_token = yield self.store.paginate_room_events(
+            room_id, token, limit=2,
+        )
+        self.assertEqual(
+            [e.event_id for e in expected], [e.event_id for e in events]
+        )
+        self.assertEqual(expected_token, next_token)
+        self.assertNotIn(
+            (token, None, 2),
+            self.store._read_ahead_cache.get((room_id,)),
+        )
+
+        # The read-ahead for the page after that gets dropped when an event
+        # might have landed in it.
+        self.store._invalidate_read_ahead_for_room(room_id, 1)
+        self.assertIsNone(
+            self.store._read_ahead_cache.get((room_id,), None)
+        )
+
+    @defer.inlineCallbacks
+    def test_read_ahead_pages_evicted_and_expired(self):
+        yield self.event_injector.inject_room_member(
+            self.room1, self.u_alice, Membership.JOIN
+        )
+        room_id = self.room1.to_string()
+        start = yield self.store.get_room_events_max_id(direction='b')
+
+        for limit in (1, 2, 3):
+            self.store._read_ahead_room_events(room_id, start, None, limit)
+
+        # Only the newest pages are kept once the room is full.
+        self.assertEqual(
+            [(start, None, 2), (start, None, 3)],
+            self.store._read_ahead_cache.get((room_id,)).keys(),
+        )
+
+        # Pages nobody asks for expire, rather than blocking read-ahead.
+        self.store._clock.advance_time_msec(READ_AHEAD_PAGE_EXPIRY_MS + 1)
+        self.assertIsNone(
+            self.store._pop_read_ahead_page(room_id, start, None, 2)
+        )
+        self.assertEqual(
+            0, len(self.store._read_ahead_cache.get((room_id,)))
+        )
+
+        self.store._read_ahead_room_events(room_id, start, None, 2)
+        page = self.store._pop_read_ahead_page(room_id, start, None, 2)
+        rows, _ = yield page.observe()
+        self.assertEqual(1, len(rows))
+
+    @defer.inlineCallbacks
+    def test_get_recent_events_for_rooms(self):
+        yield self.event_injector.create_room(self.room1)
+        yield self.event_injector.create_room(self.room2)
+        yield self.event_injector.inject_room_member(
+            self.room1, self.u_alice, Membership.JOIN
+        )
+        yield self.event_injector.inject_room_member(
+            self.room2, self.u_alice, Membership.JOIN
+        )
+
+        start = yield self.store.get_room_events_max_id()
+
+        for i in range(3):
+            yield self.event_injector.inject_message(
+                self.room1, self.u_alice, u"test %d" % (i,)
+            )
+            yield self.event_injector.inject_message(
+                self.room2, self.u_alice, u"test %d" % (i,)
+            )
+
+        end = yield self.store.get_room_events_max_id()
+        room_ids = [self.room1.to_string(), self.room2.to_string()]
+
+        for from_token in (None, start):
+            results = yield self.store.get_recent_events_for_rooms(
+                room_ids + ["!empty:test"], 4, end, from_token=from_token,
+            )
+
+            for room_id in room_ids:
+                events, token = yield self.store.get_recent_events_for_room(
+                    room_id, 4, end, from_token=from_token,
+                )
+                self.assertEquals(
+                    [
+                        (e.event_id, e.internal_metadata.before)
+                        for e in events
+                    ],
+                    [
+                        (e.event_id, e.internal_metadata.before)
+                        for e in results[room_id][0]
+                    ],
+                )
+                self.assertEquals(token, results[room_id][1])
+
+            self.assertEquals(([], (end, end)), results["!empty:test"])
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from . import unittest
+from twisted.internet import defer
+
+from mock import Mock
+
+from synapse.appservice import ApplicationService
+from synapse.notifier import Notifier, _NotifierUserStream
+from synapse.types import StreamToken
+
+from tests.utils import MockClock
+
+
+START_TOKEN = StreamToken.from_string("s0_0_0_0_0")
+
+
+class NotifierTestCase(unittest.TestCase):
+
+    def setUp(self):
+        hs = Mock(spec=[
+            "get_event_sources", "get_datastore", "get_clock",
+            "get_distributor", "get_handlers",
+        ])
+        self.clock = MockClock()
+        hs.get_clock.return_value = self.clock
+
+        self.notifier = Notifier(hs)
+
+    def _add_user_stream(self, user_id, room_id):
+        user_stream = _NotifierUserStream(
+            user=user_id,
+            rooms=[room_id],
+            current_token=START_TOKEN,
+            time_now_ms=0,
+        )
+        self.notifier._register_with_keys(user_stream)
+        return user_stream
+
+    @defer.inlineCallbacks
+    def test_notifications_coalesced(self):
+        user_stream = self._add_user_stream("@alice:test", "!room:test")
+
+        wakeups = []
+        listener = user_stream.new_listener(START_TOKEN)
+        listener.deferred.addCallback(wakeups.append)
+
+        yield defer.gatherResults([
+            self.notifier.on_new_event(
+                "room_key", "s%d" % (i,), rooms=["!room:test"]
+            )
+            for i in range(1, 4)
+        ])
+
+        # Nothing is woken up until the next reactor tick.
+        self.assertEquals(wakeups, [])
+        self.assertEquals(user_stream.current_token.room_key, "s3")
+
+        self.clock.advance_time(Notifier.NOTIFY_COALESCE_WINDOW_S)
+
+        self.assertEquals(len(wakeups), 1)
+        self.assertEquals(wakeups[0].room_key, "s3")
+        self.assertEquals(self.notifier._pending_user_streams, set())
+
+    @defer.inlineCallbacks
+    def test_new_listener_sees_pending_notification(self):
+        user_stream = self._add_user_stream("@alice:test", "!room:test")
+
+        yield self.notifier.on_new_event(
+            "room_key", "s1", rooms=["!room:test"]
+        )
+
+        # A listener added before the wake up still sees the new token.
+        listener = user_stream.new_listener(START_TOKEN)
+        self.assertTrue(listener.deferred.called)
+
+    def test_appservice_streams_notified(self):
+        irc = ApplicationService(
+            token="irc_token", sender="@irc:test",
+            namespaces={
+                ApplicationService.NS_USERS: [
+                    {"regex": "@irc_.*", "exclusive": True},
+                ],
+            },
+        )
+        user_stream = _NotifierUserStream(
+            user="@irc:test",
+            rooms=[],
+            current_token=START_TOKEN,
+            time_now_ms=0,
+            appservice=irc,
+        )
+        self.notifier._register_with_keys(user_stream)
+        self.notifier.on_new_event = Mock()
+
+        event = Mock(
+            type="m.room.member", room_id="!room:test",
+            sender="@alice:test", state_key="@irc_bob:test",
+        )
+        self.notifier._on_new_room_event(event, "s1")
+        self.assertEquals(
+            self.notifier.on_new_event.call_args[1]["extra_streams"],
+            set([user_stream])
+        )
+
+        event.state_key = "@bob:test"
+        self.notifier._on_new_room_event(event, "s2")
+        self.assertEquals(
+            self.notifier.on_new_event.call_args[1]["extra_streams"], set()
+        )
+
+    def test_expire_unused_streams(self):
+        self._add_user_stream("@alice:test", "!room:test")
+        self.clock.advance_time_msec(Notifier.UNUSED_STREAM_EXPIRY_MS / 2)
+        bob_stream = self._add_user_stream("@bob:test", "!room:test")
+
+        self.clock.advance_time_msec(Notifier.UNUSED_STREAM_EXPIRY_MS / 2 + 1)
+        self.notifier.remove_expired_streams()
+
+        self.assertEquals(self.notifier.user_to_user_stream.keys(), ["@bob:test"])
+        self.assertEquals(
+            self.notifier.room_to_user_streams, {"!room:test": set([bob_stream])}
+        )
+
+        self.clock.advance_time_msec(Notifier.UNUSED_STREAM_EXPIRY_MS)
+        self.notifier.remove_expired_streams()
+
+        self.assertEquals(self.notifier.user_to_user_stream, {})
+        self.assertEquals(self.notifier.room_to_user_streams, {})
+
+    @defer.inlineCallbacks
+    def test_notified_and_listened_streams_not_expired(self):
+        alice_stream = self._add_user_stream("@alice:test", "!alice:test")
+        bob_stream = self._add_user_stream("@bob:test", "!bob:test")
+
+        self.clock.advance_time_msec(Notifier.UNUSED_STREAM_EXPIRY_MS)
+        yield self.notifier.on_new_event(
+            "room_key", "s1", rooms=["!alice:test"]
+        )
+        bob_stream.new_listener(START_TOKEN)
+
+        self.clock.advance_time_msec(1)
+        self.notifier.remove_expired_streams()
+
+        self.assertEquals(
+            self.notifier.user_to_user_stream,
+            {"@alice:test": alice_stream, "@bob:test": bob_stream}
+        )
+
+    @defer.inlineCallbacks
+    def test_listener_count(self):
+        self._add_user_stream("@alice:test", "!room:test")
+
+        callback = Mock(side_effect=[
+            defer.succeed([]), defer.succeed(["event"]),
+        ])
+        d = self.notifier.wait_for_events(
+            "@alice:test", 1000, callback, from_token=START_TOKEN,
+        )
+        self.assertEquals(self.notifier._listener_count, 1)
+
+        yield self.notifier.on_new_event(
+            "room_key", "s1", rooms=["!room:test"]
+        )
+        self.clock.advance_time(Notifier.NOTIFY_COALESCE_WINDOW_S)
+        result = yield d
+
+        self.assertEquals(result, ["event"])
+        self.assertEquals(self.notifier._listener_count, 0)
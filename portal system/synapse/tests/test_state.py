@@ -78,6 +78,12 @@ class StateGroupStore(object):
 
         return defer.succeed(groups)
 
+    def get_state_group_ids(self, room_id, event_ids):
+        return defer.succeed(set(
+            self._event_to_state_group.get(event_id)
+            for event_id in event_ids
+        ))
+
     def store_state_groups(self, event, context):
         if context.current_state is None:
             return
@@ -85,7 +91,9 @@ class StateGroupStore(object):
         state_events = context.current_state
 
         if event.is_state():
-            state_events[(event.type, event.state_key)] = event
+            state_events = state_events.set(
+                (event.type, event.state_key), event
+            )
 
         state_group = context.state_group
         if not state_group:
@@ -137,6 +145,7 @@ class StateTestCase(unittest.TestCase):
         self.store = Mock(
             spec_set=[
                 "get_state_groups",
+                "get_state_group_ids",
                 "add_event_hashes",
             ]
         )
@@ -521,6 +530,30 @@ class StateTestCase(unittest.TestCase):
 
         self.assertIsNone(context.state_group)
 
+    @defer.inlineCallbacks
+    def test_contexts_share_cached_state(self):
+        self.state.start_caching()
+
+        old_state = [
+            create_event(type="test1", state_key="1"),
+            create_event(type="test2", state_key=""),
+        ]
+
+        self.store.get_state_groups.return_value = {
+            "group_name_1": old_state,
+        }
+        self.store.get_state_group_ids.return_value = set(["group_name_1"])
+
+        context_1 = yield self.state.compute_event_context(
+            create_event(type="test_message", name="event1")
+        )
+        context_2 = yield self.state.compute_event_context(
+            create_event(type="test_message", name="event2")
+        )
+
+        self.assertIs(context_1.current_state, context_2.current_state)
+        self.assertEqual(1, self.store.get_state_groups.call_count)
+
     @defer.inlineCallbacks
     def test_resolve_message_conflict(self):
         event = create_event(type="test_message", name="event")
@@ -629,6 +662,68 @@ class StateTestCase(unittest.TestCase):
 
         self.assertEqual(old_state_1[2], context.current_state[("test1", "1")])
 
+    @defer.inlineCallbacks
+    def test_resolution_memoized_by_state_groups(self):
+        self.state.start_caching()
+
+        creation = create_event(
+            type=EventTypes.Create, state_key="",
+            content={"creator": "@user_id:example.com"}
+        )
+        member_event = create_event(
+            type=EventTypes.Member,
+            state_key="@user_id:example.com",
+            content={"membership": Membership.JOIN},
+        )
+
+        old_state_1 = [
+            creation,
+            member_event,
+            create_event(type="test1", state_key="1", depth=1),
+        ]
+        old_state_2 = [
+            creation,
+            member_event,
+            create_event(type="test1", state_key="1", depth=2),
+        ]
+
+        self.store.get_state_groups.return_value = {
+            "group_name_1": old_state_1,
+            "group_name_2": old_state_2,
+        }
+        self.store.get_state_group_ids.return_value = set([
+            "group_name_1", "group_name_2",
+        ])
+
+        auth = self.state.hs.get_auth()
+        auth.check = Mock(side_effect=auth.check)
+
+        group, state, prev_states = yield self.state.resolve_state_groups(
+            "!room_id:example.com", ["$A:example.com", "$B:example.com"],
+            event_type="test1", state_key="1",
+        )
+        self.assertIsNone(group)
+        self.assertEqual(old_state_2[2], state[("test1", "1")])
+        self.assertItemsEqual(
+            [old_state_1[2].event_id, old_state_2[2].event_id], prev_states
+        )
+        self.assertEqual(1, auth.check.call_count)
+
+        # A different set of extremities with the same state groups shouldn't
+        # need resolving again.
+        group, state_2, prev_states = yield self.state.resolve_state_groups(
+            "!room_id:example.com", ["$C:example.com", "$D:example.com"],
+            event_type="test1", state_key="1",
+        )
+        self.assertIs(state, state_2)
+        self.assertItemsEqual(
+            [old_state_1[2].event_id, old_state_2[2].event_id], prev_states
+        )
+        self.assertEqual(1, auth.check.call_count)
+
+        # ... nor loading the state of the groups.
+        self.assertEqual(1, self.store.get_state_groups.call_count)
+
     def _get_context(self, event, old_state_1, old_state_2):
         group_name_1 = "group_name_1"
         group_name_2 = "group_name_2"
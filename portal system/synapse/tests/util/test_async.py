@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from twisted.internet import defer
+from tests import unittest
+
+from synapse.util.async import concurrently_execute
+
+
+class ConcurrentlyExecuteTestCase(unittest.TestCase):
+
+    def test_limit_and_order(self):
+        pending = {}
+
+        def func(arg):
+            pending[arg] = defer.Deferred()
+            return pending[arg]
+
+        results = []
+        concurrently_execute(func, range(5), 2).addCallback(results.append)
+        self.assertItemsEqual([0, 1], pending.keys())
+
+        # Finishing a call out of order starts the next one.
+        pending[1].callback("b")
+        self.assertItemsEqual([0, 1, 2], pending.keys())
+
+        for arg in [2, 0, 3, 4]:
+            pending[arg].callback(chr(ord("a") + arg))
+
+        self.assertEquals([["a", "b", "c", "d", "e"]], results)
+
+    def test_failure(self):
+        def func(arg):
+            if arg == 1:
+                return defer.fail(ValueError("boom"))
+            return defer.succeed(arg)
+
+        failures = []
+        concurrently_execute(func, range(3), 2).addErrback(failures.append)
+        self.assertEquals(1, len(failures))
+        failures[0].trap(ValueError)
+
+    def test_empty(self):
+        results = []
+        concurrently_execute(None, [], 5).addCallback(results.append)
+        self.assertEquals([[]], results)
+
+    def test_limit_below_one(self):
+        for limit in (0, -1):
+            results = []
+            concurrently_execute(
+                defer.succeed, range(3), limit
+            ).addCallback(results.append)
+            self.assertEquals([[0, 1, 2]], results)
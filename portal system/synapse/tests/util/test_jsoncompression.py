@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from .. import unittest
+
+from synapse.util.jsoncompression import (
+    JsonCompressor, event_json_compressor,
+)
+
+import zlib
+
+
+class JsonCompressorTestCase(unittest.TestCase):
+
+    def test_round_trip(self):
+        js = (
+            u'{"type":"m.room.message","room_id":"!a:test",'
+            u'"content":{"msgtype":"m.text","body":"☃"}}'
+        ).encode("UTF-8")
+
+        compressed = event_json_compressor.compress(js)
+        self.assertLess(len(compressed), len(zlib.compress(js)))
+        self.assertEquals(js, event_json_compressor.decompress(compressed))
+        self.assertEquals(
+            js, event_json_compressor.decompress(buffer(compressed))
+        )
+
+    def test_old_dictionary(self):
+        old = JsonCompressor({1: b'"body":"'}, 1)
+        new = JsonCompressor({1: b'"body":"', 2: b'"msgtype":"'}, 2)
+
+        compressed = old.compress(b'{"body":"hello"}')
+        self.assertEquals(b'{"body":"hello"}', new.decompress(compressed))
+        self.assertEquals(
+            b'{"msgtype":"m.text"}',
+            new.decompress(new.compress(b'{"msgtype":"m.text"}')),
+        )
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from twisted.internet import defer
+from tests import unittest
+from tests.utils import MockClock
+
+from synapse.util.caches.response_cache import ResponseCache
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = MockClock()
+        self.cache = ResponseCache(
+            self.clock, timeout_ms=2000, keep_result=bool,
+        )
+
+    def test_concurrent_requests_share_result(self):
+        d = defer.Deferred()
+        first = self.cache.set("key", d)
+
+        second = self.cache.get("key")
+        self.assertIsNotNone(second)
+        self.assertIsNone(self.cache.get("other"))
+
+        results = []
+        first.addCallback(results.append)
+        second.addCallback(results.append)
+
+        d.callback(["result"])
+        self.assertEquals([["result"], ["result"]], results)
+
+    def test_result_kept_until_timeout(self):
+        self.cache.set("key", defer.succeed(["result"]))
+
+        self.clock.advance_time(1)
+        results = []
+        self.cache.get("key").addCallback(results.append)
+        self.assertEquals([["result"]], results)
+
+        self.clock.advance_time(1)
+        self.assertIsNone(self.cache.get("key"))
+
+    def test_empty_result_not_kept(self):
+        d = defer.Deferred()
+        self.cache.set("key", d)
+        self.assertIsNotNone(self.cache.get("key"))
+
+        d.callback([])
+        self.assertIsNone(self.cache.get("key"))
+
+    def test_failure_not_kept(self):
+        d = defer.Deferred()
+        first = self.cache.set("key", d)
+        second = self.cache.get("key")
+
+        failures = []
+        first.addErrback(failures.append)
+        second.addErrback(failures.append)
+
+        d.errback(Exception("boom"))
+        self.assertEquals(2, len(failures))
+        self.assertIsNone(self.cache.get("key"))
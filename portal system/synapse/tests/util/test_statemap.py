@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from .. import unittest
+
+from synapse.util.statemap import StateMap
+
+
+class StateMapTestCase(unittest.TestCase):
+
+    def test_set(self):
+        base = StateMap({("a", ""): 1, ("b", ""): 2})
+        derived = base.set(("b", ""), 3).set(("c", ""), 4)
+
+        self.assertEquals(dict(base), {("a", ""): 1, ("b", ""): 2})
+        self.assertEquals(
+            dict(derived), {("a", ""): 1, ("b", ""): 3, ("c", ""): 4},
+        )
+        self.assertEquals(len(derived), 3)
+        self.assertIn(("c", ""), derived)
+        self.assertNotIn(("c", ""), base)
+        self.assertEquals(derived.get(("d", ""), 5), 5)
+        self.assertItemsEqual(derived.values(), [1, 3, 4])
+        self.assertItemsEqual(derived.keys(), [("a", ""), ("b", ""), ("c", "")])
+
+        # The unchanged state is shared rather than copied.
+        self.assertIs(derived._base, base._base)
+
+    def test_set_many(self):
+        base = StateMap({("a", ""): 1})
+        derived = base.set_many({("a", ""): 2, ("b", ""): 3})
+
+        self.assertEquals(dict(derived), {("a", ""): 2, ("b", ""): 3})
+        self.assertIs(base.set_many({}), base)
+
+    def test_changes_folded(self):
+        state_map = StateMap({("m", str(i)): i for i in range(1000)})
+        for i in range(100):
+            state_map = state_map.set(("n", str(i)), i)
+
+        self.assertEquals(len(state_map), 1100)
+        self.assertLessEqual(len(state_map._changes), 32)
+        self.assertEquals(state_map[("m", "10")], 10)
+        self.assertEquals(state_map[("n", "10")], 10)
+
+    def test_immutable(self):
+        state_map = StateMap({("a", ""): 1})
+
+        with self.assertRaises(TypeError):
+            state_map[("a", "")] = 2
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from twisted.internet import defer
+from tests import unittest
+
+from synapse.util.caches.stream_change_cache import StreamChangeCache
+
+
+class StreamChangeCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = StreamChangeCache(
+            "test", lambda: defer.succeed(10), max_size=3,
+        )
+
+    @defer.inlineCallbacks
+    def test_changes(self):
+        yield self.cache.entity_has_changed("a", 11)
+        yield self.cache.entity_has_changed("b", 12)
+        yield self.cache.entity_has_changed("a", 13)
+
+        changed = yield self.cache.get_entities_changed(["a", "b", "c"], 11)
+        self.assertEquals(set(["a", "b"]), changed)
+
+        changed = yield self.cache.get_entities_changed(["a", "b", "c"], 12)
+        self.assertEquals(set(["a"]), changed)
+
+        changed = yield self.cache.has_entity_changed("b", 12)
+        self.assertFalse(changed)
+        changed = yield self.cache.has_entity_changed("c", 10)
+        self.assertFalse(changed)
+
+        changed = yield self.cache.has_any_entity_changed(12)
+        self.assertTrue(changed)
+        changed = yield self.cache.has_any_entity_changed(13)
+        self.assertFalse(changed)
+
+    @defer.inlineCallbacks
+    def test_unknown_positions(self):
+        # The cache doesn't know what happened before it was created.
+        changed = yield self.cache.get_entities_changed(["a", "b"], 9)
+        self.assertEquals(set(["a", "b"]), changed)
+        changed = yield self.cache.has_entity_changed("a", 9)
+        self.assertTrue(changed)
+
+        # Changes from before it was created are ignored.
+        yield self.cache.entity_has_changed("a", 5)
+        changed = yield self.cache.has_entity_changed("a", 10)
+        self.assertFalse(changed)
+
+    @defer.inlineCallbacks
+    def test_evicted(self):
+        for i, entity in enumerate(["a", "b", "c", "d"]):
+            yield self.cache.entity_has_changed(entity, 11 + i)
+
+        # Forgetting about "a" means we can no longer tell what changed since
+        # before its change.
+        changed = yield self.cache.has_entity_changed("d", 10)
+        self.assertTrue(changed)
+        changed = yield self.cache.get_entities_changed(["a", "e"], 11)
+        self.assertEquals(set(), changed)
+        changed = yield self.cache.get_entities_changed(["a", "c", "d"], 12)
+        self.assertEquals(set(["c", "d"]), changed)